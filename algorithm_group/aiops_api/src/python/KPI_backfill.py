@@ -0,0 +1,304 @@
+# 离线重算历史预测：按 id 分块读取一段历史数据，跨块向量化计算窗口特征，用当前模型大批量打分，批量写回 predict
+# 多个 KPI 由多个子进程并行处理；每个 KPI 的进度写在 saveDirs/<kpi>/backfill.json，中断后重新运行会从断点继续
+# 用法（在本目录下运行，读取 KPIautoPredictConfig.ini）：
+#       python KPI_backfill.py all --only-null --workers 4
+#       python KPI_backfill.py kpi_all_p95_hour kpi_service_qps_minute --from-time "2020-01-01 00:00:00"
+#       python KPI_backfill.py kpi_all_p95_hour --from-id 100000 --to-id 200000 --restart
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import KPI_config
+import KPI_db
+import KPI_feature
+import KPI_kpiConfig
+import KPI_modelCache
+import KPI_predict
+from KPI_config import modelConfig as globalConfig, tableIgnoreList
+
+checkpointName = "backfill.json"
+# 每隔这么多秒输出一次进度
+reportEvery = 5
+
+
+def history_num(modelConfig):
+    # 与 autoPredictKPI.getHistoryNum 相同：一个点之前至少有这么多行才打分
+    return max(modelConfig["STA_windowSize_left"], modelConfig["minPredictNum"])
+
+
+def id_range(db, kpiName, fromId=None, toId=None, fromTime=None, toTime=None):
+    # 把 id / 时间范围换算成 [firstId, lastId]（数据按 id 顺序写入，时间随 id 递增），没有数据时返回 None
+    conditions = []
+    params = []
+    if fromId is not None:
+        conditions.append("`id` >= %s")
+        params.append(fromId)
+    if toId is not None:
+        conditions.append("`id` <= %s")
+        params.append(toId)
+    if fromTime is not None:
+        conditions.append("`time` >= %s")
+        params.append(fromTime)
+    if toTime is not None:
+        conditions.append("`time` <= %s")
+        params.append(toTime)
+    SQLstr = "SELECT MIN(`id`), MAX(`id`) FROM " + KPI_db.table(kpiName)
+    if len(conditions) > 0:
+        SQLstr += " WHERE " + " AND ".join(conditions)
+    value = db.query_one(SQLstr, tuple(params))
+    if value is None or value[0] is None:
+        return None
+    return int(value[0]), int(value[1])
+
+
+def read_context(db, kpiName, afterId, count):
+    # id <= afterId 的最后 count 行（升序），作为第一个点的窗口
+    values = db.query("SELECT `id`, `value` FROM " + KPI_db.table(kpiName) +
+                      " WHERE `id` <= %s ORDER BY `id` DESC LIMIT %s", (afterId, count))
+    values.reverse()
+    return np.array([row[0] for row in values], dtype=np.int64), np.array([row[1] for row in values], dtype=np.float64)
+
+
+def read_upper(db, kpiName, lastId, right):
+    # 右窗口需要 lastId 之后的 right - 1 行，返回实际要读到的 id
+    if right <= 1:
+        return lastId
+    value = db.query_one("SELECT `id` FROM " + KPI_db.table(kpiName) + " WHERE `id` > %s ORDER BY `id` LIMIT %s, 1",
+                         (lastId, right - 2))
+    if value is None:
+        value = db.query_one("SELECT MAX(`id`) FROM " + KPI_db.table(kpiName))
+    return max(int(value[0]), lastId)
+
+
+def iter_rows(db, kpiName, afterId, upperId, chunkSize):
+    # 按 id 分页读取 (afterId, upperId]，每块为 (ids, values, predict 是否为空)
+    table = KPI_db.table(kpiName)
+    while True:
+        values = db.query("SELECT `id`, `value`, `predict` FROM " + table +
+                          " WHERE `id` > %s AND `id` <= %s ORDER BY `id` LIMIT %s", (afterId, upperId, chunkSize))
+        if len(values) == 0:
+            return
+        chunk = (np.array([row[0] for row in values], dtype=np.int64),
+                 np.array([row[1] for row in values], dtype=np.float64),
+                 np.array([row[2] is None for row in values], dtype=bool))
+        del values
+        afterId = int(chunk[0][-1])
+        yield chunk
+        if len(chunk[0]) < chunkSize:
+            return
+
+
+def checkpoint_path(kpiName, modelConfig):
+    return os.path.join(modelConfig["saveDirs"], str(kpiName), checkpointName)
+
+
+def read_checkpoint(kpiName, modelConfig):
+    try:
+        with open(checkpoint_path(kpiName, modelConfig)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_checkpoint(kpiName, modelConfig, checkpoint):
+    path = checkpoint_path(kpiName, modelConfig)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+class Progress(object):
+
+    def __init__(self, kpiName, total):
+        self.kpiName = kpiName
+        self.total = total  # 范围内的 id 数，用于估计完成比例
+        self.rows = 0
+        self.written = 0
+        self.start = time.perf_counter()
+        self.reported = self.start
+
+    def add(self, rows, written, lastId, firstId, force=False):
+        self.rows += rows
+        self.written += written
+        now = time.perf_counter()
+        if not force and now - self.reported < reportEvery:
+            return
+        self.reported = now
+        done = 100.0 * (lastId - firstId + 1) / max(self.total, 1)
+        print("%s: %d 行，写回 %d，%.1f%%，%.0f 行/秒" % (self.kpiName, self.rows, self.written, min(done, 100.0),
+                                                    self.rows / max(now - self.start, 1e-9)))
+        sys.stdout.flush()
+
+
+def backfill_kpi(kpiName, options):
+    # 返回 {"kpi", "rows", "written", "seconds", "status"}；使用该 KPI 的参数（kpiConfig.json）
+    modelConfig = KPI_kpiConfig.config_for(kpiName, globalConfig)
+    start = time.perf_counter()
+    db = KPI_db.get_database("aiops")
+    result = {"kpi": kpiName, "rows": 0, "written": 0, "seconds": 0.0, "status": "ok"}
+    if not KPI_modelCache.has_model(kpiName, modelConfig):
+        result["status"] = "no model"
+        return result
+    bounds = id_range(db, kpiName, options.get("fromId"), options.get("toId"),
+                      options.get("fromTime"), options.get("toTime"))
+    if bounds is None:
+        result["status"] = "empty"
+        return result
+    firstId, lastId = bounds
+    if options.get("onlyNull"):
+        # 只写空值时从范围内第一个空值开始读（之前的行只作为窗口读取）
+        value = db.query_one("SELECT MIN(`id`) FROM " + KPI_db.table(kpiName) +
+                             " WHERE `predict` IS NULL AND `id` >= %s AND `id` <= %s", (firstId, lastId))
+        if value is None or value[0] is None:
+            result["status"] = "empty"
+            return result
+        firstId = int(value[0])
+
+    # 断点：范围、是否只写空值、特征参数和模型文件都相同时才继续
+    modelPath = KPI_modelCache.model_path(kpiName, modelConfig)
+    left = modelConfig["STA_windowSize_left"]
+    right = modelConfig["STA_windowSize_right"]
+    fws = modelConfig["STA_fws"]
+    key = {"range": [firstId, lastId], "onlyNull": options.get("onlyNull", False),
+           "window": [left, right, fws, history_num(modelConfig)], "modelMtime": os.path.getmtime(modelPath)}
+    checkpoint = {} if options.get("restart") else read_checkpoint(kpiName, modelConfig)
+    afterId = firstId - 1
+    if checkpoint.get("key") == key:
+        if checkpoint.get("done"):
+            result["status"] = "done"
+            return result
+        afterId = checkpoint["lastId"]
+        print(kpiName + ": 从断点 id " + str(afterId) + " 之后继续")
+    checkpoint = {"key": key, "lastId": afterId, "done": False}
+
+    # 第一个点之前的 historyNum 行作为窗口；不足时说明已到表头，前 historyNum 行不打分
+    historyNum = history_num(modelConfig)
+    contextIds, contextValues = read_context(db, kpiName, afterId, historyNum)
+    stream = KPI_feature.StreamingWindowFeatures(left, right, fws, contextValues, 0, historyNum)
+    idTail = contextIds
+    nullTail = np.zeros(len(contextIds), dtype=bool)
+    idOffset = 0
+
+    progress = Progress(kpiName, lastId - firstId + 1)
+    batchSize = options.get("batchSize", 65536)
+    onlyNull = options.get("onlyNull", False)
+    pendingIds = []
+    pendingFeatures = []
+    pendingRows = [0]
+    processedId = [afterId]
+
+    def flush(force=False):
+        ids = np.concatenate(pendingIds) if len(pendingIds) > 0 else np.empty(0, dtype=np.int64)
+        written = 0
+        if len(ids) > 0:
+            scores = KPI_predict.kpi_predict_batch(kpiName, np.concatenate(pendingFeatures), modelConfig)
+            written = db.update_by_id(kpiName, "predict",
+                                      [(int(rowId), float(score)) for rowId, score in zip(ids, scores)])
+        del pendingIds[:]
+        del pendingFeatures[:]
+        # 写回后再记断点：断点之前的点都已处理
+        checkpoint["lastId"] = processedId[0]
+        write_checkpoint(kpiName, modelConfig, checkpoint)
+        progress.add(pendingRows[0], written, processedId[0], firstId, force)
+        pendingRows[0] = 0
+        return written
+
+    for ids, values, nulls in iter_rows(db, kpiName, afterId, read_upper(db, kpiName, lastId, right),
+                                        options.get("chunkSize", 50000)):
+        positions, features = stream.push(values)
+        idBuffer = np.concatenate((idTail, ids))
+        nullBuffer = np.concatenate((nullTail, nulls))
+        local = positions - idOffset
+        rowIds = idBuffer[local]
+        # 右窗口多读的行只提供数据，不打分
+        inRange = rowIds <= lastId
+        keep = inRange & (rowIds > afterId)
+        if onlyNull:
+            keep &= nullBuffer[local]
+        if inRange.any():
+            processedId[0] = int(rowIds[inRange][-1])
+        pendingIds.append(rowIds[keep])
+        pendingFeatures.append(features[keep])
+        pendingRows[0] += int(np.count_nonzero(keep))
+        result["rows"] += len(ids)
+        # 只保留下一个点的窗口需要的行（与 stream 的 tail 对齐）
+        idTail = idBuffer[stream.offset - idOffset:]
+        nullTail = nullBuffer[stream.offset - idOffset:]
+        idOffset = stream.offset
+        if sum(len(part) for part in pendingIds) >= batchSize:
+            result["written"] += flush()
+    result["written"] += flush(force=True)
+    checkpoint["lastId"] = lastId
+    checkpoint["done"] = True
+    write_checkpoint(kpiName, modelConfig, checkpoint)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run_task(kpiName, options):
+    # 子进程入口；一个 KPI 出错不影响其他 KPI
+    try:
+        return backfill_kpi(kpiName, options)
+    except Exception as e:
+        return {"kpi": kpiName, "rows": 0, "written": 0, "seconds": 0.0, "status": "failed: " + str(e)}
+
+
+def kpi_names(names):
+    if names != ["all"]:
+        return names
+    return [name for name in KPI_db.get_database("aiops").list_tables()
+            if name.startswith("kpi_") and name not in tableIgnoreList]
+
+
+def run(names, options, workers=1):
+    # workers 为 1 时在本进程中逐个处理，否则每个 KPI 交给 spawn 子进程
+    start = time.perf_counter()
+    results = []
+    if workers <= 1:
+        for kpiName in names:
+            results.append(run_task(kpiName, options))
+            print(kpiName + ": " + results[-1]["status"])
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+            futures = [executor.submit(run_task, kpiName, options) for kpiName in names]
+            for future in as_completed(futures):
+                results.append(future.result())
+                print(results[-1]["kpi"] + ": " + results[-1]["status"])
+    seconds = time.perf_counter() - start
+    rows = sum(result["rows"] for result in results)
+    written = sum(result["written"] for result in results)
+    print("完成 %d 个 KPI，读取 %d 行，写回 %d 行，%.1f 秒，%.0f 行/秒" % (len(results), rows, written, seconds,
+                                                           rows / max(seconds, 1e-9)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="离线重算历史预测")
+    parser.add_argument("kpis", nargs="+", help="KPI 表名，或 all")
+    parser.add_argument("--from-id", type=int)
+    parser.add_argument("--to-id", type=int)
+    parser.add_argument("--from-time", help="按 time 列筛选，例如 \"2020-01-01 00:00:00\"")
+    parser.add_argument("--to-time")
+    parser.add_argument("--only-null", action="store_true", help="只写回 predict 为空的点")
+    parser.add_argument("--workers", type=int, default=KPI_config.trainWorkers, help="同时处理的 KPI 数（子进程数）")
+    parser.add_argument("--chunk-size", type=int, default=KPI_config.historyChunkSize, help="每次读取的行数")
+    parser.add_argument("--batch-size", type=int, default=65536, help="每次打分并写回的点数")
+    parser.add_argument("--restart", action="store_true", help="忽略断点，从头开始")
+    parser.add_argument("--sqlite", help="用这个 SQLite 文件代替 MySQL（本地测试）")
+    args = parser.parse_args()
+    if args.sqlite:
+        # 环境变量让子进程也使用同一个替身库
+        os.environ["KPI_SQLITE"] = args.sqlite
+        KPI_config.sqlitePath = args.sqlite
+    options = {"fromId": args.from_id, "toId": args.to_id, "fromTime": args.from_time, "toTime": args.to_time,
+               "onlyNull": args.only_null, "chunkSize": args.chunk_size, "batchSize": args.batch_size,
+               "restart": args.restart}
+    results = run(kpi_names(args.kpis), options, args.workers)
+    sys.exit(0 if all(result["status"] in ("ok", "done", "no model", "empty") for result in results) else 1)
@@ -0,0 +1,471 @@
+# 性能基准：用合成的 KPI 数据和进程内 SQLite 替身库运行，不依赖线上 MySQL
+# 结果以 JSON 输出（stdout 或 --output），--compare 与上一次的结果对比耗时
+# 用法：python KPI_benchmark.py all --output result.json
+#       python KPI_benchmark.py tick --tables 20 --compare result.json
+#       python KPI_benchmark.py threshold --rows 100000
+#       python KPI_benchmark.py sweep --rows 200000
+#       python KPI_benchmark.py startup
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import KPI_discovery
+import KPI_feature
+import KPI_metrics
+import KPI_npModel
+import KPI_threshold
+
+
+def legacy_best_threshold(predicted, train_y, step=0.02):
+    # 原 kpi_train_model 中 testTC 的逐点循环，作为对照
+    def testTC(tc):
+        true1num = 0
+        false1num = 0
+        ytrue1num = 0
+        for i in range(len(predicted)):
+            if predicted[i][0] > tc:
+                if train_y[i] == 1:
+                    true1num = true1num + 1
+                    ytrue1num = ytrue1num + 1
+                else:
+                    false1num = false1num + 1
+            else:
+                if train_y[i] == 1:
+                    ytrue1num = ytrue1num + 1
+        myscore = 1
+        if ytrue1num != 0:
+            myscore = (true1num / (ytrue1num)) - (false1num / (ytrue1num))
+        return myscore
+
+    startTC = 0
+    maxScore = 0
+    genTc = startTC
+    for i in range(1, int((1 - startTC) / step)):
+        tpScore = testTC(startTC + i * step)
+        if tpScore > maxScore:
+            maxScore = tpScore
+            genTc = startTC + i * step
+    return genTc, maxScore
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def synthetic_kpi(rows, period=1440, amplitude=20.0, noise=3.0, anomalyRate=0.01, seed=0,
+                  start="2020-01-01T00:00"):
+    # 合成一张 KPI 表：每分钟一个点，周期为 period 的正弦季节性加噪声，
+    # 按 anomalyRate 随机注入尖峰并标为异常；返回 {'id', 'time', 'value', 'label'}
+    rng = np.random.default_rng(seed)
+    index = np.arange(rows)
+    value = 100.0 + amplitude * np.sin(2 * np.pi * index / period) + rng.normal(0, noise, rows)
+    label = (rng.random(rows) < anomalyRate).astype(np.float64)
+    spikes = rng.choice([-1.0, 1.0], rows) * rng.uniform(6, 10, rows) * noise
+    value = value + label * spikes
+    return {
+        'id': index.astype(np.int64) + 1,
+        'time': np.datetime64(start, "us") + index.astype("timedelta64[m]"),
+        'value': value,
+        'label': label,
+    }
+
+
+def synthetic_chunks(kpi, chunkSize):
+    # 与 iterHistoryChunks 相同格式的分块数据
+    for start in range(0, len(kpi['id']), chunkSize):
+        yield dict((name, column[start:start + chunkSize]) for name, column in kpi.items())
+
+
+def standin_database(tableNames, kpis, pendingRows):
+    # 建一个 SQLite 替身库并注册为默认库和 aiops 库；每张表最后 pendingRows 行的 predict 为空（待预测）
+    import KPI_db
+    db = KPI_db.sqlite_database()
+    for tableName, kpi in zip(tableNames, kpis):
+        db.execute("CREATE TABLE " + KPI_db.table(tableName) +
+                   " (id INTEGER PRIMARY KEY, value REAL, time TEXT, predict REAL)")
+        insert_rows(db, tableName, kpi, len(kpi['id']) - pendingRows)
+    KPI_db.set_database(db)
+    KPI_db.set_database(db, "aiops")
+    return db
+
+
+def insert_rows(db, tableName, kpi, labeledRows):
+    import KPI_db
+    rows = []
+    for i in range(len(kpi['id'])):
+        label = float(kpi['label'][i]) if i < labeledRows else None
+        rows.append((int(kpi['id'][i]), float(kpi['value'][i]), str(kpi['time'][i]).replace("T", " "), label))
+    db.executemany("INSERT INTO " + KPI_db.table(tableName) + " (id, value, time, predict) VALUES (%s, %s, %s, %s)",
+                   rows)
+
+
+def bench_config(saveDirs):
+    import KPI_config
+    modelConfig = dict(KPI_config.modelConfig)
+    modelConfig["saveDirs"] = saveDirs
+    modelConfig["plotMode"] = "off"
+    return modelConfig
+
+
+def stage_totals():
+    # 按阶段汇总 KPI_metrics 中记录的耗时
+    totals = {}
+    for (name, labels), (count, seconds) in KPI_metrics.snapshot_timers().items():
+        stage = dict(labels).get("stage")
+        if name != "stage_seconds" or stage is None:
+            continue
+        if stage not in totals:
+            totals[stage] = {"count": 0, "seconds": 0.0}
+        totals[stage]["count"] += count
+        totals[stage]["seconds"] += seconds
+    return totals
+
+
+def synthetic_scores(rows, anomalyRate=0.02, seed=0):
+    # 模拟模型输出：异常点得分偏高
+    rng = np.random.default_rng(seed)
+    labels = (rng.random(rows) < anomalyRate).astype(np.float32).reshape(-1, 1)
+    predicted = np.clip(rng.normal(0.2, 0.15, rows) + labels[:, 0] * 0.5, 0, 1).astype(np.float32).reshape(-1, 1)
+    return predicted, labels
+
+
+def bench_threshold(args):
+    rows = args.rows
+    legacy = not args.no_legacy
+    predicted, labels = synthetic_scores(rows)
+    result = {"rows": rows}
+    (tc, score), seconds = timed(KPI_threshold.best_threshold, predicted, labels, 0.02)
+    result["vectorized"] = {"seconds": seconds, "threshold": tc, "score": score}
+    (tc, score), seconds = timed(KPI_threshold.best_threshold, predicted, labels, 0)
+    result["exact"] = {"seconds": seconds, "threshold": tc, "score": score}
+    if legacy:
+        (tc, score), seconds = timed(legacy_best_threshold, predicted, labels, 0.02)
+        result["legacy"] = {"seconds": seconds, "threshold": tc, "score": score}
+        result["speedup"] = result["legacy"]["seconds"] / result["vectorized"]["seconds"]
+    return result
+
+
+# 在子进程中导入模块，测量导入耗时、峰值内存以及加载了哪些重量级框架
+startupCode = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+try:
+    import resource
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        maxRss = maxRss // 1024
+except ImportError:
+    maxRss = None
+heavy = ["tensorflow", "keras", "matplotlib", "sklearn", "pandas"]
+print(json.dumps({{"seconds": seconds, "maxRssKB": maxRss,
+                  "loaded": [name for name in heavy if name in sys.modules]}}))
+"""
+
+
+def bench_startup(args):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    result = {}
+    for module in args.modules.split(","):
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.check_output([sys.executable, "-c", startupCode.format(module=module)], cwd=directory)
+            runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+        result[module] = {
+            "seconds": min(run["seconds"] for run in runs),
+            "maxRssKB": runs[0]["maxRssKB"],
+            "loaded": runs[0]["loaded"],
+        }
+    return result
+
+
+def legacy_features(values, left, right, fws):
+    # 原 kpi_train_model 中逐行计算窗口特征的循环，作为对照
+    features = []
+    for i in range(left, len(values)):
+        window = values[i - left:i + right]
+        if len(window) < left + right:
+            break
+        features.append([np.std(window) * np.std(window), np.mean(window), np.percentile(window, fws)])
+    return np.array(features)
+
+
+def bench_features(args):
+    import KPI_config
+    left = KPI_config.modelConfig["STA_windowSize_left"]
+    right = KPI_config.modelConfig["STA_windowSize_right"]
+    fws = KPI_config.modelConfig["STA_fws"]
+    kpi = synthetic_kpi(args.rows, args.period, anomalyRate=args.anomaly_rate, seed=args.seed)
+    result = {"rows": args.rows, "left": left, "right": right, "fws": fws}
+    (positions, features), seconds = timed(KPI_feature.window_features, kpi['value'], left, right, fws)
+    result["vectorized"] = {"seconds": seconds}
+
+    def streaming():
+        stream = KPI_feature.StreamingWindowFeatures(left, right, fws)
+        return [stream.push(chunk['value']) for chunk in synthetic_chunks(kpi, args.chunk_size)]
+    _, seconds = timed(streaming)
+    result["streaming"] = {"seconds": seconds, "chunkSize": args.chunk_size}
+    if not args.no_legacy:
+        expected, seconds = timed(legacy_features, kpi['value'], left, right, fws)
+        result["legacy"] = {"seconds": seconds}
+        result["speedup"] = result["legacy"]["seconds"] / result["vectorized"]["seconds"]
+        result["maxAbsDiff"] = float(np.abs(features - expected).max()) if len(features) else 0.0
+    return result
+
+
+def bench_sweep(args):
+    # 参数搜索的特征计算：多组窗口 / 分位数一次计算（共用前缀和与有序窗口），对比逐组调用 window_features
+    kpi = synthetic_kpi(args.rows, args.period, anomalyRate=args.anomaly_rate, seed=args.seed)
+    candidates = [(left, right, fws) for left in parse_ints(args.sweep_lefts) for right in parse_ints(args.sweep_rights)
+                  for fws in [float(fws) for fws in args.sweep_fws.split(",")] if left + right > 0]
+    result = {"rows": args.rows, "candidates": len(candidates)}
+    combined, seconds = timed(KPI_feature.multi_window_features, kpi['value'], candidates)
+    result["combined"] = {"seconds": seconds}
+
+    def separate():
+        return dict((candidate, KPI_feature.window_features(kpi['value'], *candidate)) for candidate in candidates)
+    expected, seconds = timed(separate)
+    result["separate"] = {"seconds": seconds}
+    result["speedup"] = result["separate"]["seconds"] / result["combined"]["seconds"]
+    result["maxRelDiff"] = max(float((np.abs(combined[c][1] - expected[c][1]) /
+                                      np.maximum(np.abs(expected[c][1]), 1)).max()) if len(expected[c][1]) else 0.0
+                               for c in candidates)
+    return result
+
+
+def parse_ints(text):
+    return [int(item) for item in text.split(",") if item.strip() != ""]
+
+
+def bench_train(args):
+    try:
+        import keras
+    except ImportError as e:
+        return {"skipped": str(e)}
+    import KPI_modelTrain
+    saveDirs = tempfile.mkdtemp(prefix="kpi_bench_")
+    try:
+        modelConfig = bench_config(saveDirs)
+        modelConfig["max_epochs"] = args.epochs
+        kpi = synthetic_kpi(args.rows, args.period, anomalyRate=args.anomaly_rate, seed=args.seed)
+        KPI_metrics.reset()
+        _, seconds = timed(KPI_modelTrain.kpi_train_model, "kpi_bench", synthetic_chunks(kpi, args.chunk_size),
+                           modelConfig)
+        return {"rows": args.rows, "epochs": args.epochs, "seconds": seconds, "stages": stage_totals()}
+    finally:
+        shutil.rmtree(saveDirs, ignore_errors=True)
+
+
+def random_dense_model(seed=0):
+    # 与 kpi_train_model 相同的结构：3 -> 128 -> 128 -> 1
+    rng = np.random.default_rng(seed)
+    shapes = [(3, 128), (128, 128), (128, 1)]
+    return KPI_npModel.NumpyModel([rng.normal(0, 0.1, shape) for shape in shapes],
+                                  [rng.normal(0, 0.1, shape[1]) for shape in shapes],
+                                  ["relu", "relu", "sigmoid"])
+
+
+def bench_inference(args):
+    numpyModel = random_dense_model()
+    features = np.random.default_rng(1).normal(0, 1, (args.rows, 3)).astype(np.float32)
+    result = {"rows": args.rows}
+    _, seconds = timed(numpyModel.predict, features)
+    result["numpy"] = {"seconds": seconds, "usPerRow": seconds / args.rows * 1e6}
+    single = min(timed(numpyModel.predict, features[:1])[1] for _ in range(100))
+    result["numpySingleRow"] = {"seconds": single}
+    try:
+        import keras as K
+    except ImportError:
+        return result
+    model = K.models.Sequential()
+    model.add(K.layers.Dense(units=128, input_dim=3, activation='relu'))
+    model.add(K.layers.Dense(units=128, activation='relu'))
+    model.add(K.layers.Dense(units=1, activation='sigmoid'))
+    model.set_weights([w for pair in zip(numpyModel.kernels, numpyModel.biases) for w in pair])
+    model.predict(features[:1], verbose=0)
+    expected, seconds = timed(model.predict, features, batch_size=min(args.rows, 8192), verbose=0)
+    result["keras"] = {"seconds": seconds, "usPerRow": seconds / args.rows * 1e6}
+    result["kerasSingleRow"] = {"seconds": min(timed(model.predict, features[:1], verbose=0)[1] for _ in range(10))}
+    result["maxAbsDiff"] = float(np.abs(numpyModel.predict(features) - expected).max())
+    return result
+
+
+def bench_predict(args):
+    # 经 KPI_predict 的单点预测（kpi_predict）与批量预测（kpi_predict_batch / kpi_predict_many）
+    import KPI_predict
+    saveDirs = tempfile.mkdtemp(prefix="kpi_bench_")
+    try:
+        modelConfig = bench_config(saveDirs)
+        kpiNames = ["kpi_bench_" + str(i) for i in range(args.tables)]
+        for i, kpiName in enumerate(kpiNames):
+            os.makedirs(os.path.join(saveDirs, kpiName))
+            KPI_npModel.save(random_dense_model(i), os.path.join(saveDirs, kpiName, "model.npz"))
+        kpi = synthetic_kpi(args.rows, args.period, anomalyRate=args.anomaly_rate, seed=args.seed)
+        left = modelConfig["STA_windowSize_left"]
+        right = modelConfig["STA_windowSize_right"]
+        _, features = KPI_feature.window_features(kpi['value'], left, right, modelConfig["STA_fws"])
+        result = {"rows": len(features), "tables": args.tables}
+
+        KPI_predict.kpi_predict(kpiNames[0], kpi['value'][:left + right], modelConfig)  # 预热模型缓存
+        singleRows = min(len(features), 1000)
+        start = time.perf_counter()
+        for i in range(singleRows):
+            KPI_predict.kpi_predict(kpiNames[0], kpi['value'][i:i + left + right], modelConfig)
+        seconds = time.perf_counter() - start
+        result["single"] = {"rows": singleRows, "seconds": seconds, "usPerRow": seconds / singleRows * 1e6}
+
+        _, seconds = timed(KPI_predict.kpi_predict_batch, kpiNames[0], features, modelConfig)
+        result["batch"] = {"seconds": seconds, "usPerRow": seconds / len(features) * 1e6}
+
+        kpiList = [kpiNames[i % args.tables] for i in range(len(features))]
+        _, seconds = timed(KPI_predict.kpi_predict_many, kpiList, features, modelConfig)
+        result["many"] = {"seconds": seconds, "usPerRow": seconds / len(features) * 1e6}
+        return result
+    finally:
+        shutil.rmtree(saveDirs, ignore_errors=True)
+
+
+def bench_tick(args):
+    # 完整的调度 tick：SQLite 替身库中 tables 张表，第一次 tick 预热并预测积压的 pending 行，
+    # 之后每张表追加 newRows 行，再测一次增量 tick，最后测一次没有新数据的空闲 tick
+    try:
+        import autoPredictKPI
+    except ImportError as e:
+        return {"skipped": str(e)}
+    # 基准测试不写阶段日志
+    KPI_metrics.configure_log("")
+    saveDirs = tempfile.mkdtemp(prefix="kpi_bench_")
+    oldSaveDirs = autoPredictKPI.modelConfig["saveDirs"]
+    oldMode = autoPredictKPI.tickMode
+    try:
+        autoPredictKPI.modelConfig["saveDirs"] = saveDirs
+        tableNames = ["kpi_bench_" + str(i) for i in range(args.tables)]
+        kpis = [synthetic_kpi(args.table_rows + args.new_rows, args.period, anomalyRate=args.anomaly_rate,
+                              seed=args.seed + i) for i in range(args.tables)]
+        for i, tableName in enumerate(tableNames):
+            os.makedirs(os.path.join(saveDirs, tableName))
+            KPI_npModel.save(random_dense_model(i), os.path.join(saveDirs, tableName, "model.npz"))
+        result = {"tables": args.tables, "tableRows": args.table_rows, "pending": args.pending,
+                  "newRows": args.new_rows}
+        for mode in args.tick_modes.split(","):
+            db = standin_database(tableNames, [dict((name, column[:args.table_rows]) for name, column in kpi.items())
+                                               for kpi in kpis], args.pending)
+            autoPredictKPI.tickMode = mode
+            autoPredictKPI.windowStates.clear()
+            autoPredictKPI.tableDiscovery.invalidate()
+            autoPredictKPI.watermarks = KPI_discovery.Watermarks()
+            KPI_metrics.reset()
+            _, warmUp = timed(autoPredictKPI.runTick)
+            warmUpStages = stage_totals()
+            for tableName, kpi in zip(tableNames, kpis):
+                insert_rows(db, tableName, dict((name, column[args.table_rows:]) for name, column in kpi.items()), 0)
+            KPI_metrics.reset()
+            _, incremental = timed(autoPredictKPI.runTick)
+            incrementalStages = stage_totals()
+            KPI_metrics.reset()
+            _, idle = timed(autoPredictKPI.runTick)
+            result[mode] = {
+                "warmUp": {"seconds": warmUp, "stages": warmUpStages},
+                "incremental": {"seconds": incremental, "stages": incrementalStages},
+                "idle": {"seconds": idle, "stages": stage_totals()},
+            }
+            db.close()
+        return result
+    finally:
+        autoPredictKPI.modelConfig["saveDirs"] = oldSaveDirs
+        autoPredictKPI.tickMode = oldMode
+        autoPredictKPI.windowStates.clear()
+        autoPredictKPI.tableDiscovery.invalidate()
+        autoPredictKPI.watermarks = KPI_discovery.Watermarks()
+        shutil.rmtree(saveDirs, ignore_errors=True)
+
+
+benchmarks = {
+    "features": bench_features,
+    "sweep": bench_sweep,
+    "threshold": bench_threshold,
+    "train": bench_train,
+    "predict": bench_predict,
+    "inference": bench_inference,
+    "tick": bench_tick,
+    "startup": bench_startup,
+}
+
+
+def compare(result, baseline, path=""):
+    # 对两次结果中同一位置的 seconds 求比值（本次 / 上次），大于 1 表示变慢
+    ratios = {}
+    if isinstance(result, dict) and isinstance(baseline, dict):
+        for key in result:
+            if key in baseline:
+                ratios.update(compare(result[key], baseline[key], path + "/" + key if path else key))
+    elif path.endswith("seconds") and isinstance(result, (int, float)) and isinstance(baseline, (int, float)) \
+            and baseline > 0:
+        ratios[path] = result / baseline
+    return ratios
+
+
+def run(names, args):
+    report = {
+        "meta": {
+            "time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": {},
+    }
+    for name in names:
+        # 被测代码的 print 输出到 stderr，stdout 只有 JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            report["results"][name] = benchmarks[name](args)
+    if args.compare:
+        with open(args.compare) as f:
+            report["compare"] = compare(report["results"], json.load(f)["results"])
+    return report
+
+
+if __name__ == '__main__':
+    # 配置文件从当前目录读取
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", choices=sorted(benchmarks) + ["all"])
+    parser.add_argument("--rows", type=int, default=100000, help="合成序列的长度")
+    parser.add_argument("--period", type=int, default=1440, help="季节性周期（点数）")
+    parser.add_argument("--anomaly-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--no-legacy", action="store_true", help="不运行原实现（数据量大时很慢）")
+    parser.add_argument("--epochs", type=int, default=2, help="train：训练轮数")
+    parser.add_argument("--sweep-lefts", default="10,20,40,60", help="sweep：左窗口")
+    parser.add_argument("--sweep-rights", default="0,5", help="sweep：右窗口")
+    parser.add_argument("--sweep-fws", default="0.5,5,50,95", help="sweep：特征分位数")
+    parser.add_argument("--tables", type=int, default=10, help="predict/tick：KPI 表数")
+    parser.add_argument("--table-rows", type=int, default=20000, help="tick：每张表的行数")
+    parser.add_argument("--pending", type=int, default=1000, help="tick：每张表积压的待预测行数")
+    parser.add_argument("--new-rows", type=int, default=10, help="tick：增量 tick 前每张表追加的行数")
+    parser.add_argument("--tick-modes", default="sync,async")
+    parser.add_argument("--modules", default="autoPredictKPI,KPI_predict,KPI_modelTrain", help="startup：要测量的模块")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="结果写入文件")
+    parser.add_argument("--compare", help="上一次的结果文件")
+    args = parser.parse_args()
+    names = sorted(benchmarks) if args.name == "all" else [args.name]
+    text = json.dumps(run(names, args), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
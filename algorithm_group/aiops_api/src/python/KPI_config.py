@@ -0,0 +1,79 @@
+# KPIautoPredictConfig.ini 中的配置，供调度进程和训练/预测子进程共用
+import configparser
+import os
+cf = configparser.ConfigParser()
+cf.read("KPIautoPredictConfig.ini")
+secs = cf.sections()
+# print(secs)
+
+
+
+HOST =cf.get("database", "HOST")
+USERNAME = cf.get("database", "USERNAME")
+PASSWORD = str(cf.get("database", "PASSWORD"))
+
+
+DB_NAME=cf.get("database", "DB_NAME")
+poolSize=int(cf.get("database", "poolSize", fallback=5))  # 连接池大小
+# 不为空时用这个 SQLite 文件代替 MySQL（本地测试）；环境变量 KPI_SQLITE 优先，训练子进程也能继承
+sqlitePath=os.environ.get("KPI_SQLITE", cf.get("database", "sqlitePath", fallback=""))
+PredictKPIList=cf.get("predictconfig", "PredictKPIList")
+modelDir=cf.get("modelconfig", "modelDir")
+
+tableIgnoreList=cf.get("predictconfig", "tableIgnoreList").split(",")
+maxBatchSize=int(cf.get("predictconfig", "maxBatchSize", fallback=1000))  # 每个 KPI 每次最多预测的点数
+tickMode=cf.get("predictconfig", "tickMode", fallback="async")  # async：各 KPI 并发读写；sync：逐个处理
+tickConcurrency=int(cf.get("predictconfig", "tickConcurrency", fallback=poolSize))  # async 模式下同时处理的 KPI 数
+tableRefreshInterval=int(cf.get("predictconfig", "tableRefreshInterval", fallback=300))  # 表名列表缓存的秒数
+changeTracking=cf.getboolean("predictconfig", "changeTracking", fallback=True)  # 只访问 MAX(id) 有变化的表
+shardIndex=int(cf.get("shard", "shardIndex", fallback=0))  # 本进程的分片编号（从 0 开始）
+shardCount=int(cf.get("shard", "shardCount", fallback=1))  # 预测进程（分片）总数，1 为不分片
+shardVnodes=int(cf.get("shard", "shardVnodes", fallback=64))  # 一致性哈希环上每个分片的虚拟节点数
+leaseEnabled=cf.getboolean("shard", "leaseEnabled", fallback=False)  # 用数据库中的租约表防止两个进程预测同一个 KPI
+leaseTtl=int(cf.get("shard", "leaseTtl", fallback=60))  # 租约有效期（秒），应远大于预测间隔
+leaseTable=cf.get("shard", "leaseTable", fallback="predict_lease")  # 租约表名，不能以 kpi_ 开头
+fallbackEnabled=cf.getboolean("predictconfig", "fallbackEnabled", fallback=True)  # 还没有模型的 KPI 用在线检测器打分
+historyChunkSize=int(cf.get("trainconfig", "historyChunkSize", fallback=50000))  # 读取历史数据时每块的行数
+
+trainWorkers=int(cf.get("trainconfig", "trainWorkers", fallback=2))  # 同时训练的 KPI 数（子进程数）
+trainThreads=int(cf.get("trainconfig", "trainThreads", fallback=1))  # 每个训练子进程的 TensorFlow 线程数
+trainTimeout=int(cf.get("trainconfig", "trainTimeout", fallback=7200))  # 单个 KPI 训练超时（秒）
+plotWorkers=int(cf.get("trainconfig", "plotWorkers", fallback=1))  # plotMode=deferred 时同时绘图的子进程数
+
+metricsPort=int(cf.get("metrics", "metricsPort", fallback=0))  # Prometheus 指标端口，0 为不启动
+metricsHost=cf.get("metrics", "metricsHost", fallback="127.0.0.1")
+metricsLog=cf.get("metrics", "metricsLog", fallback="")  # 每行一个 JSON 的阶段日志，为空时不写
+
+modelConfig = {
+    "minTrainNum":int(cf.get("modelconfig", "minTrainNum")),
+    "minPredictNum":int(cf.get("modelconfig", "minPredictNum")),
+    "saveDirs": cf.get("modelconfig", "saveDirs"),
+    "uu": int(cf.get("modelconfig", "uu")),  # 起始位置
+    "hRate":float(cf.get("modelconfig", "hRate") )  ,  # 历史数据集大小
+    "nRate": float(cf.get("modelconfig", "nRate") ),  # 实时数据集大小（用于检验
+
+    "traintestRate": float(cf.get("modelconfig", "traintestRate") ),  # 划分train test比例
+    "max_epochs": int(cf.get("modelconfig", "max_epochs")),  # 训练次数
+    "b_size": 0 if cf.get("modelconfig", "b_size") == "auto" else int(cf.get("modelconfig", "b_size")),  # batch_size每批数量，auto(0) 为按数据量选择
+    "earlyStoppingPatience": int(cf.get("modelconfig", "earlyStoppingPatience", fallback=3)),  # 验证集 loss 连续多少轮不下降就停止，0 为不提前停止
+    "warmStart": cf.getboolean("modelconfig", "warmStart", fallback=True),  # 在上次的 model.h5 上继续训练新增的数据
+    "replayRate": float(cf.get("modelconfig", "replayRate", fallback=1.0)),  # 继续训练时混入的旧数据量（相对新增数据）
+    "warmStartMaxNewRate": float(cf.get("modelconfig", "warmStartMaxNewRate", fallback=1.0)),  # 新增数据超过已训练数据的这个比例时重新训练
+
+    "STA_windowSize_left": int(cf.get("modelconfig", "STA_windowSize_left")),  # 特征提取窗口大小
+    "STA_windowSize_right": int(cf.get("modelconfig", "STA_windowSize_right")),
+    "STA_fws": float(cf.get("modelconfig", "STA_fws") ),  # 特征提取分位数
+
+    "thresholdStep": float(cf.get("modelconfig", "thresholdStep", fallback=0.02)),  # 阈值搜索步长，0 为精确搜索
+
+    "plotMode": cf.get("modelconfig", "plotMode", fallback="inline"),  # 诊断图：off / inline（训练进程中绘制）/ deferred（训练结束后由调度进程绘制）
+    "plotChipSize": int(cf.get("modelconfig", "plotChipSize", fallback=3000)),  # 原始数据图每张的点数
+    "plotMaxPoints": int(cf.get("modelconfig", "plotMaxPoints", fallback=4000)),  # 每条曲线最多绘制的点数
+
+    "modelMode": cf.get("modelconfig", "modelMode", fallback="perKpi"),  # perKpi：每个 KPI 一个模型；grouped：每类 KPI 一个模型
+    "groupEmbeddingDim": int(cf.get("modelconfig", "groupEmbeddingDim", fallback=8)),  # 分组模型中 KPI 编号的 embedding 维数
+
+    "modelCacheSize": int(cf.get("modelconfig", "modelCacheSize", fallback=64)),  # 内存中最多缓存的模型数
+    "fallbackZMin": float(cf.get("modelconfig", "fallbackZMin", fallback=3.0)),  # 在线检测器的最小 |z| 阈值
+
+}
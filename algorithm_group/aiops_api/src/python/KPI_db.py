@@ -0,0 +1,277 @@
+# 数据库访问层：有界连接池、参数化语句（统一使用 %s 占位符）、显式事务
+# 除 MySQL 外也可以接 SQLite，作为本地测试 / 基准测试用的替身数据库
+import contextlib
+import logging
+import queue
+import re
+import threading
+import time
+import uuid
+
+import KPI_config
+
+logger = logging.getLogger("KPI_db")
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+# MySQL 死锁（1213）和锁等待超时（1205）时事务已被回滚，可以整体重试
+retryableErrnos = (1213, 1205)
+# 一条批量 UPDATE 最多更新的行数（每行 3 个参数，远低于 MySQL 的 65535 个占位符上限）
+updateChunkRows = 1000
+
+
+def is_retryable(error):
+    if getattr(error, "errno", None) in retryableErrnos:
+        return True
+    # SQLite 替身库：其他连接持有写锁
+    return error.__class__.__name__ == "OperationalError" and "locked" in str(error)
+
+
+class Database(object):
+
+    def __init__(self, connect, poolSize=5, dialect="mysql", timeout=30, check=None):
+        self.connect = connect  # 无参函数，返回一个新连接
+        self.poolSize = poolSize
+        self.dialect = dialect
+        self.timeout = timeout
+        self.check = check  # 从池中取出连接时调用，用于断线重连
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(poolSize)
+
+    def sql(self, SQLstr):
+        if self.dialect == "sqlite":
+            return SQLstr.replace("%s", "?")
+        return SQLstr
+
+    def acquire(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+        if self.check is not None:
+            try:
+                self.check(conn)
+            except Exception:
+                close_quietly(conn)
+                return self.connect()
+        return conn
+
+    def run(self, cursor, SQLstr, params):
+        if params is None:
+            cursor.execute(self.sql(SQLstr))
+        else:
+            cursor.execute(self.sql(SQLstr), params)
+
+    @contextlib.contextmanager
+    def connection(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolExhaustedError("no free connection after %s seconds" % self.timeout)
+        try:
+            conn = self.acquire()
+            try:
+                yield conn
+            except BaseException:
+                # 出错的连接回滚后再放回；回滚也失败就记录日志并丢弃连接，抛出的仍是原来的异常
+                try:
+                    conn.rollback()
+                except Exception:
+                    logger.warning("rollback failed, connection discarded", exc_info=True)
+                    close_quietly(conn)
+                else:
+                    self.idle.put(conn)
+                raise
+            self.idle.put(conn)
+        finally:
+            self.slots.release()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # with db.transaction() as cursor: ... 正常结束时提交，异常时回滚
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                conn.commit()
+            finally:
+                cursor.close()
+
+    def query(self, SQLstr, params=None):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self.run(cursor, SQLstr, params)
+                values = cursor.fetchall()
+            finally:
+                cursor.close()
+            # 结束只读事务，避免下次取出时读到旧快照
+            conn.rollback()
+        return values
+
+    def query_one(self, SQLstr, params=None):
+        values = self.query(SQLstr, params)
+        if len(values) == 0:
+            return None
+        return values[0]
+
+    def execute(self, SQLstr, params=None):
+        with self.transaction() as cursor:
+            self.run(cursor, SQLstr, params)
+            return cursor.rowcount
+
+    def executemany(self, SQLstr, paramsList):
+        with self.transaction() as cursor:
+            cursor.executemany(self.sql(SQLstr), paramsList)
+            return cursor.rowcount
+
+    def run_transaction(self, work, retries=3, backoff=0.1):
+        # work(cursor) 在一个事务中执行；死锁或锁等待超时时回滚并整体重试（指数退避）
+        for attempt in range(retries + 1):
+            try:
+                with self.transaction() as cursor:
+                    return work(cursor)
+            except Exception as e:
+                if attempt == retries or not is_retryable(e):
+                    raise
+                time.sleep(backoff * (2 ** attempt))
+
+    def update_by_id(self, tableName, columnName, idValueList, retries=3):
+        # 批量写回：每 updateChunkRows 行一条
+        #   UPDATE t SET c = CASE id WHEN %s THEN %s ... END WHERE id IN (%s, ...)
+        # 所有语句在同一个事务中执行，返回更新的行数；同一个 id 出现多次时以最后一次为准
+        values = {}
+        for rowId, value in idValueList:
+            values[rowId] = value
+        items = list(values.items())
+        target = table(tableName)
+        col = column(columnName)
+
+        def work(cursor):
+            updated = 0
+            for start in range(0, len(items), updateChunkRows):
+                chunk = items[start:start + updateChunkRows]
+                SQLstr = "UPDATE " + target + " SET " + col + " = CASE `id`" + \
+                         " WHEN %s THEN %s" * len(chunk) + \
+                         " END WHERE `id` IN (" + ", ".join(["%s"] * len(chunk)) + ")"
+                params = [param for item in chunk for param in item] + [rowId for rowId, _ in chunk]
+                self.run(cursor, SQLstr, params)
+                updated += cursor.rowcount
+            return updated
+
+        if len(items) == 0:
+            return 0
+        return self.run_transaction(work, retries)
+
+    def insert_rows(self, tableName, columns, rows, retries=3):
+        # 批量插入（同一个事务，死锁时重试），返回插入的行数
+        SQLstr = "INSERT INTO " + table(tableName) + " (" + ", ".join(column(name) for name in columns) + \
+                 ") VALUES (" + ", ".join(["%s"] * len(columns)) + ")"
+
+        def work(cursor):
+            cursor.executemany(self.sql(SQLstr), rows)
+            return cursor.rowcount
+
+        if len(rows) == 0:
+            return 0
+        return self.run_transaction(work, retries)
+
+    def list_tables(self):
+        if self.dialect == "sqlite":
+            values = self.query("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+        else:
+            values = self.query("SHOW TABLES")
+        return [row[0] for row in values]
+
+    def close(self):
+        while True:
+            try:
+                close_quietly(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+tableNamePattern = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+def table(tableName):
+    # 表名不能作为参数绑定，只允许字母数字下划线并加反引号（MySQL 与 SQLite 均支持）
+    if not tableNamePattern.match(tableName):
+        raise ValueError("invalid table name: %r" % (tableName,))
+    return "`" + tableName + "`"
+
+
+def column(columnName):
+    # 列名同样只允许字母数字下划线
+    return table(columnName)
+
+
+def mysql_database(db_name=None, poolSize=None):
+    import mysql.connector
+
+    if db_name is None:
+        db_name = KPI_config.DB_NAME
+    if poolSize is None:
+        poolSize = KPI_config.poolSize
+
+    def connect():
+        return mysql.connector.connect(host=KPI_config.HOST,
+                                       user=KPI_config.USERNAME,
+                                       password=KPI_config.PASSWORD,
+                                       database=db_name)
+
+    def check(conn):
+        conn.ping(reconnect=True, attempts=1, delay=0)
+
+    return Database(connect, poolSize=poolSize, dialect="mysql", check=check)
+
+
+def sqlite_database(path=":memory:", poolSize=5):
+    import sqlite3
+
+    if path == ":memory:":
+        # 多个连接共享同一个内存库；keeper 连接保证库在 Database 存活期间不被释放
+        path = "file:kpi_standin_" + uuid.uuid4().hex + "?mode=memory&cache=shared"
+    elif not path.startswith("file:"):
+        path = "file:" + path
+
+    def connect():
+        conn = sqlite3.connect(path, uri=True, timeout=30, check_same_thread=False)
+        return conn
+
+    db = Database(connect, poolSize=poolSize, dialect="sqlite")
+    db.keeper = connect()
+    return db
+
+
+databases = {}
+databasesLock = threading.Lock()
+
+
+def get_database(db_name=None):
+    # 每个库一个进程内共享的连接池
+    if db_name is None:
+        db_name = KPI_config.DB_NAME
+    with databasesLock:
+        if db_name not in databases:
+            if KPI_config.sqlitePath:
+                databases[db_name] = sqlite_database(KPI_config.sqlitePath, KPI_config.poolSize)
+            else:
+                databases[db_name] = mysql_database(db_name)
+        return databases[db_name]
+
+
+def set_database(db, db_name=None):
+    # 替换为其他实现（例如 sqlite_database() 替身库）
+    if db_name is None:
+        db_name = KPI_config.DB_NAME
+    with databasesLock:
+        databases[db_name] = db
@@ -0,0 +1,81 @@
+# KPI 表的发现与变化跟踪：
+# - 表名列表缓存 refreshInterval 秒，不在每次 tick 都 SHOW TABLES
+# - 每次 tick 用一条 UNION ALL 查询取各表的 MAX(id)（主键，开销很小），与上次处理到的 id（水位）比较，
+#   只访问有新数据（或上次没处理完、处理失败）的表
+import threading
+import time
+
+import KPI_db
+
+# 一条 UNION ALL 查询最多包含的表数
+unionTables = 200
+
+
+class TableDiscovery(object):
+
+    def __init__(self, db_name=None, prefix="kpi_", refreshInterval=300, clock=time.monotonic):
+        self.db_name = db_name
+        self.prefix = prefix
+        self.refreshInterval = refreshInterval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.cached = None
+        self.loadedAt = None
+
+    def tables(self, refresh=False):
+        with self.lock:
+            expired = self.loadedAt is None or self.clock() - self.loadedAt >= self.refreshInterval
+            if refresh or expired or self.cached is None:
+                names = KPI_db.get_database(self.db_name).list_tables()
+                self.cached = [name for name in names if name.startswith(self.prefix)]
+                self.loadedAt = self.clock()
+            return list(self.cached)
+
+    def invalidate(self):
+        with self.lock:
+            self.loadedAt = None
+
+
+def max_ids(db, tableNames):
+    # 返回 {表名: MAX(id)}，空表为 None
+    result = {}
+    for start in range(0, len(tableNames), unionTables):
+        chunk = tableNames[start:start + unionTables]
+        SQLstr = " UNION ALL ".join("SELECT %s, MAX(id) FROM " + KPI_db.table(name) for name in chunk)
+        for name, maxId in db.query(SQLstr, tuple(chunk)):
+            result[name] = maxId
+    return result
+
+
+class Watermarks(object):
+    # 每张表已经处理到的 id；没有记录的表下次一定访问
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handled = {}
+        self.latest = {}
+
+    def changed(self, maxIds):
+        # 记下各表最新的 MAX(id)，返回需要访问的表（保持 maxIds 的顺序）
+        with self.lock:
+            self.latest = dict(maxIds)
+            for name in list(self.handled):
+                if name not in maxIds:
+                    del self.handled[name]
+            return [name for name, maxId in maxIds.items()
+                    if maxId is not None and (name not in self.handled or maxId > self.handled[name])]
+
+    def mark(self, name, lastId):
+        with self.lock:
+            self.handled[name] = lastId
+
+    def forget(self, name):
+        with self.lock:
+            self.handled.pop(name, None)
+
+    def backlog(self, name):
+        # 最近一次 MAX(id) 与已处理水位之差，估计积压的行数
+        with self.lock:
+            if name not in self.latest or self.latest[name] is None or name not in self.handled:
+                return None
+            return max(int(self.latest[name]) - int(self.handled[name]), 0)
@@ -0,0 +1,75 @@
+# 没有训练好模型的 KPI（新表、数据不足 minTrainNum）使用的在线检测器：不需要 Keras，数据到达即可打分
+# - EWMA 均值与 EWMA 平均绝对偏差（乘 sqrt(pi/2) 估计标准差），跨度为 STA_windowSize_left；
+#   偏差超过 clip 倍标准差时均值只按 clip 倍更新（Huber），单个异常点不会把基线拉走，持续的水平变化仍能跟上
+# - |z| 的流式分位数（随机逼近），分位数为 100 - STA_fws，作为自适应阈值，下限 fallbackZMin
+# - 得分 |z| / (|z| + 阈值)：在 [0, 1) 之间，超过阈值时大于 0.5，与模型 sigmoid 输出的含义相同
+# 每个点 O(1)，每个 KPI 只保存几个浮点数
+import math
+
+madToStd = math.sqrt(math.pi / 2)
+
+
+class OnlineDetector(object):
+
+    def __init__(self, span, quantile, warmUp, zMin=3.0, clip=4.0, quantileStep=0.05):
+        self.span = span
+        self.quantile = quantile  # |z| 的分位数（0~1）
+        self.warmUp = warmUp  # 之前至少有这么多个点才打分，与模型的 historyNum 相同
+        self.zMin = zMin
+        self.clip = clip
+        self.quantileStep = quantileStep
+        self.alpha = 2.0 / (span + 1)
+        self.count = 0
+        self.mean = 0.0
+        self.dev = 0.0
+        self.threshold = zMin
+        self.lastId = None
+
+    def params(self):
+        return [self.span, self.quantile, self.warmUp, self.zMin, self.clip]
+
+    def scale(self):
+        # 常数序列的偏差为 0，用均值的一个很小的比例代替，避免除零
+        return max(self.dev * madToStd, 1e-6 * max(abs(self.mean), 1.0))
+
+    def push(self, rowId, value):
+        # 推入一个点并更新状态；点之前已有 warmUp 个点时返回它的得分，否则返回 None
+        self.lastId = rowId
+        if value is None or value != value:
+            return None
+        value = float(value)
+        if self.count == 0:
+            self.mean = value
+            self.count = 1
+            return None
+
+        residual = value - self.mean
+        scale = self.scale()
+        z = abs(residual) / scale
+        score = None
+        if self.count >= self.warmUp:
+            score = z / (z + max(self.threshold, self.zMin))
+            # 阈值在 |z| 的 quantile 分位数附近收敛
+            if z > self.threshold:
+                self.threshold += self.quantileStep * self.quantile
+            else:
+                self.threshold = max(self.threshold - self.quantileStep * (1 - self.quantile), 0.0)
+
+        # 刚开始时按算术平均更新，不受初值影响
+        alpha = max(self.alpha, 1.0 / (self.count + 1))
+        limit = self.clip * scale
+        self.mean += alpha * max(min(residual, limit), -limit)
+        self.dev += alpha * (abs(residual) - self.dev)
+        self.count += 1
+        return score
+
+
+def detector_for(modelConfig, warmUp):
+    return OnlineDetector(modelConfig["STA_windowSize_left"],
+                          1 - modelConfig["STA_fws"] / 100.0,
+                          warmUp,
+                          modelConfig.get("fallbackZMin", 3.0))
+
+
+def matches(detector, modelConfig, warmUp):
+    return detector.params() == detector_for(modelConfig, warmUp).params()
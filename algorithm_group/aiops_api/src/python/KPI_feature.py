@@ -0,0 +1,134 @@
+# 滑动窗口特征提取（方差、均值、分位数），向量化实现
+import numpy as np
+
+# 每次处理的窗口数，限制中间数组的内存占用
+chunkRows = 65536
+
+featureColumns = ['timestamp', 'std', 'mean', 'fws', 'label']
+
+
+def features_of_windows(windows, fws):
+    # windows 为 (m, windowSize) 的二维数组，每行一个窗口；返回 (m, 3) 的 [std*std, mean, fws]
+    windows = np.asarray(windows, dtype=np.float64)
+    features = np.empty((len(windows), 3), dtype=np.float64)
+    for start in range(0, len(windows), chunkRows):
+        # 拷贝成连续数组，保证与逐行 np.std / np.mean / np.percentile 的结果一致
+        chip = np.ascontiguousarray(windows[start:start + chunkRows])
+        std = np.std(chip, axis=1)
+        features[start:start + len(chip), 0] = std * std
+        features[start:start + len(chip), 1] = np.mean(chip, axis=1)
+        features[start:start + len(chip), 2] = np.percentile(chip, fws, axis=1)
+    return features
+
+
+def window_features(values, left, right, fws):
+    # 对每个位置 i 取窗口 values[i-left : i+right]（与原 kpi_train_model 循环一致，不含 i+right）
+    # 返回 (positions, features)：positions 为拥有完整窗口的下标，features 每行为 [std*std, mean, fws]
+    values = np.asarray(values, dtype=np.float64)
+    windowSize = left + right
+    if windowSize <= 0:
+        raise ValueError("STA_windowSize_left + STA_windowSize_right must be positive")
+    if len(values) < windowSize or len(values) <= left:
+        return np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.float64)
+
+    windows = np.lib.stride_tricks.sliding_window_view(values, windowSize)
+    # right 为 0 时最后一个窗口之后已没有数据点
+    windows = windows[:len(values) - left]
+    features = features_of_windows(windows, fws)
+    positions = np.arange(left, left + len(windows), dtype=np.int64)
+    return positions, features
+
+
+def multi_window_features(values, candidates):
+    # 一次计算多组窗口参数的特征（参数搜索用）：candidates 为 [(left, right, fws), ...]
+    # 返回 {(left, right, fws): (positions, features)}，与分别调用 window_features 的结果相同（浮点误差以内）
+    # 方差和均值由同一组前缀和得到，O(1) 每点；同样大小的窗口只排序一次，各个分位数和 left/right 划分共用
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    # 以中位数为基准累加，减小平方和的抵消误差
+    shift = float(np.median(values)) if n > 0 else 0.0
+    centered = values - shift
+    sums = np.concatenate(([0.0], np.cumsum(centered)))
+    sumSqs = np.concatenate(([0.0], np.cumsum(centered * centered)))
+
+    bySize = {}
+    for left, right, fws in candidates:
+        if left + right <= 0:
+            raise ValueError("STA_windowSize_left + STA_windowSize_right must be positive")
+        bySize.setdefault(left + right, []).append((left, right, fws))
+
+    result = {}
+    for windowSize, group in bySize.items():
+        # 窗口 s 为 values[s : s+windowSize]；点 i = s + left，最多 n - max(left) 个窗口
+        count = max(min(n - windowSize + 1, n - min(left for left, _, _ in group)), 0)
+        fwsList = sorted(set(fws for _, _, fws in group))
+        quantiles = dict((fws, np.empty(count, dtype=np.float64)) for fws in fwsList)
+        if count > 0:
+            windows = np.lib.stride_tricks.sliding_window_view(values, windowSize)[:count]
+            for start in range(0, count, chunkRows):
+                chip = np.sort(windows[start:start + chunkRows], axis=1)
+                for fws in fwsList:
+                    # 在有序窗口上直接做 np.percentile 默认的线性插值
+                    pos = fws / 100.0 * (windowSize - 1)
+                    lo = int(np.floor(pos))
+                    hi = min(lo + 1, windowSize - 1)
+                    quantiles[fws][start:start + len(chip)] = chip[:, lo] + (chip[:, hi] - chip[:, lo]) * (pos - lo)
+        mean = (sums[windowSize:windowSize + count] - sums[:count]) / windowSize
+        var = np.maximum((sumSqs[windowSize:windowSize + count] - sumSqs[:count]) / windowSize - mean * mean, 0.0)
+        for left, right, fws in group:
+            # 与 window_features 相同：right 为 0 时只有 n - left 个窗口
+            m = max(min(count, n - left), 0) if n > left else 0
+            features = np.empty((m, 3), dtype=np.float64)
+            features[:, 0] = var[:m]
+            features[:, 1] = mean[:m] + shift
+            features[:, 2] = quantiles[fws][:m]
+            result[(left, right, fws)] = (np.arange(left, left + m, dtype=np.int64), features)
+    return result
+
+
+class StreamingWindowFeatures(object):
+    # 分块输入数据，块之间保留窗口重叠部分，逐块输出特征
+    # context 为第一个块之前的数据（下标从 offset 开始），只输出下标 >= start 的点
+
+    def __init__(self, left, right, fws, context=(), offset=0, start=0):
+        self.left = left
+        self.right = right
+        self.fws = fws
+        self.tail = np.asarray(context, dtype=np.float64)
+        self.offset = offset  # tail[0] 的全局下标
+        self.next = start  # 下一个待输出的全局下标
+
+    def push(self, values):
+        # 返回 (全局下标, features)
+        buf = np.concatenate((self.tail, np.asarray(values, dtype=np.float64)))
+        positions, features = window_features(buf, self.left, self.right, self.fws)
+        positions = positions + self.offset
+        keep = positions >= self.next
+        positions = positions[keep]
+        features = features[keep]
+        if len(positions) > 0:
+            self.next = positions[-1] + 1
+        # 只保留下一个点的窗口需要的数据
+        keepFrom = min(max(self.next - self.left - self.offset, 0), len(buf))
+        self.tail = buf[keepFrom:]
+        self.offset += keepFrom
+        return positions, features
+
+
+def extract_features(dataset, modelConfig):
+    # dataset 为 generateDataFrame 生成的 DataFrame（id, value, timestamp, label）
+    # 输出列与 HandledData.csv 相同：timestamp, std, mean, fws, label
+    import pandas as pd
+
+    positions, features = window_features(dataset["value"].values,
+                                          modelConfig["STA_windowSize_left"],
+                                          modelConfig["STA_windowSize_right"],
+                                          modelConfig["STA_fws"])
+    handledData = pd.DataFrame({
+        'timestamp': dataset["timestamp"].values[positions],
+        'std': features[:, 0],
+        'mean': features[:, 1],
+        'fws': features[:, 2],
+        'label': dataset["label"].values[positions].astype(int),
+    }, columns=featureColumns)
+    return handledData
@@ -0,0 +1,216 @@
+# 按 id 增量维护的特征库：每个 KPI 一个目录，每列一个 .npy 文件
+# 只为新追加的行（以及边界处缺少右窗口的行）计算特征；新行逐块追加到文件末尾并原地改写文件头中的行数，
+# 已有的行不读入内存，更新时的内存占用与表的大小无关
+import json
+import os
+import struct
+
+import numpy as np
+
+import KPI_feature
+
+rawColumns = ['id', 'time', 'value', 'label']
+featureColumns = ['std', 'mean', 'fws']
+columnTypes = {
+    'id': np.int64,
+    'time': 'datetime64[us]',
+    'value': np.float64,
+    'label': np.float64,
+    'std': np.float64,
+    'mean': np.float64,
+    'fws': np.float64,
+}
+# 新建的列文件头长度，足够写下 20 位的行数
+headerLength = 128
+
+
+class FeatureStore(object):
+
+    def __init__(self, directory, left, right, fws):
+        self.directory = directory
+        self.left = left
+        self.right = right
+        self.fws = fws
+
+    def params(self):
+        return {"left": self.left, "right": self.right, "fws": self.fws}
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.directory, "meta.json")) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def load(self, mmap=True):
+        # 返回 {列名: 数组}；窗口参数变化或没有数据时返回空数组
+        meta = self.read_meta()
+        if meta is None or meta["params"] != self.params():
+            return dict((name, np.empty(0, dtype=columnTypes[name])) for name in rawColumns + featureColumns)
+        columns = {}
+        for name in rawColumns + featureColumns:
+            # 以 meta 中的行数为准，保存中途退出时多写的部分不算
+            columns[name] = np.load(os.path.join(self.directory, name + ".npy"),
+                                    mmap_mode="r" if mmap else None)[:meta["rows"]]
+        return columns
+
+    def last_id(self):
+        meta = self.read_meta()
+        if meta is None or meta["params"] != self.params() or meta["rows"] == 0:
+            return None
+        return meta["lastId"]
+
+    def column_path(self, name):
+        return os.path.join(self.directory, name + ".npy")
+
+    def write_meta(self, rows, lastId):
+        meta = {"params": self.params(), "rows": rows, "lastId": lastId}
+        with open(os.path.join(self.directory, "meta.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(self.directory, "meta.json.tmp"), os.path.join(self.directory, "meta.json"))
+
+    def update(self, ids, times, values, labels):
+        # 追加 id 大于已保存最大 id 的行（乱序到达、id 更小的行会被忽略），返回新增行数
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind="mergesort")
+        return self.update_chunks([{
+            'id': ids[order],
+            'time': np.asarray(times)[order],
+            'value': np.asarray(values)[order],
+            'label': np.asarray(labels)[order],
+        }])
+
+    def update_chunks(self, chunks):
+        # chunks 依次给出按 id 升序的块 {'id', 'time', 'value', 'label'}，边读边算特征，逐块追加到各列文件末尾
+        # 已有的数据只通过 mmap 读取窗口需要的最后几行，内存占用只与块大小有关，与表的大小无关
+        meta = self.read_meta()
+        if meta is None or meta["params"] != self.params():
+            rows = 0
+            lastId = None
+        else:
+            rows = meta["rows"]
+            lastId = meta["lastId"]
+
+        # 原来最后 right-1 行缺少右窗口，连同新行一起计算
+        first = max(rows - max(self.right - 1, 0), 0)
+        base = max(first - self.left, 0)
+        context = np.array(self.load()["value"][base:]) if rows > 0 else ()
+        stream = KPI_feature.StreamingWindowFeatures(self.left, self.right, self.fws, context, offset=base, start=first)
+        os.makedirs(self.directory, exist_ok=True)
+        newRows = 0
+        for chunk in chunks:
+            ids = np.asarray(chunk['id'], dtype=np.int64)
+            keep = np.ones(len(ids), dtype=bool) if lastId is None else ids > lastId
+            if not keep.any():
+                continue
+            part = dict((name, np.asarray(chunk[name])[keep].astype(columnTypes[name])) for name in rawColumns)
+            count = len(part['id'])
+            positions, features = stream.push(part['value'])
+            for name in rawColumns:
+                append_column(self.column_path(name), columnTypes[name], rows, part[name])
+            # 新行中还没有完整窗口的填 NaN；之前缺少右窗口的行在原位置改写
+            inChunk = positions >= rows
+            for i, name in enumerate(featureColumns):
+                column = np.full(count, np.nan)
+                column[positions[inChunk] - rows] = features[inChunk, i]
+                append_column(self.column_path(name), columnTypes[name], rows, column)
+                if not inChunk.all():
+                    write_rows(self.column_path(name), positions[~inChunk], features[~inChunk, i])
+            rows += count
+            newRows += count
+            lastId = int(part['id'][-1])
+            # 每块之后更新行数，中途退出时已追加的块不用重算
+            self.write_meta(rows, lastId)
+        return newRows
+
+    def update_from_dataframe(self, dataset):
+        # dataset 为 generateDataFrame 生成的 DataFrame（id, value, timestamp, label）
+        import pandas as pd
+        return self.update(dataset["id"].values,
+                           pd.to_datetime(dataset["timestamp"]).values,
+                           dataset["value"].values,
+                           dataset["label"].values)
+
+    def rows(self):
+        meta = self.read_meta()
+        if meta is None or meta["params"] != self.params():
+            return 0
+        return meta["rows"]
+
+    def handled_data(self):
+        # 有完整窗口的行，列与 HandledData.csv 相同：timestamp, std, mean, fws, label
+        import pandas as pd
+        columns = self.load()
+        featured = ~np.isnan(columns["std"])
+        return pd.DataFrame({
+            'timestamp': columns["time"][featured],
+            'std': columns["std"][featured],
+            'mean': columns["mean"][featured],
+            'fws': columns["fws"][featured],
+            'label': columns["label"][featured].astype(int),
+        }, columns=KPI_feature.featureColumns)
+
+
+def read_header(f):
+    # 返回 (版本, 行数, dtype, 数据起始位置)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+    return version, shape[0] if len(shape) == 1 else -1, dtype, f.tell()
+
+
+def header_bytes(dtype, rows, length):
+    # 长度为 length 的 1.0 版 .npy 文件头（不够时返回 None）；空格补齐，行数变多时可以原地改写
+    text = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(dtype), rows)
+    padding = length - 10 - len(text) - 1
+    if padding < 0 or length - 10 > 65535:
+        return None
+    return np.lib.format.magic(1, 0) + struct.pack("<H", length - 10) + (text + " " * padding + "\n").encode("latin1")
+
+
+def create_column(path, dtype, rows=0, source=None):
+    # 新建一维 .npy 文件，文件头留出行数变长的空间；source 给出时分块复制它的前 rows 行
+    dtype = np.dtype(dtype)
+    with open(path + ".tmp", "wb") as f:
+        f.write(header_bytes(dtype, rows, headerLength))
+        for start in range(0, rows, KPI_feature.chunkRows):
+            f.write(np.ascontiguousarray(source[start:min(start + KPI_feature.chunkRows, rows)], dtype=dtype).tobytes())
+    os.replace(path + ".tmp", path)
+
+
+def append_column(path, dtype, rows, values):
+    # 把 values 写在文件前 rows 行之后（之后的内容是中途退出时多写的，丢弃），再改写文件头中的行数
+    dtype = np.dtype(dtype)
+    values = np.ascontiguousarray(values, dtype=dtype)
+    if not os.path.exists(path):
+        create_column(path, dtype)
+    with open(path, "rb") as f:
+        version, fileRows, fileDtype, offset = read_header(f)
+    if version != (1, 0) or fileDtype != dtype or fileRows < rows or \
+            header_bytes(dtype, rows + len(values), offset) is None:
+        # 其他程序写的文件（文件头放不下更多位数、类型不同）：复制一次，之后都可以原地追加
+        create_column(path, dtype, rows, np.load(path, mmap_mode="r") if rows > 0 else None)
+        offset = headerLength
+    with open(path, "r+b") as f:
+        f.seek(offset + rows * dtype.itemsize)
+        f.truncate()
+        f.write(values.tobytes())
+        f.seek(0)
+        f.write(header_bytes(dtype, rows + len(values), offset))
+
+
+def write_rows(path, positions, values):
+    # 原地改写已有的行
+    column = np.load(path, mmap_mode="r+")
+    column[positions] = values
+    column.flush()
+    del column
+
+
+def store_for(kpiid, modelConfig):
+    return FeatureStore(modelConfig["saveDirs"] + "/" + str(kpiid) + "/features/",
+                        modelConfig["STA_windowSize_left"],
+                        modelConfig["STA_windowSize_right"],
+                        modelConfig["STA_fws"])
@@ -0,0 +1,233 @@
+# 分组模型（modelMode=grouped）：同一类 KPI（表名 kpi_<类>_<指标>_<粒度>，类为 all/service/instance/endpoint）
+# 共用一个模型。输入为按 KPI 标准化后的三个特征加上 KPI 编号的 embedding；阈值仍按 KPI 单独搜索
+# 目录 saveDirs/group_<类>/：每次训练的 model.h5、model.npz 保存在新的版本子目录 v<时间> 中，
+# 最后写入的 groupIndex.json（KPI -> 编号、预处理参数（见 KPI_preprocess）、阈值，以及版本子目录名）一次替换即切换版本，
+# 预测进程按 groupIndex.json 的修改时间重新加载，读到的编号和 embedding 权重总是同一次训练的
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import KPI_featureStore
+import KPI_metrics
+import KPI_npModel
+import KPI_preprocess
+import KPI_threshold
+
+kpiClasses = ("all", "service", "instance", "endpoint")
+# 保留的版本子目录数：当前版本和上一个版本（预测进程可能刚读到旧的 groupIndex.json，还没有加载模型）
+keepVersions = 2
+
+
+def group_of(kpiName):
+    parts = str(kpiName).split("_")
+    if len(parts) > 2 and parts[0] == "kpi" and parts[1] in kpiClasses:
+        return parts[1]
+    return "other"
+
+
+def group_name(className):
+    return "group_" + className
+
+
+def group_dir(className, modelConfig):
+    return modelConfig["saveDirs"] + "/" + group_name(className) + "/"
+
+
+def index_path(kpiid, modelConfig):
+    return group_dir(group_of(kpiid), modelConfig) + "groupIndex.json"
+
+
+class KpiModel(object):
+    # 分组模型中某一个 KPI 的视图，predict 接口与单 KPI 模型相同
+
+    def __init__(self, model, info):
+        self.model = model
+        self.index = info["index"]
+        self.preprocessor = KPI_preprocess.Preprocessor.from_dict(info["preprocess"])
+
+    def predict(self, x, batch_size=8192, verbose=0):
+        x = self.preprocessor.transform(x)
+        index = np.full((len(x), 1), self.index, dtype=np.int32)
+        return self.model.predict([x, index], batch_size=batch_size, verbose=verbose)
+
+
+class GroupModel(object):
+
+    def __init__(self, model, kpis):
+        self.model = model
+        self.kpis = kpis
+
+    def for_kpi(self, kpiid):
+        # 训练时没有这个 KPI（数据太少或新表）时返回 None
+        info = self.kpis.get(str(kpiid))
+        if info is None:
+            return None
+        return KpiModel(self.model, info)
+
+
+def load(path):
+    with open(path) as f:
+        groupIndex = json.load(f)
+    # 没有 version 的是版本子目录之前的旧布局，模型文件直接在组目录中
+    directory = os.path.join(os.path.dirname(path), groupIndex.get("version", ""))
+    if os.path.exists(os.path.join(directory, "model.npz")):
+        model = KPI_npModel.load(os.path.join(directory, "model.npz"))
+    else:
+        from keras.models import load_model
+        model = load_model(os.path.join(directory, "model.h5"), compile=False)
+    return GroupModel(model, groupIndex["kpis"])
+
+
+def new_version(saveDir):
+    # 新建版本子目录 v<时间>，同一秒内多次训练时加序号
+    base = "v" + time.strftime("%Y%m%d%H%M%S", time.localtime(time.time()))
+    version = base
+    suffix = 1
+    while os.path.exists(saveDir + version):
+        version = base + "_" + str(suffix)
+        suffix += 1
+    os.makedirs(saveDir + version)
+    return version
+
+
+def remove_old_versions(saveDir, current):
+    # 保留 current 和按修改时间最近的版本子目录，共 keepVersions 个
+    versions = [name for name in os.listdir(saveDir) if name.startswith("v") and os.path.isdir(saveDir + name)]
+    versions.sort(key=lambda name: (name == current, os.path.getmtime(saveDir + name)), reverse=True)
+    for name in versions[keepVersions:]:
+        shutil.rmtree(saveDir + name, ignore_errors=True)
+    # 旧布局直接放在组目录中的模型文件相当于上一个版本，已有两个版本子目录时删除
+    if len(versions) > 1:
+        for name in ("model.h5", "model.npz"):
+            if os.path.exists(saveDir + name):
+                os.remove(saveDir + name)
+
+
+def training_rows(featureStore, modelConfig):
+    # 与 kpi_train_model 相同的划分：[uu, uu+historyData_length) 中前 traintestRate 为训练集，其余为验证集
+    # 返回 (训练特征, 训练标签, 验证特征, 验证标签)
+    import KPI_modelTrain
+    columns = featureStore.load()
+    featured = ~np.isnan(columns["std"])
+    x = np.stack((columns["std"][featured], columns["mean"][featured], columns["fws"][featured]), axis=1)
+    y = columns["label"][featured].astype(np.float32).reshape(-1, 1)
+    uu = modelConfig["uu"]
+    historyData_length = max(KPI_modelTrain.split_lengths(len(x), uu, modelConfig["hRate"], modelConfig["nRate"])[0], 0)
+    x = x[uu:uu + historyData_length]
+    y = y[uu:uu + historyData_length]
+    cut = int(modelConfig["traintestRate"] * len(x))
+    return x[:cut], y[:cut], x[cut:], y[cut:]
+
+
+def build_model(kpiCount, embeddingDim):
+    import keras as K
+    init = K.initializers.glorot_uniform(seed=1)
+    featureInput = K.layers.Input(shape=(3,))
+    kpiInput = K.layers.Input(shape=(1,), dtype="int32")
+    embedding = K.layers.Flatten()(K.layers.Embedding(kpiCount, embeddingDim)(kpiInput))
+    # 特征在前、embedding 在后，与 KPI_npModel 中的拼接顺序一致
+    hidden = K.layers.Concatenate()([featureInput, embedding])
+    hidden = K.layers.Dense(units=128, kernel_initializer=init, activation='relu')(hidden)
+    hidden = K.layers.Dropout(0.01)(hidden)
+    hidden = K.layers.Dense(units=128, kernel_initializer=init, activation='relu')(hidden)
+    hidden = K.layers.Dropout(0.01)(hidden)
+    output = K.layers.Dense(units=1, kernel_initializer=init, activation='sigmoid')(hidden)
+    model = K.models.Model(inputs=[featureInput, kpiInput], outputs=output)
+    model.compile(loss='binary_crossentropy', optimizer=K.optimizers.Adam(), metrics=['accuracy'])
+    return model
+
+
+def train_group(className, kpiNameList, chunksFor, modelConfig):
+    # chunksFor(kpiName) 返回该 KPI 特征库之后新增的历史数据块（见 autoPredictKPI.iterHistoryChunks）
+    import keras as K
+    import KPI_modelTrain
+
+    saveDir = group_dir(className, modelConfig)
+    os.makedirs(saveDir, exist_ok=True)
+    logFile = open(saveDir + "log.txt", "a")
+    logFile.writelines("开始处理 \n  " + group_name(className) + "\n")
+    logFile.writelines(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())) + "\n")
+
+    # 1. 各 KPI 的特征库增量更新，按 KPI 标准化后合并成一个训练集
+    kpis = {}
+    parts = []
+    for kpiName in kpiNameList:
+        featureStore = KPI_featureStore.store_for(kpiName, modelConfig)
+        with KPI_metrics.timer("features", kpi=kpiName, phase="train"):
+            featureStore.update_chunks(chunksFor(kpiName))
+        if featureStore.rows() <= modelConfig["minTrainNum"]:
+            print("数据过少，不训练 " + str(kpiName))
+            continue
+        train_x, train_y, test_x, test_y = training_rows(featureStore, modelConfig)
+        if len(train_x) == 0 or len(test_x) == 0:
+            continue
+        preprocessor = KPI_preprocess.fit(train_x, modelConfig)
+        index = len(kpis)
+        kpis[str(kpiName)] = {"index": index, "preprocess": preprocessor.to_dict()}
+        parts.append((index, preprocessor.transform(train_x), train_y, preprocessor.transform(test_x), test_y))
+    if len(kpis) == 0:
+        print("没有可训练的 KPI " + group_name(className))
+        logFile.writelines("没有可训练的 KPI\n")
+        logFile.close()
+        return 0
+
+    train_x = np.concatenate([part[1] for part in parts])
+    train_y = np.concatenate([part[2] for part in parts])
+    train_index = np.concatenate([np.full((len(part[1]), 1), part[0], dtype=np.int32) for part in parts])
+    test_x = np.concatenate([part[3] for part in parts])
+    test_y = np.concatenate([part[4] for part in parts])
+    test_index = np.concatenate([np.full((len(part[3]), 1), part[0], dtype=np.int32) for part in parts])
+    logFile.writelines("KPI 数：" + str(len(kpis)) + "，训练行数：" + str(len(train_x)) + "\n")
+
+    # 2. 训练（提前停止、自动 batch size、tf.data 与 kpi_train_model 相同）
+    model = build_model(len(kpis), modelConfig.get("groupEmbeddingDim", 8))
+    b_size = modelConfig["b_size"]
+    batchSize = b_size if b_size > 0 else KPI_modelTrain.auto_batch_size(len(train_x))
+    callbacks = []
+    if modelConfig.get("earlyStoppingPatience", 0) > 0:
+        callbacks.append(K.callbacks.EarlyStopping(monitor='val_loss',
+                                                   patience=modelConfig["earlyStoppingPatience"],
+                                                   restore_best_weights=True))
+    trainData = KPI_modelTrain.make_dataset((train_x, train_index), train_y, batchSize, True)
+    with KPI_metrics.timer("fit", kpi=group_name(className), mode="grouped"):
+        if trainData is None:
+            history = model.fit([train_x, train_index], train_y, batch_size=batchSize,
+                                epochs=modelConfig["max_epochs"],
+                                validation_data=([test_x, test_index], test_y),
+                                shuffle=True, callbacks=callbacks, verbose=2)
+        else:
+            history = model.fit(trainData, epochs=modelConfig["max_epochs"],
+                                validation_data=KPI_modelTrain.make_dataset((test_x, test_index), test_y,
+                                                                            batchSize, False),
+                                callbacks=callbacks, verbose=2)
+    logFile.writelines("训练轮数：" + str(len(history.history['loss'])) + "\n")
+
+    # 3. 每个 KPI 单独搜索阈值
+    with KPI_metrics.timer("threshold", kpi=group_name(className)):
+        predicted = model.predict([train_x, train_index], batch_size=8192, verbose=0)
+        for kpiName, info in kpis.items():
+            rows = train_index[:, 0] == info["index"]
+            genTc, maxScore = KPI_threshold.best_threshold(predicted[rows], train_y[rows],
+                                                           modelConfig.get("thresholdStep", 0.02))
+            info["threshold"] = genTc
+            info["score"] = maxScore
+            logFile.writelines(kpiName + " 阈值:" + str(genTc) + ",得分：" + str(maxScore) + "\n")
+
+    # 4. 保存：模型文件写入新的版本子目录，groupIndex.json 最后写入并指向它
+    with KPI_metrics.timer("save_model", kpi=group_name(className)):
+        version = new_version(saveDir)
+        model.save(saveDir + version + "/model.h5")
+        KPI_npModel.export_model(model, saveDir + version + "/model.npz", [train_x[:1000], train_index[:1000]])
+        groupIndex = {"version": version, "kpis": kpis,
+                      "params": KPI_featureStore.store_for(kpiNameList[0], modelConfig).params(),
+                      "embeddingDim": modelConfig.get("groupEmbeddingDim", 8)}
+        with open(saveDir + "groupIndex.json.tmp", "w") as f:
+            json.dump(groupIndex, f, ensure_ascii=False)
+        os.replace(saveDir + "groupIndex.json.tmp", saveDir + "groupIndex.json")
+        remove_old_versions(saveDir, version)
+    logFile.writelines(" 完成训练，模型已保存，版本 " + version + "\n")
+    logFile.close()
+    return 0
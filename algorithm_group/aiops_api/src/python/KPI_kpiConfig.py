@@ -0,0 +1,70 @@
+# 每个 KPI 单独的模型参数：参数搜索（KPI_sweep）选出的最优参数保存为 saveDirs/<kpi>/kpiConfig.json，
+# 覆盖 KPIautoPredictConfig.ini 中的全局值；预测、训练和 KPI_backfill 都通过 config_for 取该 KPI 的参数
+# 分组模型（modelMode=grouped）一组 KPI 共用一套特征，不使用单独的参数
+import json
+import os
+import threading
+
+fileName = "kpiConfig.json"
+# 可以按 KPI 设置的参数
+tunable = ("STA_windowSize_left", "STA_windowSize_right", "STA_fws", "b_size", "max_epochs")
+
+lock = threading.Lock()
+cache = {}  # 路径 -> (修改时间, 覆盖的参数)
+
+
+def config_path(kpiid, modelConfig):
+    return os.path.join(modelConfig["saveDirs"], str(kpiid), fileName)
+
+
+def read_overrides(path):
+    # 按修改时间缓存，每次只多一次 stat
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    with lock:
+        cached = cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    overrides = dict((name, data["params"][name]) for name in tunable if name in data.get("params", {}))
+    with lock:
+        cache[path] = (mtime, overrides)
+    return overrides
+
+
+def config_for(kpiid, modelConfig):
+    # 返回该 KPI 使用的 modelConfig（没有单独参数时就是 modelConfig 本身）
+    if modelConfig.get("modelMode") == "grouped":
+        return modelConfig
+    overrides = read_overrides(config_path(kpiid, modelConfig))
+    if len(overrides) == 0 or all(modelConfig.get(name) == value for name, value in overrides.items()):
+        return modelConfig
+    config = dict(modelConfig)
+    config.update(overrides)
+    return config
+
+
+def save(kpiid, modelConfig, params, sweep=None):
+    # params 为 tunable 中的参数；sweep 为选出这组参数的搜索结果，只用于查看
+    path = config_path(kpiid, modelConfig)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {"params": dict((name, params[name]) for name in tunable if name in params)}
+    if sweep is not None:
+        data["sweep"] = sweep
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def remove(kpiid, modelConfig):
+    # 恢复使用全局参数
+    try:
+        os.remove(config_path(kpiid, modelConfig))
+    except OSError:
+        pass
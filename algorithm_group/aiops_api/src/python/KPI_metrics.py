@@ -0,0 +1,209 @@
+# 运行指标：各阶段耗时（timer）、计数（counter）和当前值（gauge）
+# 以 Prometheus 文本格式从本地 HTTP 端口（/metrics）导出，同时每个阶段结束时向日志文件写一行 JSON
+# 训练在子进程中进行：子进程用 dump 保存自己的指标，调度进程用 merge 合并
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+namePrefix = "kpi_"
+lock = threading.Lock()
+counters = {}  # (name, labels) -> 值
+gauges = {}
+timers = {}  # (name, labels) -> [次数, 总秒数]
+descriptions = {
+    "stage_seconds": "各阶段耗时（秒）",
+    "rows_read_total": "从数据库读取的行数",
+    "rows_predicted_total": "预测的点数",
+    "rows_written_total": "写回数据库的预测结果数",
+    "backlog_rows": "待预测的积压行数（估计值）",
+    "kpi_tables": "有模型、参与预测的 KPI 表数",
+    "kpi_tables_changed": "本次 tick 有新数据的 KPI 表数",
+    "kpi_tables_owned": "分到本进程（并取得租约）的 KPI 表数",
+    "kpi_tables_fallback": "还没有模型、由在线检测器打分的 KPI 表数",
+    "model_cache_hits_total": "模型缓存命中次数",
+    "model_cache_misses_total": "模型缓存未命中（加载模型）次数",
+    "model_cache_size": "缓存中的模型数",
+    "ticks_coalesced_total": "与上一次重叠、合并执行的预测次数",
+    "train_results_total": "每周训练结果（ok/failed/timeout）",
+}
+
+jsonLogger = logging.getLogger("KPI_metrics")
+jsonLogger.propagate = False
+
+
+def key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with lock:
+        k = key(name, labels)
+        counters[k] = counters.get(k, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with lock:
+        gauges[key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    with lock:
+        k = key(name, labels)
+        if k not in timers:
+            timers[k] = [0, 0.0]
+        timers[k][0] += 1
+        timers[k][1] += seconds
+
+
+def log_event(event, **fields):
+    if not jsonLogger.handlers:
+        return
+    record = {"ts": time.time(), "event": event}
+    record.update(fields)
+    jsonLogger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def timer(stage, **labels):
+    # with timer("read", kpi=kpiName): ...  记录到 stage_seconds{stage=...}，并写一行 JSON 日志
+    start = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        observe("stage_seconds", seconds, stage=stage, **labels)
+        log_event("stage", stage=stage, seconds=round(seconds, 6), ok=ok, **labels)
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = [k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for k, v in labels]
+    return "{" + ",".join(escaped) + "}"
+
+
+def render():
+    # Prometheus text exposition format 0.0.4
+    with lock:
+        snapshot = [("counter", dict(counters)), ("gauge", dict(gauges)), ("summary", dict(timers))]
+    lines = []
+    for kind, values in snapshot:
+        names = sorted(set(name for name, _ in values))
+        for name in names:
+            fullName = namePrefix + name
+            if name in descriptions:
+                lines.append("# HELP " + fullName + " " + descriptions[name])
+            lines.append("# TYPE " + fullName + " " + kind)
+            for (metricName, labels), value in sorted(values.items()):
+                if metricName != name:
+                    continue
+                if kind == "summary":
+                    lines.append(fullName + "_count" + format_labels(labels) + " " + str(value[0]))
+                    lines.append(fullName + "_sum" + format_labels(labels) + " " + repr(float(value[1])))
+                else:
+                    lines.append(fullName + format_labels(labels) + " " + repr(float(value)))
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_timers():
+    with lock:
+        return dict((k, list(v)) for k, v in timers.items())
+
+
+def reset():
+    with lock:
+        counters.clear()
+        gauges.clear()
+        timers.clear()
+
+
+def snapshot():
+    with lock:
+        return {
+            "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "gauges": [[name, list(labels), value] for (name, labels), value in gauges.items()],
+            "timers": [[name, list(labels), value] for (name, labels), value in timers.items()],
+        }
+
+
+def dump(path):
+    with open(path, "w") as f:
+        json.dump(snapshot(), f)
+
+
+def merge(path):
+    # 合并子进程保存的指标：计数和耗时累加，当前值覆盖
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return False
+    with lock:
+        for name, labels, value in data["counters"]:
+            k = (name, tuple(tuple(label) for label in labels))
+            counters[k] = counters.get(k, 0) + value
+        for name, labels, value in data["gauges"]:
+            gauges[(name, tuple(tuple(label) for label in labels))] = value
+        for name, labels, value in data["timers"]:
+            k = (name, tuple(tuple(label) for label in labels))
+            if k not in timers:
+                timers[k] = [0, 0.0]
+            timers[k][0] += value[0]
+            timers[k][1] += value[1]
+    return True
+
+
+def configure_log(path):
+    # 每行一个 JSON；path 为空时不写日志
+    for handler in list(jsonLogger.handlers):
+        jsonLogger.removeHandler(handler)
+        handler.close()
+    if not path:
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    handler = logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    jsonLogger.addHandler(handler)
+    jsonLogger.setLevel(logging.INFO)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, host="127.0.0.1"):
+    # 在后台线程中提供 /metrics；port 为 0 时不启动
+    if not port:
+        return None
+    server = MetricsServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
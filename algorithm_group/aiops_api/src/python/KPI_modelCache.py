@@ -0,0 +1,135 @@
+# 进程内模型缓存：LRU 淘汰，模型文件或 preprocess.json 的修改时间变化时自动重新加载
+# 优先使用训练时导出的 model.npz（纯 numpy 推理），没有时才用 Keras 加载 model.h5
+# modelMode=grouped 时同一类 KPI 共用一个分组模型（见 KPI_groupModel），缓存中每类只有一个
+import os
+import threading
+from collections import OrderedDict
+
+import KPI_groupModel
+import KPI_metrics
+import KPI_npModel
+import KPI_preprocess
+
+
+def load_keras_model(path):
+    from keras.models import load_model
+    # 预测不需要优化器，跳过 compile
+    return load_model(path, compile=False)
+
+
+def load_model(path):
+    # 有标准化参数时，predict 的输入先按它标准化：model.npz 中保存的优先，没有时用模型旁的 preprocess.json
+    # model.h5 已经替换、preprocess.json 还是上一次训练的时返回 None（本次不预测），preprocess.json 写入后重新加载
+    if path.endswith(".json"):
+        return KPI_groupModel.load(path)
+    if path.endswith(".npz"):
+        model = KPI_npModel.load(path)
+        if "preprocess" in model.extra:
+            return KPI_preprocess.ScaledModel(model, KPI_preprocess.Preprocessor.from_dict(model.extra["preprocess"]))
+        preprocessor = KPI_preprocess.load(os.path.dirname(path))
+    else:
+        try:
+            preprocessor = KPI_preprocess.load(os.path.dirname(path), path)
+        except KPI_preprocess.PendingError:
+            return None
+        model = load_keras_model(path)
+    if preprocessor is None:
+        return model
+    return KPI_preprocess.ScaledModel(model, preprocessor)
+
+
+def model_stamp(path):
+    # 模型文件和 preprocess.json 的修改时间，任一变化时重新加载；模型文件不存在时抛出 OSError
+    try:
+        sidecar = os.stat(os.path.join(os.path.dirname(path), KPI_preprocess.fileName)).st_mtime_ns
+    except OSError:
+        sidecar = None
+    return os.stat(path).st_mtime_ns, sidecar
+
+
+class ModelRegistry(object):
+
+    def __init__(self, maxSize=64, loader=load_model, stamp=model_stamp):
+        self.maxSize = maxSize
+        self.loader = loader
+        self.stamp = stamp
+        self.models = OrderedDict()  # path -> (文件修改时间, model)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        # 文件不存在时返回 None
+        try:
+            stamp = self.stamp(path)
+        except OSError:
+            with self.lock:
+                self.models.pop(path, None)
+            return None
+
+        with self.lock:
+            cached = self.models.get(path)
+            if cached is not None and cached[0] == stamp:
+                self.models.move_to_end(path)
+                self.hits += 1
+                KPI_metrics.inc("model_cache_hits_total")
+                return cached[1]
+
+        # 在锁外加载，避免阻塞其他 KPI 的命中
+        with KPI_metrics.timer("model_load", format=os.path.splitext(path)[1].lstrip(".")):
+            model = self.loader(path)
+        with self.lock:
+            self.misses += 1
+            KPI_metrics.inc("model_cache_misses_total")
+            self.models[path] = (stamp, model)
+            self.models.move_to_end(path)
+            while len(self.models) > self.maxSize:
+                self.models.popitem(last=False)
+            KPI_metrics.set_gauge("model_cache_size", len(self.models))
+        return model
+
+    def invalidate(self, path=None):
+        with self.lock:
+            if path is None:
+                self.models.clear()
+            else:
+                self.models.pop(path, None)
+
+    def resize(self, maxSize):
+        with self.lock:
+            self.maxSize = maxSize
+            while len(self.models) > self.maxSize:
+                self.models.popitem(last=False)
+
+
+registry = ModelRegistry()
+
+
+def model_path(kpiid, modelConfig):
+    # model.npz 与 model.h5 同时存在时用 npz；只有 h5 的旧模型仍然可以预测
+    if modelConfig.get("modelMode") == "grouped":
+        return KPI_groupModel.index_path(kpiid, modelConfig)
+    modelDir = modelConfig["saveDirs"] + "/" + str(kpiid) + "/"
+    if os.path.exists(modelDir + "model.npz"):
+        return modelDir + "model.npz"
+    return modelDir + "model.h5"
+
+
+def get_model(kpiid, modelConfig):
+    if "modelCacheSize" in modelConfig and modelConfig["modelCacheSize"] != registry.maxSize:
+        registry.resize(modelConfig["modelCacheSize"])
+    model = registry.get(model_path(kpiid, modelConfig))
+    if isinstance(model, KPI_groupModel.GroupModel):
+        model = model.for_kpi(kpiid)
+    preprocessor = getattr(model, "preprocessor", None)
+    if preprocessor is not None and not preprocessor.matches(modelConfig):
+        # 模型是用另一组窗口参数训练的，等重新训练后再预测
+        return None
+    return model
+
+
+def has_model(kpiid, modelConfig):
+    # 分组模型要看这个 KPI 是否参与了训练，需要加载 groupIndex.json
+    if modelConfig.get("modelMode") == "grouped":
+        return get_model(kpiid, modelConfig) is not None
+    return os.path.exists(model_path(kpiid, modelConfig))
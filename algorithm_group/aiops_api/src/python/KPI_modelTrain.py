@@ -1,27 +1,88 @@
 # 按照函数y_train=x_train*np.sin(x_train)生成函数
+# pandas、Keras 在 kpi_train_model 中才导入，调度进程加载本模块不会引入这些框架
 import numpy as np
 
-import tensorflow as tf
-import matplotlib.pyplot as plt
-from keras.layers import Dense, Dropout
-import  pandas as pd
-from pandas import read_csv
-
-
-import pandas as pd
-from matplotlib import pyplot
-
+import json
 import os
 import time
 # import timedelta
 from datetime import datetime
 
+import KPI_featureStore
+import KPI_metrics
+import KPI_npModel
+import KPI_plot
+import KPI_preprocess
+import KPI_threshold
+
 
 
 # print(fileList)
 
 
+def auto_batch_size(rows, targetSteps=200, minBatch=32, maxBatch=4096):
+    # 每轮约 targetSteps 步：数据多时用大批量，数据少时用小批量；取 2 的幂
+    size = 1 << int(np.ceil(np.log2(max(rows / float(targetSteps), 1))))
+    return int(min(max(size, minBatch), maxBatch))
+
+
+def make_dataset(x, y, batchSize, shuffle, seed=1):
+    # tf.data：打乱、分批并预取，数据准备与训练重叠；没有 tensorflow 时返回 None，直接用数组训练
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return None
+    dataset = tf.data.Dataset.from_tensor_slices((x, y))
+    if shuffle:
+        dataset = dataset.shuffle(min(len(x), 100000), seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batchSize).prefetch(tf.data.AUTOTUNE)
+
+
+def replay_rows(trainedRows, newRows, replayRate, seed=1):
+    # 从已训练过的前 trainedRows 行中均匀抽取 replayRate*newRows 行，与新增数据一起训练，减轻遗忘
+    count = min(int(newRows * replayRate), trainedRows)
+    if count <= 0:
+        return np.empty(0, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(trainedRows, count, replace=False))
+
+
+def build_model():
+    # 三个特征输入，两层 128 的全连接，输出异常概率（参数搜索 KPI_sweep 的候选模型也用这个结构）
+    import keras as K
+    init = K.initializers.glorot_uniform(seed=1)
+    model = K.models.Sequential()
+    model.add(K.layers.Dense(units=128, input_dim=3, kernel_initializer=init, activation='relu'))
+    model.add(K.layers.Dropout(0.01))
+    model.add(K.layers.Dense(units=128, kernel_initializer=init, activation='relu'))
+    model.add(K.layers.Dropout(0.01))
+    model.add(K.layers.Dense(units=1, kernel_initializer=init, activation='sigmoid'))
+    return model
+
+
+def read_train_state(saveDir):
+    try:
+        with open(saveDir + "trainState.json") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_train_state(saveDir, state):
+    with open(saveDir + "trainState.json.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(saveDir + "trainState.json.tmp", saveDir + "trainState.json")
+
+
+def split_lengths(handledRows, uu, hRate, nRate):
+    # 从第 uu 个有特征的行开始：前 hRate 为历史数据（训练/验证），之后 nRate 为新的数据（检验）
+    # 按 uu 之后实际的行数计算，两段都不会越过 handledData 的末尾；行数太少时长度可能为 0 或负数
+    available = max(handledRows - uu, 0)
+    return int(available * hRate) - 100, max(int(available * nRate) - 100, 0)
+
+
 def kpi_train_model(kpiid,rowDataFrame,modelConfig):
+    import pandas as pd
 
     saveDirs = modelConfig[ "saveDirs" ]
     uu = modelConfig[ "uu" ]  # 起始位置
@@ -37,13 +98,10 @@ def kpi_train_model(kpiid,rowDataFrame,modelConfig):
 
     STA_fws = modelConfig[ "STA_fws" ] ;  # 特征提取分位数
 
-    chipSize = 3000
-    if not os.path.exists(saveDirs):
-        os.mkdir(saveDirs)
+    os.makedirs(saveDirs, exist_ok=True)
 
     thisTrainSaveDir=saveDirs+"/"+str(kpiid)+"/"
-    if not os.path.exists(thisTrainSaveDir):
-        os.mkdir(thisTrainSaveDir)
+    os.makedirs(thisTrainSaveDir, exist_ok=True)
 
 
     logFile = open(thisTrainSaveDir+"log.txt", "a")  # 设置文件对象
@@ -62,94 +120,55 @@ def kpi_train_model(kpiid,rowDataFrame,modelConfig):
     logFile.writelines("==================================================="+"\n")
 
 
-    dataset = rowDataFrame
-    # dataset.sort_index(by = ['timestamp'],axis = 0,ascending = True)
-    # dataset.set_index(["timestamp"], inplace=True)
-
-    if not os.path.exists(thisTrainSaveDir+"rowDat/"):
-        os.mkdir(thisTrainSaveDir+"rowDat/")
-    for i  in range(1,int(len(dataset)/chipSize)):
-        pyplot.subplot("211")
-        pyplot.plot(dataset.iloc[int((i-1) *(chipSize)):int(i  *chipSize), 1:2].values, label='value')
-        pyplot.legend()
-        pyplot.subplot("212")
-        pyplot.plot(dataset.iloc[int((i-1) *(chipSize)):int(i  *chipSize), 2:3].values, label='label')
-        pyplot.legend()
-        pyplot.savefig(thisTrainSaveDir+"rowDat/"+str(i)+"原始数据.png", dpi=200)
-        pyplot.clf()
-
-    historyData_length = int(len(dataset) * hRate) - 100
-    newData_length = int(len(dataset) * nRate) - 100
-
-    dataset = dataset.iloc[uu:uu + historyData_length + newData_length]
-
-    handledData = pd.DataFrame({})
-    handledData['timestamp'] = []
-    handledData['std'] = []
-    handledData['mean'] = []
-    handledData['fws'] = []
-    # handledData['diffStd'] = []
-    # handledData['diffMean'] = []
-    # handledData['CRstd'] = []
-    # handledData['CRmean'] = []
-    handledData['label'] = []
-    allLen = len(dataset)
-
-
-    lastStd=0
-    lastMean=0
-
-    print( dataset.head(5))
-    if os.path.exists(thisTrainSaveDir+"HandledData.csv"):
-        names=['timestamp','std', 'mean', 'fws','label']
-        handledData=read_csv(thisTrainSaveDir+"HandledData.csv", names=names, low_memory=False, skiprows=1)
-    else:
-        alllent=len(dataset)
-        for index, row in dataset.iterrows():
-            if index %1000==0:
-                print("提取特征" + str(index - uu) + "/" + str(alllent))
-            tpList = []
-            # print(index,sizee
-            for ii in range(index - STA_windowSize_left, index+STA_windowSize_right):
-                try:
-                    tpList.append(dataset.loc[ii]["value"])
-                except:
-                    continue
-            if (len(tpList) < STA_windowSize_left+STA_windowSize_right):
-                continue
-            stdd = np.std(tpList)*np.std(tpList)
-            mean = np.mean(tpList)
-            fws = np.percentile(tpList, STA_fws)
-
-            changeRate=0
-
-            # diffStd=stdd-lastStd
-            # diffMean= mean - lastMean
-            # CRstd =0
-            # if stdd != 0:
-            #     CRstd= (stdd-lastStd)/stdd
-            # CRMean =0
-            # if mean != 0:
-            #     CRMean= (mean-lastMean)/mean
-            # lastStd=stdd
-            # lastMean = mean
-            handledData.loc[len(handledData)] = [row["timestamp"],
-                                                 stdd,
-                                                 mean,
-                                                 fws,
-                                                 # diffStd,
-                                                 # diffMean,
-                                                 # CRstd,
-                                                 # CRMean,
-                                                 int(row["label"])
-                                                 ]
-        handledData.to_csv(thisTrainSaveDir+"HandledData.csv")
-
-
-
-
-    TZ_df = handledData.iloc[0:historyData_length, :]
-    TZ_test = handledData.iloc[historyData_length:historyData_length + newData_length, :]
+    # 特征库只为上次之后新增的行计算特征
+    # rowDataFrame 可以是 DataFrame（id, value, timestamp, label），也可以是按 id 升序的分块数据
+    featureStore = KPI_featureStore.FeatureStore(thisTrainSaveDir + "features/",
+                                                 STA_windowSize_left, STA_windowSize_right, STA_fws)
+    with KPI_metrics.timer("features", kpi=kpiid, phase="train"):
+        if isinstance(rowDataFrame, pd.DataFrame):
+            newRows = featureStore.update_from_dataframe(rowDataFrame)
+        else:
+            newRows = featureStore.update_chunks(rowDataFrame)
+    allRows = featureStore.rows()
+    print("提取特征，新增 " + str(newRows) + "/" + str(allRows))
+    if allRows <= modelConfig["minTrainNum"]:
+        print("数据过少，不训练 " + str(kpiid))
+        logFile.writelines("数据过少，不训练\n")
+        logFile.close()
+        return 0
+
+    # 上次训练之后没有新增数据、参数也没有变化时沿用上次的模型：不重新训练也不重新保存，
+    # 模型文件的修改时间不变，预测进程缓存的模型不会失效
+    model_save_path = thisTrainSaveDir+"model.h5"
+    split = [uu, hRate, traintestRate]
+    budget = [b_size, max_epochs]
+    trainState = read_train_state(thisTrainSaveDir)
+    if newRows == 0 and trainState is not None and os.path.exists(model_save_path) \
+            and trainState["params"] == featureStore.params() and trainState["split"] == split \
+            and trainState.get("budget") == budget:
+        print("没有新增数据，沿用上次的模型 " + str(kpiid))
+        logFile.writelines("没有新增数据，沿用上次的模型\n")
+        logFile.close()
+        return 0
+
+    # 诊断图需要的数据，训练结束后按 plotMode 绘制（原始数据直接从特征库读取）
+    plotData = {"names": []}
+
+    with KPI_metrics.timer("load_features", kpi=kpiid):
+        handledData = featureStore.handled_data()
+    print(handledData.head(5))
+    historyData_length, newData_length = split_lengths(len(handledData), uu, hRate, nRate)
+    if historyData_length <= 0:
+        print("数据过少，不训练 " + str(kpiid))
+        logFile.writelines("数据过少，不训练\n")
+        logFile.close()
+        return 0
+
+
+
+
+    TZ_df = handledData.iloc[uu:uu + historyData_length, :]
+    TZ_test = handledData.iloc[uu + historyData_length:uu + historyData_length + newData_length, :]
 
     print(TZ_df.head(5))
     print(len(TZ_df))
@@ -184,15 +203,39 @@ def kpi_train_model(kpiid,rowDataFrame,modelConfig):
 
 
     import keras as K
+
+    # 上次训练用过的行（特征库只追加，窗口参数、划分方式和训练参数不变时前 trainedRows 行与上次相同）
+    # 满足条件时在上次的模型上继续训练：只用新增的行加上回放的旧行，训练量与新增数据成正比
+    trainedRows = 0
+    if modelConfig.get("warmStart", False) and trainState is not None and os.path.exists(model_save_path) \
+            and trainState["params"] == featureStore.params() and trainState["split"] == split \
+            and trainState.get("budget") == budget and 0 < trainState["trainRows"] <= len(train_x) \
+            and KPI_preprocess.load(thisTrainSaveDir) is not None \
+            and len(train_x) - trainState["trainRows"] <= modelConfig.get("warmStartMaxNewRate", 1.0) * trainState["trainRows"]:
+        trainedRows = trainState["trainRows"]
+
+    # 特征标准化：重新训练时按训练集拟合，继续训练时沿用上次的参数（模型输入的尺度不变）
+    if trainedRows > 0:
+        preprocessor = KPI_preprocess.load(thisTrainSaveDir)
+    else:
+        preprocessor = KPI_preprocess.fit(train_x, modelConfig)
+    train_x = preprocessor.transform(train_x)
+    test_x = preprocessor.transform(test_x)
+
     # 2. 定义模型
-    init = K.initializers.glorot_uniform(seed=1)
     simple_adam = K.optimizers.Adam()
-    model = K.models.Sequential()
-    model.add(K.layers.Dense(units=128, input_dim=3, kernel_initializer=init, activation='relu'))
-    model.add(Dropout(0.01))
-    model.add(K.layers.Dense(units=128, kernel_initializer=init, activation='relu'))
-    model.add(Dropout(0.01))
-    model.add(K.layers.Dense(units=1, kernel_initializer=init, activation='sigmoid'))
+    if trainedRows > 0:
+        model = K.models.load_model(model_save_path, compile=False)
+        replay = replay_rows(trainedRows, len(train_x) - trainedRows, modelConfig.get("replayRate", 1.0))
+        fitRows = np.concatenate((replay, np.arange(trainedRows, len(train_x))))
+        fit_x = train_x[fitRows]
+        fit_y = train_y[fitRows]
+        logFile.writelines("继续训练：新增 " + str(len(train_x) - trainedRows) + " 行，回放 " + str(len(replay)) + " 行\n")
+    else:
+        model = build_model()
+        fit_x = train_x
+        fit_y = train_y
+        logFile.writelines("重新训练：" + str(len(train_x)) + " 行\n")
     model.compile(
                 loss='binary_crossentropy',
                   optimizer=simple_adam,
@@ -203,114 +246,91 @@ def kpi_train_model(kpiid,rowDataFrame,modelConfig):
                            ]
                   )
 
+    batchSize = b_size if b_size > 0 else auto_batch_size(len(fit_x))
+    callbacks = []
+    if modelConfig.get("earlyStoppingPatience", 0) > 0:
+        callbacks.append(K.callbacks.EarlyStopping(monitor='val_loss',
+                                                   patience=modelConfig["earlyStoppingPatience"],
+                                                   restore_best_weights=True))
+    logFile.writelines("batch_size=" + str(batchSize) + "\n")
+
     print("Starting training ")
-    history = model.fit(
-                        train_x,
-                        train_y,
-
-                        batch_size=b_size,
-                        epochs=max_epochs,
-                        validation_data=(test_x, test_y),
-                        # class_weight='auto',
-                        shuffle=True,
-                        verbose=2)
+    lossHistory = {'loss': [], 'val_loss': []}
+    if len(fit_x) > 0:
+        trainData = make_dataset(fit_x, fit_y, batchSize, True)
+        with KPI_metrics.timer("fit", kpi=kpiid, mode="warm" if trainedRows > 0 else "full"):
+            if trainData is None:
+                history = model.fit(
+                                    fit_x,
+                                    fit_y,
+
+                                    batch_size=batchSize,
+                                    epochs=max_epochs,
+                                    validation_data=(test_x, test_y),
+                                    # class_weight='auto',
+                                    shuffle=True,
+                                    callbacks=callbacks,
+                                    verbose=2)
+            else:
+                history = model.fit(
+                                    trainData,
+                                    epochs=max_epochs,
+                                    validation_data=make_dataset(test_x, test_y, batchSize, False),
+                                    callbacks=callbacks,
+                                    verbose=2)
+        lossHistory = history.history
+        logFile.writelines("训练轮数：" + str(len(lossHistory['loss'])) + "\n")
+    else:
+        print("没有新增数据，沿用上次的模型")
     print("Training finished \n")
 
-    model_save_path = thisTrainSaveDir+"model.h5"
-    # 保存模型
-    model.save(model_save_path)
-    logFile.writelines(" 完成训练，模型已保存\n")
+    # 保存模型：先写临时文件再替换，预测进程不会读到写了一半的模型；没有训练时模型没有变化，不重新保存
+    if len(fit_x) > 0:
+        with KPI_metrics.timer("save_model", kpi=kpiid):
+            model.save(thisTrainSaveDir+"model.tmp.h5")
+            os.replace(thisTrainSaveDir+"model.tmp.h5", model_save_path)
+            # 导出纯 numpy 推理用的权重，预测进程不需要加载 Keras；标准化参数保存在同一个文件中，与权重一起替换
+            if not KPI_npModel.export_model(model, thisTrainSaveDir+"model.npz", train_x[:1000],
+                                            extra={"preprocess": preprocessor.to_dict()}):
+                logFile.writelines(" 未导出 numpy 模型，预测使用 model.h5\n")
+            # preprocess.json 最后写入并记录 model.h5 的版本：只用 model.h5 预测时，两者不一致的间隙里不会配错标准化参数
+            KPI_preprocess.save(preprocessor, thisTrainSaveDir, model_save_path)
+            write_train_state(thisTrainSaveDir, {"params": featureStore.params(), "split": split,
+                                                 "budget": budget, "trainRows": len(train_x)})
+        logFile.writelines(" 完成训练，模型已保存\n")
     # from keras.models import load_model
     # model = load_model(model_save_path)
 
-    plt.subplot("211")
-    pyplot.plot(history.history['loss'], label='train')
-    pyplot.plot(history.history['val_loss'], label='test')
-    pyplot.legend()
-    pyplot.savefig(thisTrainSaveDir+"trainLoss.png", dpi=100)
-    pyplot.clf()
+    plotData["loss"] = np.asarray(lossHistory['loss'])
+    plotData["val_loss"] = np.asarray(lossHistory['val_loss'])
 
     logFile.writelines("===================================================" + "\n")
     logFile.writelines("开始调整阈值:" + "\n")
 
-    from sklearn import  metrics
-
     unknown = np.array(
         train_x
         , dtype=np.float32)
-    predicted = model.predict(unknown)
-    def testTC(tc,time):
-        y_true = train_y;
-        y_pred = []
+    with KPI_metrics.timer("threshold", kpi=kpiid):
+        predicted = model.predict(unknown)
 
-        sum=0;
-
-        true1num = 0
-        false1num = 0
-        true0num = 0
-        false0num =0
-        ytrue1num=0
-        for i in range(len(predicted)):
-            if predicted[i][0] > tc:
-                y_pred.append(1)
-                if y_true[i]==1:
-                    true1num=true1num+1
-                    ytrue1num=ytrue1num+1
-                else :
-                    false1num=false1num+1
-            else:
-                y_pred.append(0)
-                if y_true[i]==1:
-                    false0num=false0num+1
-                    ytrue1num = ytrue1num + 1
-                else :
-                    true0num=true0num+1
-        myscore=1
-        if ytrue1num != 0:
-            rate=   ytrue1num/(len(y_true)-ytrue1num)
-            myscore= (true1num/(ytrue1num))-    (false1num/(ytrue1num))
-
-        # ac_score=metrics.accuracy_score(y_true, y_pred)
-        # prec_score = metrics.precision_score(y_true, y_pred,average='macro')#样本数量不均衡，注重数量少的，使用宏平均
-        # rc_score=  metrics. recall_score(y_true, y_pred, average='macro')
-        # f_score=metrics.f1_score(y_true, y_pred, average='macro')
-
-
-
-        print("第:" + str(time) + "次,得分：" + str(myscore) + " ")
-        # logFile.writelines("第:"+str(time)+"次,得分："+str((false1num/(ytrue1num))) + "  \n")
-        # logFile.writelines("1:" + str((true1num/(ytrue1num))) + ",2：" + str((false1num/(ytrue1num))) + "\n")
-        # logFile.writelines("(true1num/(true1num+false0num))= "+str((true1num/(true1num+false0num)))+"\n")
-        # logFile.writelines("rate *(false1num/(true1num+false0num))= "+str(rate *(false1num/(true1num+false0num)))+"\n")
-
-
-        # logFile.writelines("ac_score:     " + str(ac_score)  +  "    ")
-        # logFile.writelines("prec_score:   " + str(prec_score) + "    ")
-        # logFile.writelines("rc_score:     " + str(rc_score) +   "    \n")
-        return myscore
-
-    startTC=0
-    maxScore=0;
-    genTc=startTC
-    step=0.02
-    for i in range( 1,int((1-startTC)/step)   ):
-        tpScore= testTC(startTC+i*step, i)
-        if tpScore>maxScore:
-            maxScore=tpScore
-            genTc=startTC+i*step
+        # thresholdStep 为 0 时求精确最优阈值
+        genTc, maxScore = KPI_threshold.best_threshold(predicted, train_y, modelConfig.get("thresholdStep", 0.02))
+    print("阈值:" + str(genTc) + ",得分：" + str(maxScore) + " ")
 
     logFile.writelines("调整完成，最终阈值:" + str(genTc) + ",得分：" + str(maxScore) + "\n")
 
     TC=genTc
     # 检验阶段
     def runTestData(name, testDataFrame, clfNum):
+        if len(testDataFrame) == 0:
+            print("没有" + name + "，跳过测试")
+            logFile.writelines("没有" + name + "，跳过测试\n")
+            return 0
         print("开始测试" + name)
         # print("head5")
         # print(testDataFrame.head(5))
         input_x=testDataFrame.iloc[:, 0:3].values.astype('float32')
-        unknown = np.array(
-            input_x
-            , dtype=np.float32)
+        unknown = preprocessor.transform(input_x)
         predicted = model.predict(unknown)
         y_true =  testDataFrame.iloc[:,3 :4].values.astype('float32')
         y_pred = []
@@ -351,29 +371,22 @@ def kpi_train_model(kpiid,rowDataFrame,modelConfig):
             # else:
             #     y_pred.append(0)
 
-        plt.subplot("211")
-        pyplot.plot(y_true , label='label')
-        pyplot.legend()
-        # pyplot.show()
-        plt.subplot("212")
-        pyplot.plot(y_pred , label='predict')
-        pyplot.legend()
-        pyplot.savefig(thisTrainSaveDir + name+"预测和实际.png", dpi=100)
-        pyplot.clf()
-
-        pyplot.plot( testDataFrame.iloc[:,0 :1].values.astype('float32'), label='std')
-        pyplot.plot(testDataFrame.iloc[:, 1:2].values.astype('float32'), label='mean')
-        pyplot.plot(testDataFrame.iloc[:, 2:3].values.astype('float32'), label='fws')
-        pyplot.legend()
-        pyplot.savefig(thisTrainSaveDir + name + "数据.png", dpi=100)
-        pyplot.clf()
+        index = str(len(plotData["names"]))
+        plotData["names"].append(name)
+        plotData[index + "_true"] = y_true
+        plotData[index + "_pred"] = np.asarray(y_pred, dtype=np.float32)
+        plotData[index + "_features"] = input_x
 
 
 
         return 0
 
-    runTestData("历史数据", TZ_df, TC)
-    runTestData("新的数据", TZ_test, TC)
+    with KPI_metrics.timer("evaluate", kpi=kpiid):
+        runTestData("历史数据", TZ_df, TC)
+        runTestData("新的数据", TZ_test, TC)
+
+    with KPI_metrics.timer("plot", kpi=kpiid, mode=modelConfig.get("plotMode", "inline")):
+        KPI_plot.render(thisTrainSaveDir, featureStore.directory, plotData, modelConfig)
 
     logFile.close()
     return 0
@@ -0,0 +1,123 @@
+# 纯 numpy 的前向推理：训练后把 Dense 层的权重导出为 model.npz，预测时不需要 TensorFlow/Keras
+# 文件内容：layers=层数，<i>_kernel / <i>_bias / <i>_activation；Dropout 在推理时不起作用，不导出
+# 分组模型（见 KPI_groupModel）另有 embedding：输入为 [features, KPI 编号]，编号的 embedding 接在特征之后
+# extra：随权重一起保存的 JSON 元数据（例如特征标准化参数），与权重在同一个文件中一次替换，不会读到新旧混合的组合
+import json
+import os
+
+import numpy as np
+
+activations = {
+    "linear": lambda z: z,
+    "relu": lambda z: np.maximum(z, 0, out=z),
+    # 1 / (1 + exp(-z)) 在 z 很小时 exp 溢出并告警；logaddexp(0, -z) = log(1 + exp(-z)) 不会溢出
+    "sigmoid": lambda z: np.exp(-np.logaddexp(0, -z)),
+    "tanh": np.tanh,
+}
+
+
+class NumpyModel(object):
+
+    def __init__(self, kernels, biases, activationNames, embedding=None, extra=None):
+        for name in activationNames:
+            if name not in activations:
+                raise ValueError("unsupported activation: " + str(name))
+        self.kernels = [np.ascontiguousarray(kernel, dtype=np.float32) for kernel in kernels]
+        self.biases = [np.asarray(bias, dtype=np.float32) for bias in biases]
+        self.activationNames = list(activationNames)
+        self.embedding = None if embedding is None else np.asarray(embedding, dtype=np.float32)
+        self.extra = {} if extra is None else extra
+
+    def forward(self, x, index=None):
+        z = np.asarray(x, dtype=np.float32)
+        if self.embedding is not None:
+            z = np.concatenate((z, self.embedding[index]), axis=1)
+        for kernel, bias, name in zip(self.kernels, self.biases, self.activationNames):
+            z = z @ kernel
+            z += bias
+            z = activations[name](z)
+        return z
+
+    def predict(self, x, batch_size=8192, verbose=0):
+        # 与 Keras 的 model.predict 接口一致，返回 (n, units)；分批计算，限制中间结果的内存
+        # 有 embedding 时 x 为 [features, KPI 编号]
+        index = None
+        if self.embedding is not None:
+            x, index = x
+            index = np.asarray(index, dtype=np.int64).reshape(-1)
+        x = np.asarray(x, dtype=np.float32)
+        if len(x) <= batch_size:
+            return self.forward(x, index)
+        return np.concatenate([self.forward(x[i:i + batch_size], None if index is None else index[i:i + batch_size])
+                               for i in range(0, len(x), batch_size)])
+
+
+def from_keras(model):
+    # 只支持 Dense/Dropout 组成的模型（分组模型另有输入层、Embedding、Flatten 和 Concatenate），
+    # 遇到其他层时抛出 ValueError
+    kernels = []
+    biases = []
+    activationNames = []
+    embedding = None
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        if kind in ("Dropout", "InputLayer", "Flatten", "Concatenate"):
+            continue
+        if kind == "Embedding":
+            embedding = layer.get_weights()[0]
+            continue
+        if kind != "Dense":
+            raise ValueError("unsupported layer: " + kind)
+        kernel, bias = layer.get_weights()
+        activation = layer.get_config()["activation"]
+        if isinstance(activation, dict):
+            activation = activation.get("config", {}).get("name", activation.get("class_name"))
+        kernels.append(kernel)
+        biases.append(bias)
+        activationNames.append(activation)
+    return NumpyModel(kernels, biases, activationNames, embedding)
+
+
+def save(numpyModel, path):
+    arrays = {"layers": np.array(len(numpyModel.kernels))}
+    for i, (kernel, bias, name) in enumerate(zip(numpyModel.kernels, numpyModel.biases, numpyModel.activationNames)):
+        arrays[str(i) + "_kernel"] = kernel
+        arrays[str(i) + "_bias"] = bias
+        arrays[str(i) + "_activation"] = np.array(name)
+    if numpyModel.embedding is not None:
+        arrays["embedding"] = numpyModel.embedding
+    if len(numpyModel.extra) > 0:
+        arrays["extra"] = np.array(json.dumps(numpyModel.extra))
+    # 先写临时文件再替换，预测进程不会读到写了一半的文件
+    tmpPath = path + ".tmp.npz"
+    np.savez(tmpPath, **arrays)
+    os.replace(tmpPath, path)
+
+
+def load(path):
+    with np.load(path) as data:
+        layers = int(data["layers"])
+        return NumpyModel([data[str(i) + "_kernel"] for i in range(layers)],
+                          [data[str(i) + "_bias"] for i in range(layers)],
+                          [str(data[str(i) + "_activation"]) for i in range(layers)],
+                          data["embedding"] if "embedding" in data.files else None,
+                          json.loads(str(data["extra"])) if "extra" in data.files else None)
+
+
+def export_model(model, path, sample=None, rtol=1e-4, atol=1e-5, extra=None):
+    # 导出后用 sample（分组模型为 [features, KPI 编号]）对比 Keras 与 numpy 的输出；导出失败或结果不一致时删除 npz，
+    # 预测会退回到 model.h5，不会继续使用上一次训练的权重。extra 与权重一起保存。返回是否导出成功
+    try:
+        numpyModel = from_keras(model)
+        numpyModel.extra = {} if extra is None else extra
+        if sample is not None and len(sample) > 0:
+            expected = model.predict(sample, verbose=0)
+            if not np.allclose(numpyModel.predict(sample), expected, rtol=rtol, atol=atol):
+                raise ValueError("numpy 推理结果与 Keras 不一致")
+        save(numpyModel, path)
+        return True
+    except ValueError as e:
+        print("导出 numpy 模型失败：" + str(e))
+        if os.path.exists(path):
+            os.remove(path)
+        return False
@@ -0,0 +1,148 @@
+# 训练诊断图：可以关闭（plotMode=off）、在训练进程中直接绘制（inline，默认），
+# 或只保存数组，训练结束后由调度进程用有界的进程池绘制（deferred，见 render_pending）。只有真正绘图时才导入 matplotlib
+# 单独绘制：python KPI_plot.py <模型目录> [<特征库目录> [chipSize] [maxPoints]]
+import json
+import os
+import sys
+
+import numpy as np
+
+plotModes = ("off", "inline", "deferred")
+# deferred 模式下待绘制的标记文件，记录特征库目录和绘图参数
+pendingName = "plotPending.json"
+
+
+def decimate(values, maxPoints):
+    # min/max 抽稀：每个桶保留最小值和最大值，曲线的包络不变；返回 (x, y)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if len(values) <= maxPoints:
+        return np.arange(len(values)), values
+    buckets = max(maxPoints // 2, 1)
+    edges = np.linspace(0, len(values), buckets + 1).astype(np.int64)
+    starts = edges[:-1]
+    mins = np.minimum.reduceat(values, starts)
+    maxs = np.maximum.reduceat(values, starts)
+    x = np.repeat((edges[:-1] + edges[1:]) // 2, 2)
+    y = np.empty(2 * buckets)
+    y[0::2] = mins
+    y[1::2] = maxs
+    return x, y
+
+
+def save(saveDir, plotData):
+    # plotData: loss, val_loss, names（测试集名称）, <i>_true, <i>_pred, <i>_features
+    arrays = dict((key, value) for key, value in plotData.items() if key != "names")
+    np.savez(os.path.join(saveDir, "plotData.npz"), **arrays)
+    with open(os.path.join(saveDir, "plotNames.json"), "w") as f:
+        json.dump(plotData["names"], f, ensure_ascii=False)
+
+
+def load(saveDir):
+    data = np.load(os.path.join(saveDir, "plotData.npz"))
+    plotData = dict((key, data[key]) for key in data.files)
+    with open(os.path.join(saveDir, "plotNames.json")) as f:
+        plotData["names"] = json.load(f)
+    return plotData
+
+
+def load_raw(rawDir):
+    # 原始数据直接从特征库读取
+    with open(os.path.join(rawDir, "meta.json")) as f:
+        rows = json.load(f)["rows"]
+    value = np.load(os.path.join(rawDir, "value.npy"), mmap_mode="r")[:rows]
+    label = np.load(os.path.join(rawDir, "label.npy"), mmap_mode="r")[:rows]
+    return value, label
+
+
+def draw(saveDir, plotData, value, label, chipSize=3000, maxPoints=4000):
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot
+
+    def plot(values, name):
+        x, y = decimate(values, maxPoints)
+        pyplot.plot(x, y, label=name)
+
+    os.makedirs(os.path.join(saveDir, "rowDat"), exist_ok=True)
+    for i in range(1, int(len(value) / chipSize)):
+        pyplot.subplot(211)
+        plot(value[(i - 1) * chipSize:i * chipSize], 'value')
+        pyplot.legend()
+        pyplot.subplot(212)
+        plot(label[(i - 1) * chipSize:i * chipSize], 'label')
+        pyplot.legend()
+        pyplot.savefig(os.path.join(saveDir, "rowDat", str(i) + "原始数据.png"), dpi=200)
+        pyplot.clf()
+
+    pyplot.subplot(211)
+    plot(plotData["loss"], 'train')
+    plot(plotData["val_loss"], 'test')
+    pyplot.legend()
+    pyplot.savefig(os.path.join(saveDir, "trainLoss.png"), dpi=100)
+    pyplot.clf()
+
+    for i, name in enumerate(plotData["names"]):
+        pyplot.subplot(211)
+        plot(plotData[str(i) + "_true"], 'label')
+        pyplot.legend()
+        pyplot.subplot(212)
+        plot(plotData[str(i) + "_pred"], 'predict')
+        pyplot.legend()
+        pyplot.savefig(os.path.join(saveDir, name + "预测和实际.png"), dpi=100)
+        pyplot.clf()
+
+        features = plotData[str(i) + "_features"]
+        plot(features[:, 0], 'std')
+        plot(features[:, 1], 'mean')
+        plot(features[:, 2], 'fws')
+        pyplot.legend()
+        pyplot.savefig(os.path.join(saveDir, name + "数据.png"), dpi=100)
+        pyplot.clf()
+
+
+def render(saveDir, rawDir, plotData, modelConfig):
+    mode = modelConfig.get("plotMode", "inline")
+    chipSize = modelConfig.get("plotChipSize", 3000)
+    maxPoints = modelConfig.get("plotMaxPoints", 4000)
+    if mode == "off":
+        return
+    if mode == "deferred":
+        # 训练子进程不再自己启动绘图进程，只留下标记
+        save(saveDir, plotData)
+        with open(os.path.join(saveDir, pendingName), "w") as f:
+            json.dump({"rawDir": rawDir, "chipSize": chipSize, "maxPoints": maxPoints}, f)
+        return
+    value, label = load_raw(rawDir)
+    draw(saveDir, plotData, value, label, chipSize, maxPoints)
+
+
+def render_saved(saveDir):
+    # 绘制 deferred 模式保存的诊断图，完成后删除标记
+    with open(os.path.join(saveDir, pendingName)) as f:
+        pending = json.load(f)
+    value, label = load_raw(pending["rawDir"])
+    draw(saveDir, load(saveDir), value, label, pending["chipSize"], pending["maxPoints"])
+    os.remove(os.path.join(saveDir, pendingName))
+
+
+def render_pending(saveDirList, workers=1, timeout=600):
+    # 绘制这些目录中待绘制的诊断图：每个目录一个子进程，KPI_trainPool 限制同时运行的进程数并等待回收
+    # 绘图子进程只需要 matplotlib，threads=None 使其不导入 TensorFlow
+    # 返回 {目录: "ok" | "failed(exitcode)" | "timeout"}
+    import KPI_trainPool
+    pending = [saveDir for saveDir in saveDirList if os.path.exists(os.path.join(saveDir, pendingName))]
+    if len(pending) == 0:
+        return {}
+    return KPI_trainPool.train_all(pending, render_saved, workers=workers, timeout=timeout, threads=None)
+
+
+if __name__ == '__main__':
+    saveDir = sys.argv[1]
+    if len(sys.argv) == 2:
+        render_saved(saveDir)
+    else:
+        rawDir = sys.argv[2]
+        chipSize = int(sys.argv[3]) if len(sys.argv) > 3 else 3000
+        maxPoints = int(sys.argv[4]) if len(sys.argv) > 4 else 4000
+        value, label = load_raw(rawDir)
+        draw(saveDir, load(saveDir), value, label, chipSize, maxPoints)
@@ -1,21 +1,17 @@
 # 按照函数y_train=x_train*np.sin(x_train)生成函数
+# 预测路径只依赖 numpy：有 model.npz 时用纯 numpy 推理，只有 model.h5 时才导入 Keras（见 KPI_modelCache）
 import numpy as np
 
-import tensorflow as tf
-import matplotlib.pyplot as plt
-from keras.layers import Dense, Dropout
-import  pandas as pd
-from pandas import read_csv
-
-
-import pandas as pd
-from matplotlib import pyplot
-
 import os
 import time
 # import timedelta
 from datetime import datetime
 
+import KPI_feature
+import KPI_kpiConfig
+import KPI_metrics
+import KPI_modelCache
+
 
 
 # print(fileList)
@@ -40,23 +36,51 @@ def kpi_predict(kpiid, inputDataList,modelConfig):
 
     chipSize = 3000
 
-    from keras.models import load_model
-
-    thisTrainSaveDir=saveDirs+"/"+str(kpiid)+"/"
-    model_save_path = thisTrainSaveDir + "model.h5"
-
-    model = load_model(model_save_path)
+    model = KPI_modelCache.get_model(kpiid, modelConfig)
+    if model is None:
+        raise IOError("no model for " + str(kpiid) + ": " + KPI_modelCache.model_path(kpiid, modelConfig))
 
     tpList = inputDataList
-    stdd = np.std(tpList) * np.std(tpList)
-    mean = np.mean(tpList)
-    fws = np.percentile(tpList, STA_fws)
-
-
-    input_x = [[stdd,mean,fws]]
     unknown = np.array(
-        input_x
+        KPI_feature.features_of_windows([tpList], STA_fws)
         , dtype=np.float32)
-    predicted = model.predict(unknown)
+    with KPI_metrics.timer("inference", kpi=kpiid):
+        predicted = model.predict(unknown)
+    KPI_metrics.inc("rows_predicted_total", len(predicted), kpi=kpiid)
+    return predicted
+
+
+def kpi_predict_batch(kpiid, features, modelConfig):
+    # features 为 (n, 3) 的 [std*std, mean, fws]，一次 predict 返回 n 个得分
+    model = KPI_modelCache.get_model(kpiid, modelConfig)
+    if model is None:
+        raise IOError("no model for " + str(kpiid) + ": " + KPI_modelCache.model_path(kpiid, modelConfig))
+    unknown = np.asarray(features, dtype=np.float32)
+    if len(unknown) == 0:
+        return np.empty(0, dtype=np.float32)
+    with KPI_metrics.timer("inference", kpi=kpiid):
+        predicted = model.predict(unknown, batch_size=min(len(unknown), 8192), verbose=0)[:, 0]
+    KPI_metrics.inc("rows_predicted_total", len(predicted), kpi=kpiid)
     return predicted
 
+
+def kpi_predict_many(kpiidList, features, modelConfig):
+    # 多个 KPI 的待预测点一起处理：按 KPI 分组，每个 KPI 只调用一次 predict
+    # （分组模型中各 KPI 的标准化参数不同，也按 KPI 分别调用）
+    # kpiidList[i] 对应 features[i]；没有模型（或预测出错）的 KPI 得分为 nan，不影响其他 KPI；
+    # 各 KPI 按自己的参数（kpiConfig.json）检查模型
+    features = np.asarray(features, dtype=np.float32)
+    scores = np.full(len(kpiidList), np.nan, dtype=np.float32)
+    groups = {}  # KPI -> 行号
+    for i, kpiid in enumerate(kpiidList):
+        if kpiid not in groups:
+            groups[kpiid] = []
+        groups[kpiid].append(i)
+    for kpiid, rows in groups.items():
+        try:
+            scores[rows] = kpi_predict_batch(kpiid, features[rows], KPI_kpiConfig.config_for(kpiid, modelConfig))
+        except IOError as e:
+            print(str(e))
+        except Exception as e:
+            print("预测失败 " + str(kpiid) + ": " + str(e))
+    return scores
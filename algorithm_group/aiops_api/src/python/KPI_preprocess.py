@@ -0,0 +1,86 @@
+# 特征预处理：按 KPI 拟合的标准化参数（每个特征的均值、标准差）和特征窗口参数，
+# 训练时保存在 model.npz 中（见 KPI_npModel 的 extra），并在模型文件之后写入模型旁的 preprocess.json，
+# 预测时随模型一起加载，训练和预测使用同一套变换
+import json
+import os
+
+import numpy as np
+
+fileName = "preprocess.json"
+
+
+class Preprocessor(object):
+
+    def __init__(self, mean, std, left, right, fws):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.left = left
+        self.right = right
+        self.fws = fws
+
+    def transform(self, features):
+        return (np.asarray(features, dtype=np.float32) - self.mean) / self.std
+
+    def matches(self, modelConfig):
+        # 特征窗口参数改变后，模型需要重新训练才能使用
+        return [self.left, self.right, self.fws] == [modelConfig["STA_windowSize_left"],
+                                                     modelConfig["STA_windowSize_right"],
+                                                     modelConfig["STA_fws"]]
+
+    def to_dict(self):
+        return {"mean": self.mean.tolist(), "std": self.std.tolist(),
+                "left": self.left, "right": self.right, "fws": self.fws}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["mean"], data["std"], data["left"], data["right"], data["fws"])
+
+
+def fit(features, modelConfig):
+    # 用训练集拟合；标准差为 0（常数特征）时不缩放
+    features = np.asarray(features, dtype=np.float64)
+    mean = features.mean(axis=0)
+    std = features.std(axis=0)
+    std[~(std > 1e-12)] = 1
+    return Preprocessor(mean, std, modelConfig["STA_windowSize_left"], modelConfig["STA_windowSize_right"],
+                        modelConfig["STA_fws"])
+
+
+class PendingError(Exception):
+    # preprocess.json 对应的不是当前的模型文件：模型已经替换，新的 preprocess.json 还没有写入
+    pass
+
+
+def save(preprocessor, modelDir, modelPath=None):
+    # 在模型文件之后写入；modelPath 给出时记录该模型文件的修改时间，读取时据此判断两者是否属于同一次训练
+    data = preprocessor.to_dict()
+    if modelPath is not None:
+        data["modelMtime"] = os.stat(modelPath).st_mtime_ns
+    path = os.path.join(modelDir, fileName)
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+def load(modelDir, modelPath=None):
+    # 没有 preprocess.json（之前训练的模型）时返回 None，特征不做变换
+    # modelPath 给出、且 preprocess.json 记录的是另一个版本的模型文件时抛出 PendingError
+    try:
+        with open(os.path.join(modelDir, fileName)) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if modelPath is not None and "modelMtime" in data and data["modelMtime"] != os.stat(modelPath).st_mtime_ns:
+        raise PendingError(modelPath)
+    return Preprocessor.from_dict(data)
+
+
+class ScaledModel(object):
+    # 模型加上它的预处理，predict 接口与模型相同，输入为原始特征
+
+    def __init__(self, model, preprocessor):
+        self.model = model
+        self.preprocessor = preprocessor
+
+    def predict(self, x, batch_size=8192, verbose=0):
+        return self.model.predict(self.preprocessor.transform(x), batch_size=batch_size, verbose=verbose)
@@ -0,0 +1,132 @@
+# 多个预测进程分担 KPI：
+# - 一致性哈希：每个分片在哈希环上放 vnodes 个虚拟节点，KPI 表名哈希后顺时针找到的第一个节点即其所属分片；
+#   分片数从 n 变为 n+1 时只有约 1/(n+1) 的 KPI 换分片
+# - 租约（可选）：数据库中的 predict_lease 表（不以 kpi_ 开头，不会被当成 KPI 表）记录每个 KPI 当前的处理者和到期时间，
+#   分片数调整期间新旧进程的划分不一致时，同一个 KPI 也只有持有租约的进程会预测
+import bisect
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import KPI_db
+
+
+def hash_key(text):
+    # 不用 hash()：各进程的字符串哈希随机化，结果不一致
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+
+    def __init__(self, shardCount, vnodes=64):
+        self.shardCount = shardCount
+        points = sorted((hash_key("shard-" + str(shard) + "#" + str(v)), shard)
+                        for shard in range(shardCount) for v in range(vnodes))
+        self.keys = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+    def owner(self, name):
+        if self.shardCount <= 1:
+            return 0
+        position = bisect.bisect(self.keys, hash_key(name)) % len(self.keys)
+        return self.shards[position]
+
+
+class Shard(object):
+    # 本进程负责的分片：index 从 0 开始，count 为分片总数
+
+    def __init__(self, index=0, count=1, vnodes=64):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError("invalid shard %s/%s" % (index, count))
+        self.index = index
+        self.count = count
+        self.ring = HashRing(count, vnodes)
+
+    def owns(self, name):
+        return self.ring.owner(name) == self.index
+
+    def filter(self, names):
+        return [name for name in names if self.owns(name)]
+
+
+def default_owner(shard):
+    return socket.gethostname() + ":" + str(os.getpid()) + ":" + str(shard.index) + "/" + str(shard.count)
+
+
+class Leases(object):
+    # 租约按本机时间计算，ttl 应远大于预测间隔和各机器之间的时钟误差
+
+    def __init__(self, db_name=None, owner="", ttl=60, tableName="predict_lease", clock=time.time):
+        self.db_name = db_name
+        self.owner = owner
+        self.ttl = ttl
+        self.tableName = tableName
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.created = False
+
+    def db(self):
+        return KPI_db.get_database(self.db_name)
+
+    def ensure(self):
+        with self.lock:
+            if self.created:
+                return
+            self.db().execute("CREATE TABLE IF NOT EXISTS " + KPI_db.table(self.tableName) +
+                              " (`kpi` VARCHAR(191) NOT NULL PRIMARY KEY,"
+                              " `owner` VARCHAR(191) NOT NULL, `expires` DOUBLE NOT NULL)")
+            self.created = True
+
+    def claim(self, names):
+        # 续约自己持有的、接管已过期的、新建还没有租约的，返回本进程持有租约的 KPI（保持 names 的顺序）
+        if len(names) == 0:
+            return []
+        self.ensure()
+        db = self.db()
+        target = KPI_db.table(self.tableName)
+        now = self.clock()
+        held = set()
+        for start in range(0, len(names), KPI_db.updateChunkRows):
+            chunk = names[start:start + KPI_db.updateChunkRows]
+            marks = ", ".join(["%s"] * len(chunk))
+            db.execute("UPDATE " + target + " SET `owner` = %s, `expires` = %s"
+                       " WHERE `kpi` IN (" + marks + ") AND (`owner` = %s OR `expires` < %s)",
+                       [self.owner, now + self.ttl] + list(chunk) + [self.owner, now])
+            existing = db.query("SELECT `kpi`, `owner` FROM " + target + " WHERE `kpi` IN (" + marks + ")",
+                                tuple(chunk))
+            known = set()
+            for kpiName, owner in existing:
+                known.add(kpiName)
+                if owner == self.owner:
+                    held.add(kpiName)
+            for kpiName in chunk:
+                if kpiName not in known and self.insert(kpiName, now):
+                    held.add(kpiName)
+        return [name for name in names if name in held]
+
+    def insert(self, kpiName, now):
+        # 两个进程同时新建同一个 KPI 的租约时，主键冲突的一方放弃
+        try:
+            self.db().execute("INSERT INTO " + KPI_db.table(self.tableName) + " (`kpi`, `owner`, `expires`)"
+                              " VALUES (%s, %s, %s)", (kpiName, self.owner, now + self.ttl))
+            return True
+        except Exception as e:
+            if e.__class__.__name__ == "IntegrityError":
+                return False
+            raise
+
+    def release(self, names=None):
+        # 退出时释放本进程的租约，其他进程不必等到过期
+        if not self.created:
+            return 0
+        SQLstr = "DELETE FROM " + KPI_db.table(self.tableName) + " WHERE `owner` = %s"
+        if names is None:
+            return self.db().execute(SQLstr, (self.owner,))
+        released = 0
+        for start in range(0, len(names), KPI_db.updateChunkRows):
+            chunk = names[start:start + KPI_db.updateChunkRows]
+            released += self.db().execute(SQLstr + " AND `kpi` IN (" + ", ".join(["%s"] * len(chunk)) + ")",
+                                          [self.owner] + list(chunk))
+        return released
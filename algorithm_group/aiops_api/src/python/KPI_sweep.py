@@ -0,0 +1,281 @@
+# 参数搜索：为每个 KPI 在多组 窗口大小 / 分位数（以及 batch size、训练轮数）中选出检验数据上最好的一组，
+# 保存为 saveDirs/<kpi>/kpiConfig.json，之后的预测、每周训练和 KPI_backfill 自动使用（见 KPI_kpiConfig）
+# 1. 原始序列取自特征库（只从数据库读取新增的行），所有候选窗口的特征一次计算（KPI_feature.multi_window_features），
+#    保存在 saveDirs/<kpi>/sweep/，数据没有变化时下次直接复用
+# 2. 每个候选在独立子进程中训练（KPI_trainPool），划分与 kpi_train_model 相同：
+#    在训练集上选阈值，用没有参与训练的“新的数据”段打分
+# 3. 选出得分最高的候选写入 kpiConfig.json；参数与当前模型不同时用新参数重新训练正式模型
+# 用法（在本目录下运行，读取 KPIautoPredictConfig.ini）：
+#       python KPI_sweep.py all --lefts 10,20,40 --rights 0,5 --fws 0.5,5,50
+#       python KPI_sweep.py kpi_all_p95_hour --lefts 20,60 --batch-sizes auto,256 --workers 4 --no-publish
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import KPI_config
+import KPI_feature
+import KPI_featureStore
+import KPI_kpiConfig
+import KPI_preprocess
+import KPI_threshold
+import KPI_trainPool
+from KPI_config import modelConfig, tableIgnoreList
+
+manifestName = "candidates.json"
+
+
+def parse_list(text, cast):
+    # "10,20,40" -> [10, 20, 40]；b_size 的 auto 为 0
+    return [0 if item.strip() == "auto" else cast(item) for item in text.split(",") if item.strip() != ""]
+
+
+def candidates(lefts, rights, fwsList, batchSizes, epochsList):
+    return [{"STA_windowSize_left": left, "STA_windowSize_right": right, "STA_fws": fws,
+             "b_size": batchSize, "max_epochs": epochs}
+            for left in lefts for right in rights for fws in fwsList
+            for batchSize in batchSizes for epochs in epochsList if left + right > 0]
+
+
+def window_of(params):
+    return [params["STA_windowSize_left"], params["STA_windowSize_right"], params["STA_fws"]]
+
+
+def sweep_dir(kpiName, modelConfig):
+    return os.path.join(modelConfig["saveDirs"], str(kpiName), "sweep") + "/"
+
+
+def read_manifest(sweepDir):
+    try:
+        with open(sweepDir + manifestName) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def prepare(kpiName, chunks, candidateList, modelConfig):
+    # 更新特征库中的原始序列，计算（或复用）各候选窗口的特征；返回候选数，数据太少时返回 0
+    config = KPI_kpiConfig.config_for(kpiName, modelConfig)
+    featureStore = KPI_featureStore.store_for(kpiName, config)
+    featureStore.update_chunks(chunks)
+    if featureStore.rows() <= modelConfig["minTrainNum"]:
+        print("数据过少，不搜索 " + str(kpiName))
+        return 0
+    columns = featureStore.load()
+    lastId = int(columns["id"][-1])
+
+    sweepDir = sweep_dir(kpiName, modelConfig)
+    os.makedirs(sweepDir, exist_ok=True)
+    old = read_manifest(sweepDir)
+    windows = []
+    for params in candidateList:
+        if window_of(params) not in windows:
+            windows.append(window_of(params))
+    # 数据没有变化时复用已经算过的窗口（文件按窗口参数命名）
+    reuse = old is not None and old["lastId"] == lastId and old["rows"] == len(columns["id"])
+    known = old["windows"] if reuse else []
+    missing = [window for window in windows if window not in known]
+    start = time.perf_counter()
+    if len(missing) > 0:
+        computed = KPI_feature.multi_window_features(columns["value"], [tuple(window) for window in missing])
+        for window in missing:
+            positions, features = computed[tuple(window)]
+            np.save(sweepDir + window_file(window, "x"), features.astype(np.float32))
+            np.save(sweepDir + window_file(window, "y"),
+                    columns["label"][positions].astype(np.float32).reshape(-1, 1))
+    print("%s: %d 个候选，%d 组窗口（新计算 %d 组），%d 行，%.2f 秒" % (kpiName, len(candidateList), len(windows),
+                                                          len(missing), len(columns["id"]),
+                                                          time.perf_counter() - start))
+    manifest = {"kpi": str(kpiName), "lastId": lastId, "rows": len(columns["id"]),
+                "windows": known + missing, "candidates": candidateList,
+                "split": {"uu": modelConfig["uu"], "hRate": modelConfig["hRate"], "nRate": modelConfig["nRate"],
+                          "traintestRate": modelConfig["traintestRate"]},
+                "earlyStoppingPatience": modelConfig.get("earlyStoppingPatience", 0),
+                "thresholdStep": modelConfig.get("thresholdStep", 0.02)}
+    write_json(sweepDir + manifestName, manifest)
+    for i in range(len(candidateList)):
+        if os.path.exists(sweepDir + "result_" + str(i) + ".json"):
+            os.remove(sweepDir + "result_" + str(i) + ".json")
+    return len(candidateList)
+
+
+def window_file(window, kind):
+    return "%s_%d_%d_%s.npy" % (kind, window[0], window[1], repr(float(window[2])))
+
+
+def split_rows(x, y, manifest):
+    # 与 kpi_train_model 相同：[uu, uu+historyData_length) 中前 traintestRate 训练，其余验证；之后 newData_length 行检验
+    # 两段的长度按 uu 之后有特征的行数计算（KPI_modelTrain.split_lengths）
+    import KPI_modelTrain
+    split = manifest["split"]
+    uu = split["uu"]
+    historyData_length, newData_length = KPI_modelTrain.split_lengths(len(x), uu, split["hRate"], split["nRate"])
+    historyData_length = max(historyData_length, 0)
+    cut = uu + int(split["traintestRate"] * historyData_length)
+    end = uu + historyData_length
+    return (x[uu:cut], y[uu:cut]), (x[cut:end], y[cut:end]), (x[end:end + newData_length], y[end:end + newData_length])
+
+
+def train_candidate(task):
+    # 子进程入口：task 为 "<sweep 目录>#<候选编号>"，结果写到 sweep 目录下的 result_<编号>.json
+    import keras as K
+    import KPI_modelTrain
+
+    sweepDir, index = task.rsplit("#", 1)
+    manifest = read_manifest(sweepDir)
+    params = manifest["candidates"][int(index)]
+    window = window_of(params)
+    start = time.perf_counter()
+    x = np.load(sweepDir + window_file(window, "x"), mmap_mode="r")
+    y = np.load(sweepDir + window_file(window, "y"), mmap_mode="r")
+    (train_x, train_y), (val_x, val_y), (check_x, check_y) = split_rows(x, y, manifest)
+    preprocessor = KPI_preprocess.fit(train_x, {"STA_windowSize_left": window[0], "STA_windowSize_right": window[1],
+                                                "STA_fws": window[2]})
+    train_x = preprocessor.transform(train_x)
+    val_x = preprocessor.transform(val_x)
+    check_x = preprocessor.transform(check_x)
+    train_y = np.asarray(train_y)
+    val_y = np.asarray(val_y)
+    check_y = np.asarray(check_y)
+
+    model = KPI_modelTrain.build_model()
+    model.compile(loss='binary_crossentropy', optimizer=K.optimizers.Adam(), metrics=['accuracy'])
+    batchSize = params["b_size"] if params["b_size"] > 0 else KPI_modelTrain.auto_batch_size(len(train_x))
+    callbacks = []
+    if manifest["earlyStoppingPatience"] > 0:
+        callbacks.append(K.callbacks.EarlyStopping(monitor='val_loss', patience=manifest["earlyStoppingPatience"],
+                                                   restore_best_weights=True))
+    trainData = KPI_modelTrain.make_dataset(train_x, train_y, batchSize, True)
+    if trainData is None:
+        history = model.fit(train_x, train_y, batch_size=batchSize, epochs=params["max_epochs"],
+                            validation_data=(val_x, val_y), shuffle=True, callbacks=callbacks, verbose=0)
+    else:
+        history = model.fit(trainData, epochs=params["max_epochs"],
+                            validation_data=KPI_modelTrain.make_dataset(val_x, val_y, batchSize, False),
+                            callbacks=callbacks, verbose=0)
+
+    # 在训练集上选阈值（与 kpi_train_model 相同），在检验数据上按同一个阈值打分
+    threshold, trainScore = KPI_threshold.best_threshold(model.predict(train_x, verbose=0), train_y,
+                                                         manifest["thresholdStep"])
+    checkScore = None
+    if len(check_x) > 0:
+        checkScore = float(KPI_threshold.threshold_scores(model.predict(check_x, verbose=0), check_y, [threshold])[0])
+    valLoss = history.history.get("val_loss", [])
+    write_json(sweepDir + "result_" + index + ".json", {
+        "params": params, "threshold": threshold, "trainScore": trainScore, "checkScore": checkScore,
+        "valLoss": float(min(valLoss)) if len(valLoss) > 0 else None,
+        "epochs": len(history.history.get("loss", [])), "trainRows": len(train_x),
+        "seconds": time.perf_counter() - start})
+
+
+def read_results(sweepDir, count):
+    results = []
+    for i in range(count):
+        try:
+            with open(sweepDir + "result_" + str(i) + ".json") as f:
+                results.append(json.load(f))
+        except (IOError, ValueError):
+            pass
+    return results
+
+
+def rank_key(result):
+    # 检验得分高的在前；得分相同（例如检验数据中没有异常）时验证集 loss 低的在前，再相同时窗口小的在前
+    checkScore = result["checkScore"] if result["checkScore"] is not None else result["trainScore"]
+    valLoss = result["valLoss"] if result["valLoss"] is not None else float("inf")
+    params = result["params"]
+    return (-checkScore, valLoss, params["STA_windowSize_left"] + params["STA_windowSize_right"])
+
+
+def select(results):
+    if len(results) == 0:
+        return None
+    return sorted(results, key=rank_key)[0]
+
+
+def current_params(kpiName, modelConfig):
+    config = KPI_kpiConfig.config_for(kpiName, modelConfig)
+    return dict((name, config[name]) for name in KPI_kpiConfig.tunable)
+
+
+def run(names, candidateList, workers=2, publish=True, threads=1, timeout=7200):
+    # 返回 {kpiName: 选出的结果}；publish 时写入 kpiConfig.json，参数变化的 KPI 重新训练正式模型
+    import autoPredictKPI
+
+    if modelConfig.get("modelMode") == "grouped":
+        print("分组模型（modelMode=grouped）不使用单独的参数，不搜索")
+        return {}
+    prepared = []
+    for kpiName in names:
+        afterId = KPI_featureStore.store_for(kpiName, KPI_kpiConfig.config_for(kpiName, modelConfig)).last_id()
+        if prepare(kpiName, autoPredictKPI.iterHistoryChunks(kpiName, "aiops", afterId),
+                   candidateList, modelConfig) > 0:
+            prepared.append(kpiName)
+
+    tasks = [sweep_dir(kpiName, modelConfig) + "#" + str(i)
+             for kpiName in prepared for i in range(len(candidateList))]
+    KPI_trainPool.train_all(tasks, train_candidate, workers=workers, timeout=timeout, threads=threads)
+
+    selected = {}
+    retrain = []
+    for kpiName in prepared:
+        results = read_results(sweep_dir(kpiName, modelConfig), len(candidateList))
+        best = select(results)
+        write_json(sweep_dir(kpiName, modelConfig) + "summary.json",
+                   {"best": best, "results": sorted(results, key=rank_key)})
+        if best is None:
+            print(kpiName + ": 没有候选训练成功")
+            continue
+        selected[kpiName] = best
+        print("%s: 最优 %s，检验得分 %s（共 %d 个候选）" % (kpiName, json.dumps(best["params"]), best["checkScore"],
+                                                len(results)))
+        if not publish:
+            continue
+        changed = best["params"] != current_params(kpiName, modelConfig)
+        KPI_kpiConfig.save(kpiName, modelConfig, best["params"],
+                           {"checkScore": best["checkScore"], "valLoss": best["valLoss"],
+                            "candidates": len(results), "time": time.strftime("%Y-%m-%d %H:%M:%S")})
+        if changed:
+            retrain.append(kpiName)
+    if len(retrain) > 0:
+        # 正式模型按新参数完整训练（特征库参数变化后会重建）；训练完成前旧模型与新参数不一致，这些 KPI 暂停预测
+        KPI_trainPool.train_all(retrain, autoPredictKPI.trainOneKpi, workers=workers, timeout=timeout,
+                                threads=threads)
+        autoPredictKPI.renderPlots(retrain)
+    return selected
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="按 KPI 搜索窗口大小和分位数")
+    parser.add_argument("kpis", nargs="+", help="KPI 表名，或 all")
+    parser.add_argument("--lefts", default=str(modelConfig["STA_windowSize_left"]), help="左窗口，逗号分隔")
+    parser.add_argument("--rights", default=str(modelConfig["STA_windowSize_right"]), help="右窗口")
+    parser.add_argument("--fws", default=str(modelConfig["STA_fws"]), help="特征分位数")
+    parser.add_argument("--batch-sizes", default=str(modelConfig["b_size"] or "auto"), help="batch size，auto 为按数据量")
+    parser.add_argument("--epochs", default=str(modelConfig["max_epochs"]), help="最多训练轮数")
+    parser.add_argument("--workers", type=int, default=KPI_config.trainWorkers, help="同时训练的候选数（子进程数）")
+    parser.add_argument("--threads", type=int, default=KPI_config.trainThreads, help="每个子进程的 TensorFlow 线程数")
+    parser.add_argument("--no-publish", action="store_true", help="只输出结果，不写 kpiConfig.json")
+    parser.add_argument("--sqlite", help="用这个 SQLite 文件代替 MySQL（本地测试）")
+    args = parser.parse_args()
+    if args.sqlite:
+        # 环境变量让子进程也使用同一个替身库
+        os.environ["KPI_SQLITE"] = args.sqlite
+        KPI_config.sqlitePath = args.sqlite
+    candidateList = candidates(parse_list(args.lefts, int), parse_list(args.rights, int),
+                               parse_list(args.fws, float), parse_list(args.batch_sizes, int),
+                               parse_list(args.epochs, int))
+    names = args.kpis
+    if names == ["all"]:
+        import KPI_db
+        names = [name for name in KPI_db.get_database("aiops").list_tables()
+                 if name.startswith("kpi_") and name not in tableIgnoreList]
+    run(names, candidateList, args.workers, not args.no_publish, args.threads, KPI_config.trainTimeout)
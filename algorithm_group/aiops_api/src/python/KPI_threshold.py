@@ -0,0 +1,53 @@
+# 阈值搜索：得分排序一次后用累加和计算每个阈值下的 myscore，O(n log n)
+# myscore = 检出的异常数/异常总数 - 误报数/异常总数（与原 testTC 相同）
+import numpy as np
+
+
+def legacy_grid(step, startTC=0):
+    # 原 kpi_train_model 中的阈值序列：startTC + i*step, i = 1 .. int((1-startTC)/step)-1
+    return np.array([startTC + i * step for i in range(1, int((1 - startTC) / step))], dtype=np.float64)
+
+
+def threshold_scores(predicted, labels, thresholds):
+    # 返回每个阈值 tc 的 myscore，predicted > tc 判为异常，labels == 1 为真实异常
+    predicted = np.asarray(predicted).ravel()
+    if not np.issubdtype(predicted.dtype, np.floating):
+        predicted = predicted.astype(np.float64)
+    positive = np.asarray(labels).ravel() == 1
+    # 按得分本身的精度比较（模型输出为 float32），与 predicted > tc 一致
+    thresholds = np.asarray(thresholds, dtype=np.float64).astype(predicted.dtype)
+
+    order = np.argsort(predicted, kind="mergesort")
+    sortedScores = predicted[order]
+    # cumPositive[k]：得分最低的 k 个点中异常的个数
+    cumPositive = np.concatenate(([0], np.cumsum(positive[order])))
+    ytrue1num = cumPositive[-1]
+    if ytrue1num == 0:
+        return np.ones(len(thresholds), dtype=np.float64)
+
+    below = np.searchsorted(sortedScores, thresholds, side="right")  # 得分 <= tc 的个数
+    true1num = ytrue1num - cumPositive[below]
+    false1num = (len(predicted) - below) - true1num
+    return true1num / float(ytrue1num) - false1num / float(ytrue1num)
+
+
+def exact_grid(predicted):
+    # 所有可能的划分：以每个不同的得分为阈值（严格大于该得分判为异常）
+    return np.unique(np.asarray(predicted).ravel())
+
+
+def best_threshold(predicted, labels, step=0.02, startTC=0):
+    # step > 0 时在 startTC + i*step 上搜索（与原实现相同），step <= 0 时求精确最优
+    # 返回 (阈值, 得分)；与原实现一样只接受严格大于 0 的得分，否则返回 (startTC, 0)
+    if step > 0:
+        grid = legacy_grid(step, startTC)
+    else:
+        grid = exact_grid(predicted)
+        grid = grid[grid > startTC]
+    if len(grid) == 0:
+        return startTC, 0
+    scores = threshold_scores(predicted, labels, grid)
+    best = int(np.argmax(scores))
+    if scores[best] <= 0:
+        return startTC, 0
+    return float(grid[best]), float(scores[best])
@@ -0,0 +1,99 @@
+# 每周训练的进程池：每个 KPI 在独立子进程中训练，限制并发数、TensorFlow 线程数和单个 KPI 的训练时长
+import contextlib
+import importlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+
+# 检查子进程状态的间隔（秒）
+pollInterval = 1
+
+environLock = threading.Lock()
+
+
+def thread_environ(threads):
+    return {"OMP_NUM_THREADS": str(threads),
+            "TF_NUM_INTRAOP_THREADS": str(threads),
+            "TF_NUM_INTEROP_THREADS": str(threads)}
+
+
+@contextlib.contextmanager
+def child_environ(values):
+    # spawn 启动的子进程在启动时复制当前环境变量：启动期间临时设置，子进程的解释器从一开始就带着线程数限制，
+    # 早于还原 __main__、导入 target 所在模块（numpy、TensorFlow）
+    with environLock:
+        saved = dict((name, os.environ.get(name)) for name in values)
+        os.environ.update(values)
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+
+
+def set_thread_limits(threads):
+    # 必须在导入 TensorFlow 之前设置
+    os.environ.update(thread_environ(threads))
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    except (ImportError, RuntimeError):
+        pass
+
+
+def run_task(moduleName, functionName, kpiName, threads):
+    # 子进程入口：先限制线程数，再按名字导入 target（传函数对象时，参数反序列化就会先导入它所在的模块）
+    # threads 为 None 时不是训练任务（例如绘图），不设置线程数，也不导入 TensorFlow
+    if threads is not None:
+        set_thread_limits(threads)
+    try:
+        target = getattr(importlib.import_module(moduleName), functionName)
+        target(kpiName)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+
+
+def train_all(kpiNameList, target, workers=2, timeout=7200, threads=1):
+    # target(kpiName) 在子进程中执行，必须是模块级函数（spawn 方式需要能按名字找到）
+    # threads=None 用于不需要 TensorFlow 的任务：子进程不设置线程数环境变量，也不导入 TensorFlow
+    # 返回 {kpiName: "ok" | "failed(exitcode)" | "timeout"}
+    ctx = multiprocessing.get_context("spawn")
+    waiting = list(kpiNameList)
+    running = {}  # kpiName -> (process, 开始时间)
+    results = {}
+    while len(waiting) > 0 or len(running) > 0:
+        while len(waiting) > 0 and len(running) < workers:
+            kpiName = waiting.pop(0)
+            process = ctx.Process(target=run_task, args=(target.__module__, target.__name__, kpiName, threads),
+                                  name="train-" + kpiName)
+            process.daemon = True
+            with child_environ(thread_environ(threads) if threads is not None else {}):
+                process.start()
+            running[kpiName] = (process, time.time())
+
+        time.sleep(pollInterval)
+        for kpiName, (process, startTime) in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                if process.exitcode == 0:
+                    results[kpiName] = "ok"
+                else:
+                    results[kpiName] = "failed(%s)" % process.exitcode
+            elif time.time() - startTime > timeout:
+                process.terminate()
+                process.join()
+                results[kpiName] = "timeout"
+            else:
+                continue
+            del running[kpiName]
+            print("训练结束 " + kpiName + ": " + results[kpiName] +
+                  "，用时 " + str(int(time.time() - startTime)) + " 秒")
+    return results
@@ -0,0 +1,117 @@
+# 每个 KPI 常驻内存的滑动窗口，新数据到达时增量更新，预测时不再回查历史数据
+import bisect
+import collections
+import math
+
+
+class SlidingWindow(object):
+    # 定长窗口：维护和、平方和与有序表，方差和均值 O(1)，分位数 O(log w) 查找
+
+    # 每推入这么多个点按窗口重新求和，消除累计的浮点误差
+    refreshEvery = 4096
+
+    def __init__(self, size):
+        self.size = size
+        self.values = collections.deque()
+        self.sorted = []
+        self.shift = 0.0  # 以窗口内的某个值为基准累加，减小平方和的抵消误差
+        self.sum = 0.0
+        self.sumSq = 0.0
+        self.pushed = 0
+
+    def push(self, value):
+        value = float(value)
+        if len(self.values) == 0:
+            self.shift = value
+        if len(self.values) == self.size:
+            old = self.values.popleft()
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+            d = old - self.shift
+            self.sum -= d
+            self.sumSq -= d * d
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+        d = value - self.shift
+        self.sum += d
+        self.sumSq += d * d
+
+        self.pushed += 1
+        if self.pushed % self.refreshEvery == 0:
+            self.refresh()
+
+    def refresh(self):
+        self.shift = self.sorted[len(self.sorted) // 2]
+        self.sum = 0.0
+        self.sumSq = 0.0
+        for value in self.values:
+            d = value - self.shift
+            self.sum += d
+            self.sumSq += d * d
+
+    def full(self):
+        return len(self.values) == self.size
+
+    def features(self, fws):
+        # 与 KPI_feature.features_of_windows 相同：[std*std, mean, fws 分位数]
+        n = len(self.values)
+        mean = self.sum / n
+        var = max(self.sumSq / n - mean * mean, 0.0)
+        # np.percentile 默认的线性插值
+        pos = fws / 100.0 * (n - 1)
+        lo = int(math.floor(pos))
+        hi = min(lo + 1, n - 1)
+        quantile = self.sorted[lo] + (self.sorted[hi] - self.sorted[lo]) * (pos - lo)
+        return [var, mean + self.shift, quantile]
+
+
+class KpiWindowState(object):
+    # 一个 KPI 表的窗口状态：点 i 的窗口为 [i-left, i+right)，与训练时的特征一致
+    # right > 0 时点 i 要等到 i+right-1 到达后才能算特征
+
+    def __init__(self, left, right, fws, historyNum):
+        self.left = left
+        self.right = right
+        self.fws = fws
+        self.historyNum = historyNum  # 之前至少有这么多行的点才预测
+        self.window = SlidingWindow(left + right)
+        self.waiting = collections.deque()  # (id, 是否需要预测)
+        self.lastId = None
+        self.seen = 0  # 已经过的行数（只需判断是否达到 historyNum）
+
+    def matches(self, left, right, fws, historyNum):
+        return (self.left, self.right, self.fws, self.historyNum) == (left, right, fws, historyNum)
+
+    def push(self, rowId, value, pending):
+        # 推入一行，返回 (id, features) 表示某个待预测点的特征已就绪，否则返回 None
+        scorable = pending and self.seen >= self.historyNum
+        self.seen += 1
+        self.lastId = rowId
+        if self.right == 0:
+            result = None
+            if scorable and self.window.full():
+                result = (rowId, self.window.features(self.fws))
+            self.window.push(value)
+            return result
+
+        self.window.push(value)
+        self.waiting.append((rowId, scorable))
+        if len(self.waiting) < self.right:
+            return None
+        waitId, waitScorable = self.waiting.popleft()
+        if waitScorable and self.window.full():
+            return (waitId, self.window.features(self.fws))
+        return None
+
+    def restore(self, ids, values, scorable, seen):
+        # 用一段连续读取的数据（按 id 升序，已经批量算过特征）初始化状态
+        self.window = SlidingWindow(self.left + self.right)
+        for value in values[max(len(values) - self.window.size, 0):]:
+            self.window.push(value)
+        self.waiting = collections.deque()
+        if self.right > 1:
+            start = max(len(ids) - (self.right - 1), 0)
+            for i in range(start, len(ids)):
+                self.waiting.append((int(ids[i]), bool(scorable[i])))
+        if len(ids) > 0:
+            self.lastId = int(ids[-1])
+        self.seen = seen
@@ -1,124 +1,81 @@
+import argparse
+import asyncio
 import logging
+import os
 import pytz
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.schedulers.blocking import BlockingScheduler
-import mysql.connector
-
-import KPI_modelTrain
+import numpy as np
+
+import KPI_config
+import KPI_db
+import KPI_discovery
+import KPI_fallback
+import KPI_feature
+import KPI_featureStore
+import KPI_kpiConfig
+import KPI_metrics
+import KPI_modelCache
+import KPI_plot
 import KPI_predict
+import KPI_shard
+import KPI_trainPool
+import KPI_window
 
-import configparser
-cf = configparser.ConfigParser()
-cf.read("KPIautoPredictConfig.ini")
-secs = cf.sections()
-# print(secs)
-print(cf.get("modelconfig", "minTrainNum"))
-
-
-
-HOST =cf.get("database", "HOST")
-USERNAME = cf.get("database", "USERNAME")
-PASSWORD = str(cf.get("database", "PASSWORD"))
-
-
-DB_NAME=cf.get("database", "DB_NAME")
-PredictKPIList=cf.get("predictconfig", "PredictKPIList")
-modelDir=cf.get("modelconfig", "modelDir")
-
-tableIgnoreList=cf.get("predictconfig", "tableIgnoreList").split(",")
-
-modelConfig = {
-    "minTrainNum":int(cf.get("modelconfig", "minTrainNum")),
-    "minPredictNum":int(cf.get("modelconfig", "minPredictNum")),
-    "saveDirs": cf.get("modelconfig", "saveDirs"),
-    "uu": int(cf.get("modelconfig", "uu")),  # 起始位置
-    "hRate":float(cf.get("modelconfig", "hRate") )  ,  # 历史数据集大小
-    "nRate": float(cf.get("modelconfig", "nRate") ),  # 实时数据集大小（用于检验
-
-    "traintestRate": float(cf.get("modelconfig", "traintestRate") ),  # 划分train test比例
-    "max_epochs": int(cf.get("modelconfig", "max_epochs")),  # 训练次数
-    "b_size": int(cf.get("modelconfig", "b_size")),  # batch_size每批数量
-
-    "STA_windowSize_left": int(cf.get("modelconfig", "STA_windowSize_left")),  # 特征提取窗口大小
-    "STA_windowSize_right": int(cf.get("modelconfig", "STA_windowSize_right")),
-    "STA_fws": float(cf.get("modelconfig", "STA_fws") ),  # 特征提取分位数
-
-}
+from KPI_config import DB_NAME, \
+    tableIgnoreList, maxBatchSize, tickMode, tickConcurrency, tableRefreshInterval, changeTracking, fallbackEnabled, \
+    historyChunkSize, modelConfig, \
+    trainWorkers, trainThreads, trainTimeout, plotWorkers, metricsPort, metricsHost, metricsLog, \
+    shardIndex, shardCount, shardVnodes, leaseEnabled, leaseTtl, leaseTable
+# 训练子进程也会导入本模块，阶段日志写到同一个文件
+KPI_metrics.configure_log(metricsLog)
 
 
 def read_database(db_name: str, table_name: str):
-    conn = mysql.connector.connect(host=HOST,
-                                   user=USERNAME,
-                                   password=PASSWORD,
-                                   database=db_name)
-    # 数据库 handle
-    cursor = conn.cursor()
-
-    cursor.execute('SELECT * FROM {0};'.format(table_name))
-    values = cursor.fetchall()
+    values = KPI_db.get_database(db_name).query('SELECT * FROM {0};'.format(KPI_db.table(table_name)))
 
     logging.info('read from `%s`.`%s`, size of result set: %d' % (db_name, table_name, len(values)))
     # print(values)
 
-    cursor.close()
-    conn.close()
-
     return values
 
-def write_database(db_name: str, table_name: str, records):
-    conn = mysql.connector.connect(host=HOST,
-                                   user=USERNAME,
-                                   password=PASSWORD,
-                                   database=db_name)
-    cursor = conn.cursor()
+def write_database(db_name: str, table_name: str, records, columns):
+    # 将 records 中的元组全部插入表中（同一个事务，死锁时重试），columns 为对应的列名
+    count = KPI_db.get_database(db_name).insert_rows(table_name, columns, records)
+    logging.info('write to `%s`.`%s`, number of records: %d' % (db_name, table_name, len(records)))
+    return count
 
-    # 将 records 中的元组全部插入表中
-    cursor.executemany('INSERT INTO {0} (first_name, last_name, last_update) VALUES (%s, %s, now());'.format(table_name),
-                       records)
-    if cursor.rowcount != len(records):
-        logging.error("FAILED to insert all records")
-    conn.commit()
+# 表名列表缓存 tableRefreshInterval 秒；每次 tick 用一条 MAX(id) 查询找出有新数据的表
+tableDiscovery = KPI_discovery.TableDiscovery(DB_NAME, "kpi_", tableRefreshInterval)
+watermarks = KPI_discovery.Watermarks()
 
-    logging.info('write to `%s`.`%s`, number of records: %d' % (db_name, table_name, len(records)))
+def getAllKpiName(refresh=False):
+    return tableDiscovery.tables(refresh)
+
+# 多个预测进程分担 KPI（见 KPI_shard）：本进程只处理一致性哈希分到自己分片的 KPI，
+# leases 不为 None 时还要先取得该 KPI 的租约
+shard = None
+leases = None
+ownedKpis = set()
 
-    cursor.close()
-    conn.close()
-
-def getAllKpiName():
-    conn = mysql.connector.connect(host=HOST,
-                                   user=USERNAME,
-                                   password=PASSWORD,
-                                   database=DB_NAME)
-    # 数据库 handle
-    cursor = conn.cursor()
-
-    cursor.execute('SHOW TABLES' )
-    values = cursor.fetchall()
-    kpinameList=[]
-    for tableName in values:
-        tableName=tableName[0]
-        # print(tableName)
-        if tableName.startswith("kpi_"):
-            kpinameList.append(tableName)
-
-
-    # print(len(values))
-    # print(len(kpinameList))
-    # print( kpinameList )
-
-    cursor.close()
-    conn.close()
-    return kpinameList
+def configureShard(index, count, lease=False):
+    global shard, leases
+    shard = KPI_shard.Shard(index, count, shardVnodes)
+    leases = None
+    if lease:
+        leases = KPI_shard.Leases(DB_NAME, KPI_shard.default_owner(shard), leaseTtl, leaseTable)
+
+configureShard(shardIndex, shardCount, leaseEnabled)
 def generateDataFrame(datalist):
 
     # print(datalist)
     import pandas as pd
     df = pd.DataFrame(datalist)
-    print(df)
     if len(df)==0:
         return None
 
@@ -126,86 +83,213 @@ def generateDataFrame(datalist):
     # print (type(datalist[0][2]))
     return df
 
+def kpiConfig(kpiName):
+    # 该 KPI 的参数：参数搜索保存了 kpiConfig.json 时覆盖全局参数（见 KPI_kpiConfig）
+    return KPI_kpiConfig.config_for(kpiName, modelConfig)
+
+def getHistoryNum(kpiName=None):
+    # 一个点至少需要之前这么多行才会被预测
+    config = modelConfig if kpiName == None else kpiConfig(kpiName)
+    return max(config["STA_windowSize_left"], config["minPredictNum"])
+
 def getLatestOnePieceData(kpiName,db_name):
-    # defaultPredict=str(defaultPredict)
-    SQLstr="select id,value,time,predict FROM "+kpiName+" WHERE predict  is  null ORDER BY time   limit 1 "
+    # 最早的一个可预测（之前已有足够历史）且尚未预测的点
+    historyNum = getHistoryNum(kpiName)
+    table = KPI_db.table(kpiName)
+    SQLstr="select id FROM "+table+" WHERE predict  is  null"
+    params = ()
+    if historyNum > 0:
+        SQLstr += " AND id >= (select id FROM "+table+" ORDER BY id limit %s, 1)"
+        params = (historyNum,)
+    SQLstr += " ORDER BY id   limit 1 "
     # print (SQLstr)
-    conn = mysql.connector.connect(host=HOST,
-                                   user=USERNAME,
-                                   password=PASSWORD,
-                                   database=db_name)
-    # 数据库 handle
-    cursor = conn.cursor()
-
-    cursor.execute(SQLstr)
-    values = cursor.fetchall()
+    value = KPI_db.get_database(db_name).query_one(SQLstr, params)
     # //logging.info('read from `%s`.`%s`, size of result set: %d' % (db_name, kpiName, len(values)))
-    # print(values)
-    if len(values) == 0:
+    if value == None:
         return None
 
-    targetID=values[0][0]
+    targetID=value[0]
     return  targetID
 
-def getReleatedData(kpiName,db_name,dataid):
+def getPendingBlock(kpiName,db_name,firstId,maxBatch):
+    # 一次连续读取：firstId 之前 historyNum 行作为窗口上下文，之后最多 maxBatch 个待预测点（另加右窗口）
+    historyNum = getHistoryNum(kpiName)
+    table = KPI_db.table(kpiName)
+    limit = historyNum + maxBatch + kpiConfig(kpiName)["STA_windowSize_right"]
+    if historyNum > 0:
+        SQLstr = "select id,value,time,predict FROM " + table + " WHERE id >= " + \
+                 "COALESCE((select id FROM " + table + " WHERE id < %s ORDER BY id DESC limit %s, 1), " + \
+                 "(select MIN(id) FROM " + table + ")) ORDER BY id limit %s"
+        params = (firstId, historyNum - 1, limit)
+    else:
+        SQLstr = "select id,value,time,predict FROM " + table + " WHERE id >= %s ORDER BY id limit %s"
+        params = (firstId, limit)
+    return KPI_db.get_database(db_name).query(SQLstr, params)
+
+# 每个 KPI 表的内存窗口状态，首次访问时从数据库预热一次
+windowStates = {}
+
+def newWindowState(kpiName):
+    config = kpiConfig(kpiName)
+    return KPI_window.KpiWindowState(config["STA_windowSize_left"],
+                                     config["STA_windowSize_right"],
+                                     config["STA_fws"],
+                                     getHistoryNum(kpiName))
+
+def getNewRows(kpiName,db_name,lastId,maxBatch):
+    table = KPI_db.table(kpiName)
+    if lastId == None:
+        SQLstr = "select id,value,time,predict FROM " + table + " ORDER BY id limit %s"
+        params = (maxBatch,)
+    else:
+        SQLstr = "select id,value,time,predict FROM " + table + " WHERE id > %s ORDER BY id limit %s"
+        params = (lastId, maxBatch)
+    return KPI_db.get_database(db_name).query(SQLstr, params)
+
+def warmUpWindowState(kpiName,db_name,maxBatch):
+    # 预热：积压的待预测点一次连续读取、批量计算特征，然后用读到的末尾数据初始化窗口
+    config = kpiConfig(kpiName)
+    state = newWindowState(kpiName)
+    windowStates[kpiName] = state
+    with KPI_metrics.timer("read", kpi=kpiName, phase="warmup"):
+        firstId = getLatestOnePieceData(kpiName, db_name)
+        if firstId == None:
+            # 没有待预测的点，只读表尾用来填充窗口
+            tailNum = max(getHistoryNum(kpiName), state.window.size)
+            block = KPI_db.get_database(db_name).query(
+                "select id,value,time,predict FROM " + KPI_db.table(kpiName) + " ORDER BY id DESC limit %s", (tailNum,))
+            block.reverse()
+        else:
+            block = getPendingBlock(kpiName, db_name, firstId, maxBatch)
+    KPI_metrics.inc("rows_read_total", len(block), kpi=kpiName, source="tick")
+    if firstId == None:
+        state.restore([row[0] for row in block], [row[1] for row in block], [False] * len(block), len(block))
+        return None
 
-    # print (SQLstr)
-    conn = mysql.connector.connect(host=HOST,
-                                   user=USERNAME,
-                                   password=PASSWORD,
-                                   database=db_name)
-    # 数据库 handle
-    cursor = conn.cursor()
-
-    SQLstr = "select id,value,time,predict FROM " + kpiName + " WHERE id <= " + str(
-        dataid) + " ORDER BY id  DESC limit " + str(modelConfig["STA_windowSize_left"])
-    cursor.execute(SQLstr)
-    values = cursor.fetchall()
-    if len(values) <= modelConfig["minPredictNum"]:
+    ids = np.array([row[0] for row in block], dtype=np.int64)
+    values = np.array([row[1] for row in block], dtype=np.float64)
+    # block 开头不足 historyNum 行时说明已到表头，这些点历史不够
+    scorable = np.array([row[3] is None for row in block], dtype=bool) & (ids >= firstId)
+    # firstId 之后的点之前都至少有 historyNum 行
+    with KPI_metrics.timer("features", kpi=kpiName, phase="warmup"):
+        state.restore(ids, values, scorable, getHistoryNum(kpiName))
+        positions, features = KPI_feature.window_features(values,
+                                                          config["STA_windowSize_left"],
+                                                          config["STA_windowSize_right"],
+                                                          config["STA_fws"])
+    keep = scorable[positions]
+    if not keep.any():
         return None
-    cursor.close()
-    conn.close()
-    return generateDataFrame(values)["value"].tolist()
-def setPredict(kpiName,db_name,dataid,predict):
+    return ids[positions[keep]], features[keep]
+
+def getPendingFeatures(kpiName,db_name,maxBatch):
+    # 返回 (ids, features)：该表新到达的（最多约 maxBatch 个）待预测点及其窗口特征
+    state = windowStates.get(kpiName)
+    config = kpiConfig(kpiName)
+    if state == None or not state.matches(config["STA_windowSize_left"],
+                                          config["STA_windowSize_right"],
+                                          config["STA_fws"],
+                                          getHistoryNum(kpiName)):
+        return warmUpWindowState(kpiName, db_name, maxBatch)
+
+    with KPI_metrics.timer("read", kpi=kpiName, phase="incremental"):
+        rows = getNewRows(kpiName, db_name, state.lastId, maxBatch)
+    KPI_metrics.inc("rows_read_total", len(rows), kpi=kpiName, source="tick")
+    ids = []
+    features = []
+    with KPI_metrics.timer("features", kpi=kpiName, phase="incremental"):
+        for row in rows:
+            ready = state.push(row[0], row[1], row[3] is None)
+            if ready != None:
+                ids.append(ready[0])
+                features.append(ready[1])
+    if len(ids) == 0:
+        return None
+    return np.array(ids, dtype=np.int64), np.array(features, dtype=np.float64)
+
+# 还没有模型的 KPI 的在线检测器（见 KPI_fallback），模型生成后丢弃
+fallbackStates = {}
+
+def getFallbackScores(kpiName,db_name,maxBatch):
+    # 返回 (ids, scores)：与 getPendingFeatures 读取相同的行，由在线检测器逐点打分
+    detector = fallbackStates.get(kpiName)
+    phase = "incremental"
+    config = kpiConfig(kpiName)
+    if detector == None or not KPI_fallback.matches(detector, config, getHistoryNum(kpiName)):
+        detector = KPI_fallback.detector_for(config, getHistoryNum(kpiName))
+        fallbackStates[kpiName] = detector
+        phase = "warmup"
+    with KPI_metrics.timer("read", kpi=kpiName, phase=phase):
+        if phase == "incremental":
+            rows = getNewRows(kpiName, db_name, detector.lastId, maxBatch)
+        else:
+            firstId = getLatestOnePieceData(kpiName, db_name)
+            if firstId == None:
+                # 没有待预测的点，用表尾预热
+                rows = KPI_db.get_database(db_name).query(
+                    "select id,value,time,predict FROM " + KPI_db.table(kpiName) + " ORDER BY id DESC limit %s",
+                    (getHistoryNum(kpiName),))
+                rows.reverse()
+            else:
+                rows = getPendingBlock(kpiName, db_name, firstId, maxBatch)
+    KPI_metrics.inc("rows_read_total", len(rows), kpi=kpiName, source="tick")
+    ids = []
+    scores = []
+    with KPI_metrics.timer("inference", kpi=kpiName, model="fallback"):
+        for row in rows:
+            score = detector.push(row[0], row[1])
+            if score != None and row[3] is None:
+                ids.append(row[0])
+                scores.append(score)
+    KPI_metrics.inc("rows_predicted_total", len(ids), kpi=kpiName, model="fallback")
+    if len(ids) == 0:
+        return None
+    return np.array(ids, dtype=np.int64), np.array(scores, dtype=np.float32)
 
-    # print (SQLstr)
-    conn = mysql.connector.connect(host=HOST,
-                                   user=USERNAME,
-                                   password=PASSWORD,
-                                   database=db_name)
-    # 数据库 handle
-    cursor = conn.cursor()
-
-    SQLstr = "UPDATE  " + kpiName + "SET  predict = "+  str(predict)+  " WHERE id  = " + str( dataid)
-    cursor.execute(SQLstr)
-    # values = cursor.fetchall()
-    print("成功更新")
-    cursor.close()
-    conn.close()
+def setPredict(kpiName,db_name,dataid,predict):
+    setPredictList(kpiName, db_name, [(dataid, predict)])
+    return
+def setPredictList(kpiName,db_name,idPredictList):
+    # 同一张表的预测结果在一个事务中写回
+    # 每张表一条 UPDATE ... CASE（每 KPI_db.updateChunkRows 行一条），写回开销与表数成正比
+    with KPI_metrics.timer("write", kpi=kpiName):
+        KPI_db.get_database(db_name).update_by_id(kpiName, "predict",
+                                                  [(int(dataid), float(predict)) for dataid, predict in idPredictList])
+    KPI_metrics.inc("rows_written_total", len(idPredictList), kpi=kpiName)
+    print("成功更新 " + str(kpiName) + " " + str(len(idPredictList)))
     return
 
 
-def getAllHistoryData(kpiName,db_name):
-    defaultPredict=-1
-    defaultPredict=str(defaultPredict)
-    SQLstr="select id,value,time,predict  FROM "+kpiName+" WHERE predict is not null ORDER BY time   DESC "
-    # print (SQLstr)
-    conn = mysql.connector.connect(host=HOST,
-                                   user=USERNAME,
-                                   password=PASSWORD,
-                                   database=db_name)
-    # 数据库 handle
-    cursor = conn.cursor()
-    cursor.execute(SQLstr)
-    values = cursor.fetchall()
-    print(values)
-    if len(values)<=modelConfig["minTrainNum"]:
-        return None
-    cursor.close()
-    conn.close()
-
-    return values
-
+def iterHistoryChunks(kpiName,db_name,afterId=None,chunkSize=None):
+    # 按 id 分页（id > 上一块最后的 id）读取已标注的历史数据，每块转成定长类型的数组
+    # 每次只持有一块数据，内存占用与表的大小无关
+    if chunkSize == None:
+        chunkSize = historyChunkSize
+    table = KPI_db.table(kpiName)
+    db = KPI_db.get_database(db_name)
+    lastId = afterId
+    while True:
+        with KPI_metrics.timer("read", kpi=kpiName, phase="history"):
+            if lastId == None:
+                values = db.query("select id,value,time,predict FROM " + table +
+                                  " WHERE predict is not null ORDER BY id limit %s", (chunkSize,))
+            else:
+                values = db.query("select id,value,time,predict FROM " + table +
+                                  " WHERE predict is not null AND id > %s ORDER BY id limit %s", (lastId, chunkSize))
+        KPI_metrics.inc("rows_read_total", len(values), kpi=kpiName, source="history")
+        if len(values) == 0:
+            return
+        chunk = {
+            'id': np.array([row[0] for row in values], dtype=np.int64),
+            'value': np.array([row[1] for row in values], dtype=np.float64),
+            'time': np.array([row[2] for row in values], dtype='datetime64[us]'),
+            'label': np.array([row[3] for row in values], dtype=np.float64),
+        }
+        del values
+        lastId = int(chunk['id'][-1])
+        yield chunk
+        if len(chunk['id']) < chunkSize:
+            return
 
 def string2timestamp(strValue):
     import  datetime
@@ -228,54 +312,359 @@ def string2timestamp(strValue):
     return timeStamp
 
 
-def every_ten_seconds():
-
-    time.sleep(2)
-    print("当前时间： ",str ( time.strftime('%Y.%m.%d %H:%M:%S ', time.localtime(time.time())) ) )
-    kpiNameList = getAllKpiName()
-    for kpiName in kpiNameList:
+def predictableKpiNames():
+    kpiNameList = []
+    fallbackKpis = set()
+    for kpiName in shard.filter(getAllKpiName()):
         if kpiName  in tableIgnoreList:
             continue
-        targetID=getLatestOnePieceData(kpiName, "aiops")
-        if targetID==None:
-            print("数据过少，跳过 " + str(kpiName))
+        if not KPI_modelCache.has_model(kpiName, modelConfig):
+            if not fallbackEnabled:
+                # 还没有模型时不推进窗口状态，等模型生成后再处理这些点
+                continue
+            if kpiName in windowStates:
+                # 模型被删除：改用在线检测器，从第一个未预测的点重新开始
+                dropState(kpiName)
+            fallbackKpis.add(kpiName)
+        elif kpiName in fallbackStates:
+            # 模型已生成：丢弃在线检测器，之后的点由模型预测
+            dropState(kpiName)
+        kpiNameList.append(kpiName)
+    kpiNameList = claimKpis(kpiNameList)
+    fallbackKpiSet.clear()
+    fallbackKpiSet.update(fallbackKpis)
+    KPI_metrics.set_gauge("kpi_tables_fallback", len(fallbackKpis))
+    # 一条查询取各表的 MAX(id)，只访问比已处理水位新的表（changeTracking=false 时访问全部）
+    with KPI_metrics.timer("discover"):
+        changed = watermarks.changed(KPI_discovery.max_ids(KPI_db.get_database(DB_NAME), kpiNameList))
+    KPI_metrics.set_gauge("kpi_tables", len(kpiNameList))
+    KPI_metrics.set_gauge("kpi_tables_changed", len(changed))
+    if not changeTracking:
+        return kpiNameList
+    return changed
+
+
+def claimKpis(kpiNameList):
+    # 启用租约时只保留取得租约的 KPI；不再由本进程处理的 KPI 丢弃窗口状态，
+    # 以后重新分到本进程时从数据库重新预热，不会重复预测别的进程已经写回的点
+    if leases != None:
+        with KPI_metrics.timer("lease"):
+            kpiNameList = leases.claim(kpiNameList)
+    for kpiName in ownedKpis - set(kpiNameList):
+        dropState(kpiName)
+    ownedKpis.clear()
+    ownedKpis.update(kpiNameList)
+    KPI_metrics.set_gauge("kpi_tables_owned", len(kpiNameList))
+    return kpiNameList
+
+
+# 本次 tick 中由在线检测器打分的 KPI
+fallbackKpiSet = set()
+
+
+def markHandled(kpiName):
+    # 这张表已读到窗口状态（或在线检测器）的 lastId，之后 MAX(id) 不变就不再访问；积压的行数按水位估计
+    state = windowStates.get(kpiName)
+    if state == None:
+        state = fallbackStates.get(kpiName)
+    if state == None or state.lastId == None:
+        watermarks.forget(kpiName)
+        return
+    watermarks.mark(kpiName, state.lastId)
+    backlog = watermarks.backlog(kpiName)
+    if backlog != None:
+        KPI_metrics.set_gauge("backlog_rows", backlog, kpi=kpiName)
+
+
+def dropState(kpiName):
+    # 丢弃窗口状态，下次重新预热（水位一起清除，下次一定访问）
+    windowStates.pop(kpiName, None)
+    fallbackStates.pop(kpiName, None)
+    watermarks.forget(kpiName)
+
+
+def writeBack(kpiName, idPredictList):
+    try:
+        setPredictList(kpiName, DB_NAME, idPredictList)
+    except Exception as e:
+        # 写回失败时丢弃窗口状态，下次重新预热并重试这些点
+        print("写回失败 " + str(kpiName) + ": " + str(e))
+        dropState(kpiName)
+        return
+    markHandled(kpiName)
+    print(str(kpiName)+"预测 "+str(len(idPredictList))+" 个点，最新为："+str(idPredictList[-1][1]))
+
+
+def tickSync():
+    # 1. 收集所有 KPI 表中待预测的点（积压时一次取完，每表最多 maxBatchSize 个）
+    pendingKpi = []
+    pendingId = []
+    pendingFeatures = []
+    for kpiName in predictableKpiNames():
+        try:
+            if kpiName in fallbackKpiSet:
+                tickFallback(kpiName)
+                continue
+            pending = getPendingFeatures(kpiName, DB_NAME, maxBatchSize)
+        except Exception as e:
+            # 与 async 模式相同：一个 KPI 出错不影响其他 KPI，丢弃它的窗口状态，下次重新预热
+            print("处理失败 " + str(kpiName) + ": " + str(e))
+            dropState(kpiName)
             continue
-        TfDataFrame =getReleatedData(kpiName, "aiops", targetID)
-        if TfDataFrame!=None:
-            predict= KPI_predict.kpi_predict(kpiName, TfDataFrame, modelConfig)
-            setPredict(kpiName, "aiops", targetID, predict);
-            print(str(kpiName)+"预测为："+str(predict))
-
+        if pending == None:
+            print("没有新数据，跳过 " + str(kpiName))
+            markHandled(kpiName)
+            continue
+        ids, features = pending
+        pendingKpi.extend([kpiName] * len(ids))
+        pendingId.extend(ids.tolist())
+        pendingFeatures.append(features)
+    if len(pendingKpi) == 0:
+        return
+
+    # 2. 按模型分组预测
+    predicts = KPI_predict.kpi_predict_many(pendingKpi, np.concatenate(pendingFeatures), modelConfig)
+
+    # 3. 按表批量写回
+    results = {}
+    for kpiName, targetID, predict in zip(pendingKpi, pendingId, predicts):
+        if predict != predict:  # nan：没有模型，下次重新预热
+            dropState(kpiName)
+            continue
+        if kpiName not in results:
+            results[kpiName] = []
+        results[kpiName].append((targetID, predict))
+    for kpiName, idPredictList in results.items():
+        writeBack(kpiName, idPredictList)
+
+
+def tickFallback(kpiName):
+    # 没有模型的 KPI：读取、打分、写回都在这里完成（打分每个点 O(1)，不单独放到预测线程）
+    pending = getFallbackScores(kpiName, DB_NAME, maxBatchSize)
+    if pending == None:
+        print("没有新数据，跳过 " + str(kpiName))
+        markHandled(kpiName)
+        return
+    ids, scores = pending
+    writeBack(kpiName, list(zip(ids.tolist(), scores.tolist())))
+
+
+# async 模式：每个 KPI 的 读取 -> 预测 -> 写回 是一条独立的流水线，各 KPI 并发执行，
+# 一次 tick 的耗时取决于最慢的 KPI，而不是所有 KPI 之和。
+# 数据库驱动是同步的，读写放到线程池中执行，并发数不超过 tickConcurrency（连接池大小）；
+# 预测是 CPU 密集的，放到单独的单线程执行器中，不占用数据库线程
+ioExecutor = None
+inferenceExecutor = None
+
+
+def getExecutors():
+    global ioExecutor, inferenceExecutor
+    if ioExecutor is None:
+        ioExecutor = ThreadPoolExecutor(max_workers=max(tickConcurrency, 1), thread_name_prefix="tick-io")
+        inferenceExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tick-predict")
+    return ioExecutor, inferenceExecutor
+
+
+async def tickOneKpi(kpiName, semaphore):
+    loop = asyncio.get_running_loop()
+    io, inference = getExecutors()
+    if kpiName in fallbackKpiSet:
+        async with semaphore:
+            await loop.run_in_executor(io, tickFallback, kpiName)
+        return
+    async with semaphore:
+        pending = await loop.run_in_executor(io, getPendingFeatures, kpiName, DB_NAME, maxBatchSize)
+    if pending == None:
+        print("没有新数据，跳过 " + str(kpiName))
+        markHandled(kpiName)
+        return
+    ids, features = pending
+    try:
+        predicts = await loop.run_in_executor(inference, KPI_predict.kpi_predict_batch, kpiName, features,
+                                              kpiConfig(kpiName))
+    except IOError as e:
+        # 模型在两次检查之间被删除，下次重新预热
+        print(str(e))
+        dropState(kpiName)
+        return
+    async with semaphore:
+        await loop.run_in_executor(io, writeBack, kpiName, list(zip(ids.tolist(), predicts)))
+
+
+async def tickAsync():
+    loop = asyncio.get_running_loop()
+    io, inference = getExecutors()
+    kpiNameList = await loop.run_in_executor(io, predictableKpiNames)
+    semaphore = asyncio.Semaphore(max(tickConcurrency, 1))
+    results = await asyncio.gather(*[tickOneKpi(kpiName, semaphore) for kpiName in kpiNameList],
+                                   return_exceptions=True)
+    for kpiName, result in zip(kpiNameList, results):
+        if isinstance(result, Exception):
+            # 一个 KPI 出错不影响其他 KPI；丢弃它的窗口状态，下次重新预热
+            print("处理失败 " + str(kpiName) + ": " + str(result))
+            dropState(kpiName)
+
+
+def runTick():
+    print("当前时间： ",str ( time.strftime('%Y.%m.%d %H:%M:%S ', time.localtime(time.time())) ) )
+    with KPI_metrics.timer("tick", mode=tickMode):
+        if tickMode == "async":
+            asyncio.run(tickAsync())
+        else:
+            tickSync()
     print("=======================================" )
+
+
+# 上一次 tick 还没结束时，新的 tick 不并发执行也不丢弃：只记下来，
+# 当前 tick 结束后立即再跑一次（多次重叠合并为一次）
+tickGuard = threading.Lock()
+tickState = {"running": False, "rerun": False}
+
+
+def every_ten_seconds():
+    with tickGuard:
+        if tickState["running"]:
+            tickState["rerun"] = True
+            KPI_metrics.inc("ticks_coalesced_total")
+            print("上一次预测还没有结束，结束后立即再执行一次")
+            return
+        tickState["running"] = True
+    try:
+        while True:
+            runTick()
+            with tickGuard:
+                if not tickState["rerun"]:
+                    break
+                tickState["rerun"] = False
+    finally:
+        with tickGuard:
+            tickState["running"] = False
+
+
+def trainOneKpi(kpiName):
+    # 在训练子进程中执行，训练用到的框架只在这里导入
+    import KPI_modelTrain
+    print("正在处理." + str(kpiName))
+    try:
+        with KPI_metrics.timer("train", kpi=kpiName):
+            # 只读取特征库中还没有的行
+            # 参数搜索选出的窗口等参数（kpiConfig.json）在每周训练时继续使用
+            config = kpiConfig(kpiName)
+            afterId = KPI_featureStore.store_for(kpiName, config).last_id()
+            KPI_modelTrain.kpi_train_model(kpiName, iterHistoryChunks(kpiName, DB_NAME, afterId), config)
+    finally:
+        # 子进程的指标交给调度进程合并（见 ever_week）
+        if os.path.exists(modelConfig["saveDirs"] + "/" + str(kpiName)):
+            KPI_metrics.dump(trainMetricsPath(kpiName))
+
+def trainOneGroup(className):
+    # modelMode=grouped：一类 KPI 训练一个模型，各 KPI 的特征库仍然分别增量更新
+    import KPI_groupModel
+    print("正在处理." + KPI_groupModel.group_name(className))
+    kpiNameList = [kpiName for kpiName in getAllKpiName(refresh=True)
+                   if kpiName not in tableIgnoreList and KPI_groupModel.group_of(kpiName) == className]
+    def chunksFor(kpiName):
+        afterId = KPI_featureStore.store_for(kpiName, modelConfig).last_id()
+        return iterHistoryChunks(kpiName, DB_NAME, afterId)
+    try:
+        with KPI_metrics.timer("train", kpi=KPI_groupModel.group_name(className)):
+            KPI_groupModel.train_group(className, kpiNameList, chunksFor, modelConfig)
+    finally:
+        if os.path.exists(modelConfig["saveDirs"] + "/" + KPI_groupModel.group_name(className)):
+            KPI_metrics.dump(trainMetricsPath(KPI_groupModel.group_name(className)))
+
+def trainMetricsPath(kpiName):
+    return modelConfig["saveDirs"] + "/" + str(kpiName) + "/trainMetrics.json"
+
+def renderPlots(kpiNameList):
+    # plotMode=deferred：训练子进程只保存了绘图数据，全部训练结束后在有界的进程池中绘制
+    if modelConfig.get("plotMode") != "deferred":
+        return
+    with KPI_metrics.timer("plot_all"):
+        KPI_plot.render_pending([modelConfig["saveDirs"] + "/" + str(kpiName) + "/" for kpiName in kpiNameList],
+                                workers=plotWorkers, timeout=trainTimeout)
+
 def ever_week():
-    time.sleep(2)
     print("生成每周模型...")
-    kpiNameList = getAllKpiName()
-    for kpiName in kpiNameList:
-        if kpiName in tableIgnoreList:
-            continue
-        print("正在处理." + str(kpiName))
-        historyData   =getAllHistoryData(kpiName, "aiops")
-        print(historyData)
-        if historyData  !=None:
-            KPI_modelTrain.kpi_train_model(kpiName,    generateDataFrame(historyData)  ,modelConfig)
+    kpiNameList = [kpiName for kpiName in getAllKpiName(refresh=True) if kpiName not in tableIgnoreList]
+    # 训练在子进程中进行，不占用调度进程，每十秒的预测照常运行；
+    # 多个预测进程时每个进程只训练分到自己分片的 KPI（分组模型按组名分片）
+    if modelConfig.get("modelMode") == "grouped":
+        # 每类 KPI 一个训练任务
+        import KPI_groupModel
+        taskList = sorted(set(KPI_groupModel.group_of(kpiName) for kpiName in kpiNameList))
+        taskList = [className for className in taskList if shard.owns(KPI_groupModel.group_name(className))]
+        target = trainOneGroup
+    else:
+        taskList = shard.filter(kpiNameList)
+        target = trainOneKpi
+    with KPI_metrics.timer("train_all"):
+        results = KPI_trainPool.train_all(taskList, target,
+                                          workers=trainWorkers, timeout=trainTimeout, threads=trainThreads)
+    for task, result in results.items():
+        KPI_metrics.inc("train_results_total", result=result.split("(")[0])
+        if target == trainOneGroup:
+            task = KPI_groupModel.group_name(task)
+        path = trainMetricsPath(task)
+        if KPI_metrics.merge(path):
+            os.remove(path)
+    if target == trainOneKpi:
+        renderPlots(taskList)
+    failed = [kpiName for kpiName, result in results.items() if result != "ok"]
+    print("每周模型生成完成，失败 " + str(len(failed)) + " 个: " + str(failed))
+
+
+def parseArgs():
+    # 命令行参数覆盖配置文件中的分片设置，便于同一份配置启动多个预测进程
+    parser = argparse.ArgumentParser(description="KPI 定时预测与每周训练")
+    parser.add_argument("--shard-index", type=int, default=shardIndex, help="本进程的分片编号（从 0 开始）")
+    parser.add_argument("--shard-count", type=int, default=shardCount, help="预测进程总数")
+    parser.add_argument("--lease", dest="lease", action="store_true", default=leaseEnabled,
+                        help="用租约表防止两个进程预测同一个 KPI")
+    parser.add_argument("--no-lease", dest="lease", action="store_false")
+    parser.add_argument("--sqlite", default=None, help="用这个 SQLite 文件代替 MySQL（本地测试）")
+    parser.add_argument("--ticks", type=int, default=0,
+                        help="只执行这么多次预测后退出，不训练（本地测试）；0 为按计划一直运行")
+    parser.add_argument("--interval", type=float, default=10, help="--ticks 时两次预测的间隔（秒）")
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    # KPI_modelTrain.kpi_train_model("kpi_all_p95_hour", generateDataFrame(getAllHistoryData("kpi_all_p95_hour", "aiops")), modelConfig)
+    args = parseArgs()
+    if args.sqlite:
+        # 环境变量让训练子进程也使用同一个替身库
+        os.environ["KPI_SQLITE"] = args.sqlite
+        KPI_config.sqlitePath = args.sqlite
+    configureShard(args.shard_index, args.shard_count, args.lease)
+    print("分片 " + str(shard.index) + "/" + str(shard.count) + ("，使用租约" if leases != None else ""))
+    if args.ticks > 0:
+        try:
+            for i in range(args.ticks):
+                every_ten_seconds()
+                if i + 1 < args.ticks:
+                    time.sleep(args.interval)
+        finally:
+            if leases != None:
+                leases.release()
+        raise SystemExit(0)
+
     #print("predict：" + str(KPI_predict.kpi_predict("kpi_all_p95_hour", getLatestOnePieceData("kpi_all_p95_hour", "aiops"), modelConfig)))
     # print ( getAllKpiName())
-    ever_week()
 
     # 如果只有定时任务，使用 BlockingScheduler
     # scheduler = BlockingScheduler()
     # 如果除了定时任务之外还有其他工作，使用 BackgroundScheduler
     scheduler = BackgroundScheduler()
+    KPI_metrics.start_http_server(metricsPort, metricsHost)
 
     scheduler.configure(timezone=pytz.timezone('Asia/Shanghai'))
 
-    scheduler.add_job(every_ten_seconds, 'cron', second='*/10', id='every_ten_seconds')
-    scheduler.add_job(ever_week, 'cron', day='*/7', id='every_week')
+    # 在每 10 秒的第 2 秒执行（原来在任务开头 sleep(2)，会白白占用一个执行线程）；
+    # 允许两个实例，使重叠的 tick 能登记为“再执行一次”，而不是被调度器跳过
+    scheduler.add_job(every_ten_seconds, 'cron', second='2-59/10', id='every_ten_seconds', max_instances=2)
+    scheduler.add_job(ever_week, 'cron', day='*/7', id='every_week', max_instances=1)
+    # 启动时先生成一次模型，放到后台执行，不推迟预测
+    scheduler.add_job(ever_week, 'date', id='first_week')
 
     scheduler.start()
 
@@ -285,3 +674,5 @@ if __name__ == '__main__':
             time.sleep(2)
     except (KeyboardInterrupt, SystemExit):
         scheduler.shutdown()
+        if leases != None:
+            leases.release()
@@ -0,0 +1,9 @@
+# pytest 配置：KPI_config 按当前目录读取 KPIautoPredictConfig.ini，测试从任意目录运行时先切换到本目录
+# 用法：python -m pytest -q algorithm_group/aiops_api/src/python
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+os.chdir(here)
+if here not in sys.path:
+    sys.path.insert(0, here)
@@ -0,0 +1,125 @@
+# KPI_backfill：按 id 范围 / 只写空值重算历史预测，中断后从断点继续，结果与直接用 window_features 打分相同
+import os
+
+import numpy as np
+import pytest
+
+import KPI_backfill
+import KPI_benchmark
+import KPI_db
+import KPI_feature
+import KPI_modelCache
+import KPI_npModel
+
+name = "kpi_all_backfill_minute"
+tableRows = 3000
+
+
+@pytest.fixture
+def backfill(tmp_path, monkeypatch):
+    # 替身库中一张表，saveDirs 指向临时目录，模型为随机权重的 model.npz
+    monkeypatch.setattr(KPI_db, "databases", {})
+    monkeypatch.setattr(KPI_modelCache, "registry", KPI_modelCache.ModelRegistry())
+    monkeypatch.setitem(KPI_backfill.globalConfig, "saveDirs", str(tmp_path))
+    os.makedirs(os.path.join(str(tmp_path), name))
+    KPI_npModel.save(KPI_benchmark.random_dense_model(), os.path.join(str(tmp_path), name, "model.npz"))
+    return KPI_backfill.globalConfig
+
+
+def make_table(pendingRows=0):
+    kpi = KPI_benchmark.synthetic_kpi(tableRows, seed=4)
+    return KPI_benchmark.standin_database([name], [kpi], pendingRows), kpi
+
+
+def predictions(db):
+    return dict(db.query("SELECT id, predict FROM " + KPI_db.table(name) + " ORDER BY id"))
+
+
+def expected_scores(kpi, modelConfig):
+    # 直接对整张表计算窗口特征并打分；之前不足 historyNum 行的点不打分。返回 {id: 得分}
+    positions, features = KPI_feature.window_features(kpi['value'], modelConfig["STA_windowSize_left"],
+                                                      modelConfig["STA_windowSize_right"], modelConfig["STA_fws"])
+    keep = positions >= KPI_backfill.history_num(modelConfig)
+    model = KPI_modelCache.get_model(name, modelConfig)
+    scores = model.predict(features[keep].astype(np.float32))[:, 0]
+    return dict(zip(kpi['id'][positions[keep]].tolist(), scores.tolist()))
+
+
+class Interrupt(Exception):
+    pass
+
+
+def record_writes(db, monkeypatch, failAt=None):
+    # 记录每次写回的 id；第 failAt 次写回时抛出异常，模拟进程中断
+    writes = []
+    updateById = type(db).update_by_id.__get__(db)
+
+    def update_by_id(tableName, columnName, idValueList, retries=3):
+        if failAt is not None and len(writes) + 1 == failAt:
+            raise Interrupt()
+        writes.append([rowId for rowId, value in idValueList])
+        return updateById(tableName, columnName, idValueList, retries)
+    monkeypatch.setattr(db, "update_by_id", update_by_id)
+    return writes
+
+
+@pytest.mark.parametrize("right", [0, 5])
+def test_id_range_resumes_from_checkpoint(backfill, monkeypatch, right):
+    monkeypatch.setitem(backfill, "STA_windowSize_right", right)
+    db, kpi = make_table()
+    before = predictions(db)
+    options = {"fromId": 500, "toId": 2500, "chunkSize": 300, "batchSize": 400}
+
+    writes = record_writes(db, monkeypatch, failAt=3)
+    with pytest.raises(Interrupt):
+        KPI_backfill.backfill_kpi(name, options)
+    checkpoint = KPI_backfill.read_checkpoint(name, backfill)
+    assert not checkpoint["done"]
+    assert 500 <= checkpoint["lastId"] < 2500
+    assert max(sum(writes, [])) <= checkpoint["lastId"]
+
+    # 重新运行：只读断点之后的行，已写回的点不再写
+    resumed = record_writes(db, monkeypatch)
+    result = KPI_backfill.backfill_kpi(name, options)
+    assert result["status"] == "ok"
+    assert result["rows"] < 2001
+    assert min(sum(resumed, [])) > checkpoint["lastId"]
+    written = sum(writes, []) + sum(resumed, [])
+    assert sorted(written) == list(range(500, 2501))
+
+    expected = expected_scores(kpi, backfill)
+    after = predictions(db)
+    np.testing.assert_allclose([after[i] for i in range(500, 2501)], [expected[i] for i in range(500, 2501)],
+                               rtol=1e-5)
+    # 范围之外不变
+    assert all(after[i] == before[i] for i in after if i < 500 or i > 2500)
+
+    # 已完成的范围不再处理；--restart 时重新计算
+    assert KPI_backfill.backfill_kpi(name, options)["status"] == "done"
+    assert KPI_backfill.backfill_kpi(name, dict(options, restart=True))["written"] == 2001
+
+
+def test_only_null_writes_missing_predictions(backfill, monkeypatch):
+    db, kpi = make_table(pendingRows=400)
+    # 中间再挖掉几个空值
+    db.execute("UPDATE " + KPI_db.table(name) + " SET predict = NULL WHERE id IN (100, 1500, 1501)")
+    before = predictions(db)
+    writes = record_writes(db, monkeypatch)
+    result = KPI_backfill.backfill_kpi(name, {"onlyNull": True, "chunkSize": 256, "batchSize": 100})
+    assert result["status"] == "ok"
+    expected = expected_scores(kpi, backfill)
+    nullIds = sorted(i for i, value in before.items() if value is None)
+    assert sorted(sum(writes, [])) == nullIds
+    after = predictions(db)
+    np.testing.assert_allclose([after[i] for i in nullIds], [expected[i] for i in nullIds], rtol=1e-5)
+    assert all(after[i] == before[i] for i in after if before[i] is not None)
+    # 读取从第一个空值之前的窗口开始
+    assert result["rows"] == tableRows - 100 + 1
+
+
+def test_missing_model_and_empty_range(backfill):
+    db, kpi = make_table()
+    assert KPI_backfill.backfill_kpi(name, {"fromId": tableRows + 1})["status"] == "empty"
+    assert KPI_backfill.backfill_kpi(name, {"onlyNull": True})["status"] == "empty"
+    os.remove(os.path.join(backfill["saveDirs"], name, "model.npz"))
+    assert KPI_backfill.backfill_kpi(name, {})["status"] == "no model"
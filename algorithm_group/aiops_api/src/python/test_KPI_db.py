@@ -0,0 +1,169 @@
+# KPI_db 连接池与事务，在 SQLite 替身库上测试
+import sqlite3
+import threading
+import time
+import uuid
+
+import pytest
+
+import KPI_db
+
+
+def traced_database(poolSize=5, timeout=30):
+    # 与 sqlite_database 相同的共享内存库，另外记录执行的语句和创建的连接数
+    path = "file:kpi_test_" + uuid.uuid4().hex + "?mode=memory&cache=shared"
+    statements = []
+    connections = []
+
+    def connect():
+        conn = sqlite3.connect(path, uri=True, timeout=30, check_same_thread=False)
+        conn.set_trace_callback(statements.append)
+        connections.append(conn)
+        return conn
+
+    db = KPI_db.Database(connect, poolSize=poolSize, dialect="sqlite", timeout=timeout)
+    db.keeper = sqlite3.connect(path, uri=True, check_same_thread=False)
+    return db, statements, connections
+
+
+def create_kpi(db, tableName="kpi_test", rows=0):
+    db.execute("CREATE TABLE " + KPI_db.table(tableName) +
+               " (`id` INTEGER PRIMARY KEY, `value` DOUBLE, `time` TEXT, `predict` DOUBLE)")
+    if rows > 0:
+        db.insert_rows(tableName, ["id", "value", "time"],
+                       [(i, float(i), "2020-01-01 00:00:%02d" % (i % 60)) for i in range(1, rows + 1)])
+
+
+def test_parameter_binding():
+    db = KPI_db.sqlite_database()
+    create_kpi(db)
+    # 值中的引号和 SQL 片段按参数绑定，不会拼进语句
+    text = "x'); DROP TABLE `kpi_test`; --"
+    assert db.execute("INSERT INTO `kpi_test` (`id`, `value`, `time`) VALUES (%s, %s, %s)", (1, 1.5, text)) == 1
+    assert db.execute("INSERT INTO `kpi_test` (`id`, `value`, `time`) VALUES (%s, %s, %s)", [2, 2.5, "b"]) == 1
+    assert db.query("SELECT `id`, `value`, `time` FROM `kpi_test` WHERE `time` = %s", (text,)) == [(1, 1.5, text)]
+    assert db.query_one("SELECT `value` FROM `kpi_test` WHERE `id` = %s", (2,)) == (2.5,)
+    assert db.query_one("SELECT `value` FROM `kpi_test` WHERE `id` = %s", (3,)) is None
+    assert db.query("SELECT COUNT(*) FROM `kpi_test`") == [(2,)]
+    assert db.execute("UPDATE `kpi_test` SET `predict` = %s WHERE `id` > %s", (0.5, 0)) == 2
+
+
+def test_table_name_is_validated():
+    with pytest.raises(ValueError):
+        KPI_db.table("kpi_x`; DROP TABLE t")
+    with pytest.raises(ValueError):
+        KPI_db.column("predict = 1")
+
+
+def test_update_by_id_batches(monkeypatch):
+    monkeypatch.setattr(KPI_db, "updateChunkRows", 3)
+    db, statements, _ = traced_database()
+    create_kpi(db, rows=10)
+    del statements[:]
+    # 10 个不同的 id（id 4 出现两次，以最后一次为准），每条 UPDATE 3 行 -> 4 条语句，同一个事务
+    pairs = [(i, i / 10.0) for i in range(1, 11)] + [(4, 0.99)]
+    assert db.update_by_id("kpi_test", "predict", pairs) == 10
+    updates = [sql for sql in statements if sql.startswith("UPDATE")]
+    assert len(updates) == 4
+    assert [sql.count(" WHEN ") for sql in updates] == [3, 3, 3, 1]
+    assert sum(1 for sql in statements if sql == "COMMIT") == 1
+    values = dict(db.query("SELECT `id`, `predict` FROM `kpi_test`"))
+    assert values[4] == 0.99
+    assert values[10] == 1.0
+    assert db.update_by_id("kpi_test", "predict", []) == 0
+
+
+def test_transaction_commits_on_success():
+    db = KPI_db.sqlite_database()
+    create_kpi(db)
+    with db.transaction() as cursor:
+        db.run(cursor, "INSERT INTO `kpi_test` (`id`, `value`) VALUES (%s, %s)", (1, 1.0))
+        db.run(cursor, "INSERT INTO `kpi_test` (`id`, `value`) VALUES (%s, %s)", (2, 2.0))
+    assert db.query("SELECT `id` FROM `kpi_test` ORDER BY `id`") == [(1,), (2,)]
+
+
+def test_transaction_rolls_back_on_exception():
+    db = KPI_db.sqlite_database()
+    create_kpi(db, rows=1)
+    with pytest.raises(RuntimeError):
+        with db.transaction() as cursor:
+            db.run(cursor, "INSERT INTO `kpi_test` (`id`, `value`) VALUES (%s, %s)", (2, 2.0))
+            db.run(cursor, "UPDATE `kpi_test` SET `predict` = %s", (1.0,))
+            raise RuntimeError("boom")
+    assert db.query("SELECT `id`, `predict` FROM `kpi_test`") == [(1, None)]
+    # 回滚后的连接放回池中，可以继续使用
+    assert db.execute("INSERT INTO `kpi_test` (`id`, `value`) VALUES (%s, %s)", (3, 3.0)) == 1
+
+
+class BrokenConnection(object):
+    # rollback 失败的连接
+
+    def __init__(self):
+        self.closed = False
+
+    def cursor(self):
+        return sqlite3.connect(":memory:").cursor()
+
+    def rollback(self):
+        raise sqlite3.OperationalError("connection lost")
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_failed_rollback_keeps_original_exception(caplog):
+    conns = []
+
+    def connect():
+        conns.append(BrokenConnection())
+        return conns[-1]
+
+    db = KPI_db.Database(connect, poolSize=1, dialect="sqlite")
+    with pytest.raises(KeyError):
+        with db.transaction():
+            raise KeyError("original")
+    assert "rollback failed" in caplog.text
+    # 回滚失败的连接被关闭丢弃，下次取新连接，连接数的名额已经归还
+    assert conns[0].closed
+    with db.connection() as conn:
+        assert conn is conns[1]
+
+
+def test_pool_size_bound():
+    db, _, connections = traced_database(poolSize=2, timeout=0.2)
+    with db.connection():
+        with db.connection():
+            with pytest.raises(KPI_db.PoolExhaustedError):
+                with db.connection():
+                    pass
+    # 归还后复用空闲连接，不再新建
+    for _ in range(5):
+        db.query("SELECT 1")
+    assert len(connections) == 2
+
+
+def test_pool_size_bound_across_threads():
+    db, _, connections = traced_database(poolSize=3, timeout=10)
+    lock = threading.Lock()
+    active = [0, 0]  # 当前、最大同时持有的连接数
+
+    def work():
+        for _ in range(5):
+            with db.connection():
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active[1], active[0])
+                time.sleep(0.002)
+                with lock:
+                    active[0] -= 1
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert active[1] <= 3
+    assert len(connections) <= 3
@@ -0,0 +1,98 @@
+# KPI_discovery：表名列表按 refreshInterval 缓存，一条 UNION ALL 查询取各表 MAX(id)，水位决定哪些表需要访问
+import pytest
+
+import KPI_db
+import KPI_discovery
+
+
+class Clock(object):
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = KPI_db.sqlite_database()
+    monkeypatch.setitem(KPI_db.databases, "discovery_test", db)
+    return db
+
+
+def create(db, name, ids=()):
+    db.execute("CREATE TABLE " + KPI_db.table(name) + " (id INTEGER PRIMARY KEY, value REAL, time TEXT, predict REAL)")
+    if len(ids) > 0:
+        db.executemany("INSERT INTO " + KPI_db.table(name) + " (id, value) VALUES (%s, %s)", [(i, 1.0) for i in ids])
+
+
+def test_table_list_cached_until_refresh(db):
+    clock = Clock()
+    discovery = KPI_discovery.TableDiscovery("discovery_test", "kpi_", refreshInterval=300, clock=clock)
+    create(db, "kpi_all_a_minute")
+    create(db, "predict_lease")
+    assert discovery.tables() == ["kpi_all_a_minute"]
+
+    # 缓存期内新建的表看不到；过期、refresh 或 invalidate 后重新读取
+    create(db, "kpi_all_b_minute")
+    clock.now = 299
+    assert discovery.tables() == ["kpi_all_a_minute"]
+    clock.now = 300
+    assert sorted(discovery.tables()) == ["kpi_all_a_minute", "kpi_all_b_minute"]
+    create(db, "kpi_all_c_minute")
+    assert len(discovery.tables()) == 2
+    assert len(discovery.tables(refresh=True)) == 3
+    create(db, "kpi_all_d_minute")
+    discovery.invalidate()
+    assert len(discovery.tables()) == 4
+    # 返回的是副本，调用方修改不影响缓存
+    discovery.tables().append("kpi_fake")
+    assert len(discovery.tables()) == 4
+
+
+@pytest.mark.parametrize("unionTables", [200, 2])
+def test_max_ids_in_union_queries(db, monkeypatch, unionTables):
+    monkeypatch.setattr(KPI_discovery, "unionTables", unionTables)
+    create(db, "kpi_all_a_minute", [1, 2, 3])
+    create(db, "kpi_all_b_minute")
+    create(db, "kpi_all_c_minute", [10, 7])
+    create(db, "kpi_all_d_minute", [5])
+    statements = []
+    query = db.query
+
+    def record(SQLstr, params=()):
+        statements.append(SQLstr)
+        return query(SQLstr, params)
+    monkeypatch.setattr(db, "query", record)
+    names = ["kpi_all_a_minute", "kpi_all_b_minute", "kpi_all_c_minute", "kpi_all_d_minute"]
+    assert KPI_discovery.max_ids(db, names) == {"kpi_all_a_minute": 3, "kpi_all_b_minute": None,
+                                                "kpi_all_c_minute": 10, "kpi_all_d_minute": 5}
+    assert len(statements) == (len(names) + unionTables - 1) // unionTables
+    assert all("UNION ALL" in SQLstr for SQLstr in statements)
+    assert KPI_discovery.max_ids(db, []) == {}
+
+
+def test_watermarks_changed():
+    watermarks = KPI_discovery.Watermarks()
+    # 没有水位的表都要访问；空表不访问
+    assert watermarks.changed({"a": 10, "b": 5, "c": None}) == ["a", "b"]
+    watermarks.mark("a", 10)
+    watermarks.mark("b", 3)
+    assert watermarks.changed({"a": 10, "b": 5, "c": None}) == ["b"]
+    assert watermarks.backlog("a") == 0
+    assert watermarks.backlog("b") == 2
+    assert watermarks.backlog("c") is None
+
+    # 新数据到达后再次访问
+    watermarks.mark("b", 5)
+    assert watermarks.changed({"a": 12, "b": 5, "c": 1}) == ["a", "c"]
+    # forget（处理失败、状态丢弃）后一定访问
+    watermarks.mark("a", 12)
+    watermarks.mark("c", 1)
+    watermarks.forget("b")
+    assert watermarks.changed({"a": 12, "b": 5, "c": 1}) == ["b"]
+    # 删除的表不再保留水位，重新创建后从头访问
+    watermarks.mark("b", 5)
+    assert watermarks.changed({"a": 12, "c": 1}) == []
+    assert watermarks.changed({"a": 12, "b": 1, "c": 1}) == ["b"]
@@ -0,0 +1,80 @@
+# KPI_fallback：在线检测器预热之后才打分，注入的异常点得分高于正常点
+import warnings
+
+import numpy as np
+
+import KPI_fallback
+
+
+def make_series(n, seed=0, anomalyRate=0.01):
+    rng = np.random.RandomState(seed)
+    values = 100 + 10 * np.sin(np.arange(n) / 50.0) + rng.normal(0, 1, n)
+    anomalies = np.zeros(n, dtype=bool)
+    anomalies[200:] = rng.rand(n - 200) < anomalyRate
+    values[anomalies] += rng.choice([-1, 1], anomalies.sum()) * rng.uniform(8, 15, anomalies.sum())
+    return values, anomalies
+
+
+def push_all(detector, values):
+    return [detector.push(i, value) for i, value in enumerate(values)]
+
+
+def test_scores_only_after_warm_up():
+    detector = KPI_fallback.OnlineDetector(span=20, quantile=0.995, warmUp=50)
+    scores = push_all(detector, make_series(200)[0])
+    # 点 i 之前有 i 个点，i >= warmUp 时才打分
+    assert all(score is None for score in scores[:50])
+    assert all(score is not None for score in scores[50:])
+    assert all(0 <= score < 1 for score in scores[50:])
+    assert detector.lastId == 199
+
+
+def test_missing_values_are_skipped():
+    detector = KPI_fallback.OnlineDetector(span=5, quantile=0.99, warmUp=3)
+    scores = push_all(detector, [1.0, None, 2.0, float("nan"), 1.5, 1.2, 1.4])
+    assert scores[1] is None and scores[3] is None
+    assert detector.count == 5
+    assert detector.lastId == 6
+
+
+def test_anomalies_score_higher():
+    values, anomalies = make_series(5000)
+    detector = KPI_fallback.detector_for({"STA_windowSize_left": 20, "STA_fws": 0.5, "fallbackZMin": 3.0}, 100)
+    scores = np.array(push_all(detector, values)[200:], dtype=np.float64)
+    anomalies = anomalies[200:]
+    assert np.median(scores[anomalies]) > 0.5
+    assert np.median(scores[~anomalies]) < 0.5
+    # 按得分排序，异常点几乎都排在前面
+    top = np.argsort(-scores)[:anomalies.sum()]
+    assert anomalies[top].mean() > 0.8
+
+
+def test_threshold_tracks_quantile():
+    # 随机逼近的阈值收敛到 |z| 的 quantile 分位数附近（下限 zMin 为 0 时）
+    rng = np.random.RandomState(3)
+    detector = KPI_fallback.OnlineDetector(span=50, quantile=0.9, warmUp=10, zMin=0.0, quantileStep=0.01)
+    z = []
+    for i, value in enumerate(rng.normal(0, 1, 20000)):
+        scale = detector.scale()
+        mean = detector.mean
+        detector.push(i, value)
+        if i > 1000:
+            z.append(abs(value - mean) / scale)
+    assert abs(detector.threshold - np.percentile(z, 90)) < 0.2
+
+
+def test_constant_series_without_warnings():
+    detector = KPI_fallback.OnlineDetector(span=20, quantile=0.99, warmUp=10)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        scores = push_all(detector, [5.0] * 100 + [6.0])
+    assert scores[50] == 0.0
+    assert scores[-1] > 0.99
+
+
+def test_matches_config():
+    config = {"STA_windowSize_left": 20, "STA_fws": 0.5, "fallbackZMin": 3.0}
+    detector = KPI_fallback.detector_for(config, 50)
+    assert KPI_fallback.matches(detector, config, 50)
+    assert not KPI_fallback.matches(detector, config, 60)
+    assert not KPI_fallback.matches(detector, dict(config, STA_fws=1.0), 50)
@@ -0,0 +1,98 @@
+# KPI_feature 与原 kpi_train_model 中逐行提取特征的循环（iterrows + dataset.loc）结果一致
+import numpy as np
+import pandas as pd
+import pytest
+
+import KPI_feature
+
+
+def make_dataset(n, seed=0):
+    # 与 generateDataFrame 相同的列：id, value, timestamp, label
+    rng = np.random.RandomState(seed)
+    values = 100 + 10 * np.sin(np.arange(n) / 7.0) + rng.normal(0, 3, n)
+    values[rng.rand(n) < 0.05] *= 3
+    return pd.DataFrame({
+        'id': np.arange(1, n + 1),
+        'value': np.round(values, 3),
+        'timestamp': pd.date_range("2020-01-01", periods=n, freq="min").astype(str),
+        'label': (rng.rand(n) < 0.1).astype(int),
+    }, columns=['id', 'value', 'timestamp', 'label'])
+
+
+def legacy_handled_data(dataset, STA_windowSize_left, STA_windowSize_right, STA_fws):
+    # 原 kpi_train_model 的循环（没有 HandledData.csv 时），只去掉了进度输出
+    handledData = pd.DataFrame({})
+    handledData['timestamp'] = []
+    handledData['std'] = []
+    handledData['mean'] = []
+    handledData['fws'] = []
+    handledData['label'] = []
+    for index, row in dataset.iterrows():
+        tpList = []
+        for ii in range(index - STA_windowSize_left, index + STA_windowSize_right):
+            try:
+                tpList.append(dataset.loc[ii]["value"])
+            except:
+                continue
+        if (len(tpList) < STA_windowSize_left + STA_windowSize_right):
+            continue
+        stdd = np.std(tpList) * np.std(tpList)
+        mean = np.mean(tpList)
+        fws = np.percentile(tpList, STA_fws)
+        handledData.loc[len(handledData)] = [row["timestamp"],
+                                             stdd,
+                                             mean,
+                                             fws,
+                                             int(row["label"])
+                                             ]
+    return handledData
+
+
+def config(left, right, fws):
+    return {"STA_windowSize_left": left, "STA_windowSize_right": right, "STA_fws": fws}
+
+
+@pytest.mark.parametrize("n,left,right,fws", [
+    (120, 20, 0, 0.5),  # 默认配置：right=0
+    (120, 10, 5, 5.0),  # right>0，最后 right-1 个点没有完整窗口
+    (60, 1, 1, 50.0),
+    (15, 20, 0, 0.5),  # 序列比窗口短
+    (25, 20, 8, 0.5),  # 比 left 长、比 left+right 短
+])
+def test_extract_features_matches_legacy_loop(n, left, right, fws):
+    dataset = make_dataset(n)
+    expected = legacy_handled_data(dataset, left, right, fws)
+    handledData = KPI_feature.extract_features(dataset, config(left, right, fws))
+
+    assert list(handledData.columns) == KPI_feature.featureColumns
+    assert len(handledData) == len(expected)
+    assert list(handledData['timestamp']) == list(expected['timestamp'])
+    for column in ['std', 'mean', 'fws']:
+        np.testing.assert_array_equal(handledData[column].values.astype(np.float64),
+                                      expected[column].values.astype(np.float64))
+    np.testing.assert_array_equal(handledData['label'].values, expected['label'].values.astype(int))
+
+
+@pytest.mark.parametrize("left,right", [(20, 0), (10, 5), (3, 7)])
+def test_window_features_positions_match_legacy_loop(left, right):
+    dataset = make_dataset(80, seed=1)
+    expected = legacy_handled_data(dataset, left, right, 0.5)
+    positions, features = KPI_feature.window_features(dataset['value'].values, left, right, 0.5)
+
+    assert list(dataset['timestamp'].values[positions]) == list(expected['timestamp'])
+    np.testing.assert_array_equal(features, expected[['std', 'mean', 'fws']].values.astype(np.float64))
+
+
+def test_window_features_shorter_than_window():
+    positions, features = KPI_feature.window_features(np.arange(5.0), 4, 3, 0.5)
+    assert len(positions) == 0
+    assert features.shape == (0, 3)
+
+
+def test_streaming_matches_window_features():
+    values = make_dataset(500, seed=2)['value'].values
+    positions, features = KPI_feature.window_features(values, 10, 5, 5.0)
+    stream = KPI_feature.StreamingWindowFeatures(10, 5, 5.0)
+    pushed = [stream.push(values[start:start + 37]) for start in range(0, len(values), 37)]
+    np.testing.assert_array_equal(np.concatenate([chunk[0] for chunk in pushed]), positions)
+    np.testing.assert_array_equal(np.concatenate([chunk[1] for chunk in pushed]), features)
@@ -0,0 +1,96 @@
+# KPI_featureStore：逐块追加的结果与一次计算全部特征相同，更新时不把已有的数据读入内存
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import KPI_feature
+import KPI_featureStore
+
+
+def make_chunks(n, chunkSize, start=0, seed=0):
+    rng = np.random.RandomState(seed)
+    ids = np.arange(start + 1, start + n + 1, dtype=np.int64)
+    values = 50 + 5 * np.sin(ids / 11.0) + rng.normal(0, 1, n)
+    times = np.datetime64("2020-01-01T00:00:00", "us") + ids.astype("timedelta64[m]")
+    labels = (rng.rand(n) < 0.05).astype(np.float64)
+    return [{'id': ids[i:i + chunkSize], 'time': times[i:i + chunkSize],
+             'value': values[i:i + chunkSize], 'label': labels[i:i + chunkSize]} for i in range(0, n, chunkSize)]
+
+
+def expected_columns(chunks, left, right, fws):
+    value = np.concatenate([chunk['value'] for chunk in chunks])
+    positions, features = KPI_feature.window_features(value, left, right, fws)
+    expected = dict((name, np.concatenate([chunk[name] for chunk in chunks])) for name in KPI_featureStore.rawColumns)
+    for i, name in enumerate(KPI_featureStore.featureColumns):
+        expected[name] = np.full(len(value), np.nan)
+        expected[name][positions] = features[:, i]
+    return expected
+
+
+def assert_columns_equal(columns, expected):
+    for name in KPI_featureStore.rawColumns + KPI_featureStore.featureColumns:
+        np.testing.assert_array_equal(np.asarray(columns[name]), expected[name], err_msg=name)
+
+
+@pytest.mark.parametrize("left,right", [(20, 0), (10, 5), (3, 1)])
+def test_incremental_updates_match_full_computation(tmp_path, left, right):
+    chunks = make_chunks(1000, 70)
+    store = KPI_featureStore.FeatureStore(str(tmp_path) + "/features/", left, right, 5.0)
+    # 分三次更新，每次多个块；重复的旧块被忽略
+    assert store.update_chunks(chunks[:4]) == 280
+    assert store.update_chunks(chunks[3:9]) == 350
+    assert store.update_chunks(chunks[9:]) == 370
+    assert store.update_chunks(chunks[-2:]) == 0
+    assert store.rows() == 1000
+    assert store.last_id() == 1000
+    assert_columns_equal(store.load(), expected_columns(chunks, left, right, 5.0))
+
+
+def test_leftover_after_interrupted_update_is_discarded(tmp_path):
+    chunks = make_chunks(300, 50)
+    store = KPI_featureStore.FeatureStore(str(tmp_path) + "/features/", 10, 3, 0.5)
+    store.update_chunks(chunks[:3])
+    # 模拟追加了数据、还没有更新 meta.json 时退出
+    for name in KPI_featureStore.rawColumns + KPI_featureStore.featureColumns:
+        KPI_featureStore.append_column(store.column_path(name), KPI_featureStore.columnTypes[name], 150,
+                                       np.zeros(7, dtype=KPI_featureStore.columnTypes[name]))
+    assert store.rows() == 150
+    store.update_chunks(chunks[3:])
+    assert_columns_equal(store.load(), expected_columns(chunks, 10, 3, 0.5))
+
+
+def test_params_change_rebuilds(tmp_path):
+    chunks = make_chunks(200, 64)
+    directory = str(tmp_path) + "/features/"
+    KPI_featureStore.FeatureStore(directory, 10, 0, 0.5).update_chunks(chunks)
+    store = KPI_featureStore.FeatureStore(directory, 5, 2, 0.5)
+    assert store.rows() == 0
+    assert store.update_chunks(chunks[:2]) == 128
+    assert_columns_equal(store.load(), expected_columns(chunks[:2], 5, 2, 0.5))
+
+
+def test_appends_to_files_written_by_np_save(tmp_path):
+    # 原来整体 np.save 的特征库可以直接追加
+    path = str(tmp_path / "value.npy")
+    np.save(path, np.arange(5.0))
+    KPI_featureStore.append_column(path, np.float64, 5, np.arange(5.0, 8.0))
+    np.testing.assert_array_equal(np.load(path), np.arange(8.0))
+
+
+def test_update_memory_does_not_depend_on_table_size(tmp_path):
+    store = KPI_featureStore.FeatureStore(str(tmp_path) + "/features/", 20, 0, 0.5)
+    big = make_chunks(400000, 50000)
+    store.update_chunks(big)
+    tableBytes = sum(np.asarray(store.load()[name]).nbytes
+                     for name in KPI_featureStore.rawColumns + KPI_featureStore.featureColumns)
+
+    more = make_chunks(2000, 1000, start=400000, seed=1)
+    tracemalloc.start()
+    try:
+        assert store.update_chunks(more) == 2000
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < tableBytes / 20
+    assert_columns_equal(store.load(), expected_columns(big + more, 20, 0, 0.5))
@@ -0,0 +1,111 @@
+# KPI_groupModel 的保存布局：groupIndex.json 指向版本子目录，替换 groupIndex.json 即切换到新模型
+import json
+import os
+
+import numpy as np
+import pytest
+
+import KPI_groupModel
+import KPI_modelCache
+import KPI_npModel
+import KPI_preprocess
+
+
+def group_model(scale):
+    # 两个 KPI 的 embedding 不同，输出 = scale * (特征之和 + embedding)
+    kernels = [np.full((4, 1), float(scale))]
+    return KPI_npModel.NumpyModel(kernels, [np.zeros(1)], ["linear"], np.array([[0.0], [100.0]]))
+
+
+def kpi_info(index):
+    return {"index": index, "preprocess": KPI_preprocess.Preprocessor([0.0] * 3, [1.0] * 3, 20, 0, 0.5).to_dict(),
+            "threshold": 0.5, "score": 1.0}
+
+
+def save_version(saveDir, scale):
+    version = KPI_groupModel.new_version(saveDir)
+    KPI_npModel.save(group_model(scale), saveDir + version + "/model.npz")
+    return version
+
+
+def write_index(saveDir, version=None):
+    groupIndex = {"kpis": {"kpi_service_a_1": kpi_info(0), "kpi_service_b_1": kpi_info(1)}}
+    if version is not None:
+        groupIndex["version"] = version
+    with open(saveDir + "groupIndex.json", "w") as f:
+        json.dump(groupIndex, f)
+    return saveDir + "groupIndex.json"
+
+
+def predict(path, kpiid):
+    return KPI_groupModel.load(path).for_kpi(kpiid).predict(np.ones((1, 3)))[0, 0]
+
+
+def test_index_selects_version(tmp_path):
+    saveDir = str(tmp_path) + "/"
+    first = save_version(saveDir, 1)
+    path = write_index(saveDir, first)
+    assert predict(path, "kpi_service_b_1") == 103.0
+    # 新版本的模型文件写好、groupIndex.json 还没替换时仍然使用旧版本
+    second = save_version(saveDir, 2)
+    assert second != first
+    assert predict(path, "kpi_service_b_1") == 103.0
+    write_index(saveDir, second)
+    assert predict(path, "kpi_service_b_1") == 206.0
+    assert KPI_groupModel.load(path).for_kpi("kpi_service_c_1") is None
+
+
+def test_old_layout_without_version(tmp_path):
+    saveDir = str(tmp_path) + "/"
+    KPI_npModel.save(group_model(1), saveDir + "model.npz")
+    assert predict(write_index(saveDir), "kpi_service_a_1") == 3.0
+
+
+def test_remove_old_versions(tmp_path):
+    saveDir = str(tmp_path) + "/"
+    KPI_npModel.save(group_model(1), saveDir + "model.npz")
+    versions = []
+    for scale in range(1, 5):
+        versions.append(save_version(saveDir, scale))
+        os.utime(saveDir + versions[-1], (scale, scale))
+        KPI_groupModel.remove_old_versions(saveDir, versions[-1])
+    kept = sorted(name for name in os.listdir(saveDir) if name.startswith("v"))
+    assert kept == sorted(versions[-KPI_groupModel.keepVersions:])
+    assert not os.path.exists(saveDir + "model.npz")
+
+
+def test_cache_reloads_on_index_switch(tmp_path, monkeypatch):
+    monkeypatch.setattr(KPI_modelCache, "registry", KPI_modelCache.ModelRegistry(maxSize=4))
+    modelConfig = {"saveDirs": str(tmp_path), "modelMode": "grouped",
+                   "STA_windowSize_left": 20, "STA_windowSize_right": 0, "STA_fws": 0.5}
+    saveDir = KPI_groupModel.group_dir("service", modelConfig)
+    os.makedirs(saveDir)
+    path = write_index(saveDir, save_version(saveDir, 1))
+    assert KPI_modelCache.get_model("kpi_service_a_1", modelConfig).predict(np.ones((1, 3)))[0, 0] == 3.0
+    write_index(saveDir, save_version(saveDir, 2))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 5 * 10 ** 9))
+    assert KPI_modelCache.get_model("kpi_service_a_1", modelConfig).predict(np.ones((1, 3)))[0, 0] == 6.0
+
+
+def test_train_group_saves_version(tmp_path):
+    pytest.importorskip("keras")
+    import KPI_config
+    from test_KPI_featureStore import make_chunks
+
+    modelConfig = dict(KPI_config.modelConfig)
+    modelConfig.update({"saveDirs": str(tmp_path), "modelMode": "grouped", "minTrainNum": 200, "max_epochs": 1,
+                        "b_size": 64, "earlyStoppingPatience": 0})
+    kpiNameList = ["kpi_service_a_1", "kpi_service_b_1"]
+    chunksFor = lambda kpiName: make_chunks(600, 100, seed=kpiNameList.index(kpiName))  # noqa: E731
+    saveDir = KPI_groupModel.group_dir("service", modelConfig)
+    versions = []
+    for _ in range(3):
+        KPI_groupModel.train_group("service", kpiNameList, chunksFor, modelConfig)
+        with open(saveDir + "groupIndex.json") as f:
+            versions.append(json.load(f)["version"])
+        assert os.path.exists(saveDir + versions[-1] + "/model.npz")
+        assert KPI_modelCache.get_model("kpi_service_a_1", modelConfig) is not None
+    assert len(set(versions)) == 3
+    assert not os.path.exists(saveDir + versions[0])
+    assert not hasattr(KPI_groupModel.load(saveDir + "groupIndex.json").for_kpi("kpi_service_a_1"), "threshold")
@@ -0,0 +1,111 @@
+# KPI_metrics：Prometheus 文本格式（标签转义）、子进程指标的 dump / merge、JSON 阶段日志
+import json
+import socket
+import urllib.request
+
+import pytest
+
+import KPI_metrics
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+    # 指标是进程内全局的，每个测试使用空的副本
+    monkeypatch.setattr(KPI_metrics, "counters", {})
+    monkeypatch.setattr(KPI_metrics, "gauges", {})
+    monkeypatch.setattr(KPI_metrics, "timers", {})
+    yield
+    KPI_metrics.configure_log("")
+
+
+def test_render_exposition_format():
+    KPI_metrics.inc("rows_read_total", 5, kpi="kpi_a", source="tick")
+    KPI_metrics.inc("rows_read_total", 2, kpi="kpi_a", source="tick")
+    KPI_metrics.inc("rows_read_total", kpi="kpi_b", source="history")
+    KPI_metrics.set_gauge("model_cache_size", 3)
+    KPI_metrics.observe("stage_seconds", 0.25, stage="read", kpi="kpi_a")
+    KPI_metrics.observe("stage_seconds", 0.5, stage="read", kpi="kpi_a")
+    assert KPI_metrics.render() == "\n".join([
+        "# HELP kpi_rows_read_total 从数据库读取的行数",
+        "# TYPE kpi_rows_read_total counter",
+        'kpi_rows_read_total{kpi="kpi_a",source="tick"} 7.0',
+        'kpi_rows_read_total{kpi="kpi_b",source="history"} 1.0',
+        "# HELP kpi_model_cache_size 缓存中的模型数",
+        "# TYPE kpi_model_cache_size gauge",
+        "kpi_model_cache_size 3.0",
+        "# HELP kpi_stage_seconds 各阶段耗时（秒）",
+        "# TYPE kpi_stage_seconds summary",
+        'kpi_stage_seconds_count{kpi="kpi_a",stage="read"} 2',
+        'kpi_stage_seconds_sum{kpi="kpi_a",stage="read"} 0.75',
+    ]) + "\n"
+
+
+def test_label_escaping():
+    KPI_metrics.inc("custom_total", kpi='a"b\\c\nd')
+    lines = KPI_metrics.render().splitlines()
+    # 没有说明的指标只有 TYPE 行
+    assert lines == ["# TYPE kpi_custom_total counter", 'kpi_custom_total{kpi="a\\"b\\\\c\\nd"} 1.0']
+    assert KPI_metrics.format_labels(()) == ""
+
+
+def test_dump_and_merge(tmp_path):
+    KPI_metrics.inc("rows_written_total", 10, kpi="kpi_a")
+    KPI_metrics.set_gauge("backlog_rows", 4, kpi="kpi_a")
+    KPI_metrics.observe("stage_seconds", 1.5, stage="fit", kpi="kpi_a")
+    path = str(tmp_path / "metrics.json")
+    KPI_metrics.dump(path)
+
+    # 调度进程已有的指标：计数和耗时累加，当前值被子进程的覆盖
+    KPI_metrics.reset()
+    KPI_metrics.inc("rows_written_total", 1, kpi="kpi_a")
+    KPI_metrics.set_gauge("backlog_rows", 100, kpi="kpi_a")
+    KPI_metrics.observe("stage_seconds", 0.5, stage="fit", kpi="kpi_a")
+    assert KPI_metrics.merge(path)
+    assert KPI_metrics.merge(path)
+    labels = (("kpi", "kpi_a"),)
+    assert KPI_metrics.counters[("rows_written_total", labels)] == 21
+    assert KPI_metrics.gauges[("backlog_rows", labels)] == 4
+    assert KPI_metrics.timers[("stage_seconds", (("kpi", "kpi_a"), ("stage", "fit")))] == [3, 3.5]
+    assert 'kpi_rows_written_total{kpi="kpi_a"} 21.0' in KPI_metrics.render()
+
+    assert not KPI_metrics.merge(str(tmp_path / "missing.json"))
+    with open(str(tmp_path / "broken.json"), "w") as f:
+        f.write("{")
+    assert not KPI_metrics.merge(str(tmp_path / "broken.json"))
+
+
+def test_timer_writes_json_log(tmp_path):
+    path = str(tmp_path / "logs" / "metrics.log")
+    KPI_metrics.configure_log(path)
+    with KPI_metrics.timer("read", kpi="kpi_中文"):
+        pass
+    with pytest.raises(ValueError):
+        with KPI_metrics.timer("write", kpi="kpi_a"):
+            raise ValueError()
+    KPI_metrics.log_event("custom", value=1)
+    KPI_metrics.configure_log("")
+    # 关闭日志后不再写入
+    KPI_metrics.log_event("ignored")
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["event"] for record in records] == ["stage", "stage", "custom"]
+    assert records[0]["stage"] == "read" and records[0]["kpi"] == "kpi_中文" and records[0]["ok"] is True
+    assert records[1]["stage"] == "write" and records[1]["ok"] is False
+    assert all(isinstance(record["ts"], float) for record in records)
+    assert KPI_metrics.timers[("stage_seconds", (("kpi", "kpi_a"), ("stage", "write")))][0] == 1
+
+
+def test_http_endpoint():
+    assert KPI_metrics.start_http_server(0) is None
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = KPI_metrics.start_http_server(port)
+    try:
+        KPI_metrics.inc("ticks_coalesced_total")
+        with urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port, timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert "kpi_ticks_coalesced_total 1.0" in response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
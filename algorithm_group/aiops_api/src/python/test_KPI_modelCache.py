@@ -0,0 +1,164 @@
+# KPI_modelCache：标准化参数与模型权重不会配错，文件变化时重新加载
+import os
+
+import numpy as np
+
+import KPI_modelCache
+import KPI_npModel
+import KPI_preprocess
+
+config = {"STA_windowSize_left": 20, "STA_windowSize_right": 0, "STA_fws": 0.5}
+
+
+def identity_model():
+    return KPI_npModel.NumpyModel([np.eye(3)], [np.zeros(3)], ["linear"])
+
+
+def preprocessor(mean):
+    return KPI_preprocess.Preprocessor([mean] * 3, [1.0] * 3, 20, 0, 0.5)
+
+
+def bump_mtime(path, seconds):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + int(seconds * 1e9)))
+
+
+def test_npz_uses_embedded_preprocess(tmp_path):
+    modelDir = str(tmp_path)
+    model = identity_model()
+    model.extra = {"preprocess": preprocessor(10.0).to_dict()}
+    KPI_npModel.save(model, os.path.join(modelDir, "model.npz"))
+    # 上一次训练留下的 preprocess.json 不影响 model.npz 中的参数
+    KPI_preprocess.save(preprocessor(99.0), modelDir)
+    loaded = KPI_modelCache.load_model(os.path.join(modelDir, "model.npz"))
+    np.testing.assert_allclose(loaded.predict(np.full((1, 3), 12.0)), [[2.0, 2.0, 2.0]])
+
+
+def test_npz_without_embedded_preprocess_uses_json(tmp_path):
+    modelDir = str(tmp_path)
+    KPI_npModel.save(identity_model(), os.path.join(modelDir, "model.npz"))
+    KPI_preprocess.save(preprocessor(1.0), modelDir)
+    loaded = KPI_modelCache.load_model(os.path.join(modelDir, "model.npz"))
+    np.testing.assert_allclose(loaded.predict(np.full((1, 3), 12.0)), [[11.0, 11.0, 11.0]])
+
+
+def test_h5_waits_for_matching_preprocess(tmp_path, monkeypatch):
+    monkeypatch.setattr(KPI_modelCache, "load_keras_model", lambda path: identity_model())
+    modelDir = str(tmp_path)
+    path = os.path.join(modelDir, "model.h5")
+    with open(path, "w") as f:
+        f.write("weights v1")
+    KPI_preprocess.save(preprocessor(1.0), modelDir, path)
+    assert KPI_modelCache.load_model(path).preprocessor.mean[0] == 1.0
+
+    # 新的 model.h5 已经替换，preprocess.json 还是上一次的：暂不预测
+    bump_mtime(path, 5)
+    assert KPI_modelCache.load_model(path) is None
+    KPI_preprocess.save(preprocessor(2.0), modelDir, path)
+    assert KPI_modelCache.load_model(path).preprocessor.mean[0] == 2.0
+
+
+def test_registry_reloads_when_preprocess_changes(tmp_path, monkeypatch):
+    loads = []
+
+    def loader(path):
+        loads.append(path)
+        return KPI_modelCache.load_model(path)
+
+    registry = KPI_modelCache.ModelRegistry(maxSize=4, loader=loader)
+    monkeypatch.setattr(KPI_modelCache, "registry", registry)
+    modelConfig = dict(config, saveDirs=str(tmp_path))
+    modelDir = os.path.join(str(tmp_path), "kpi_a")
+    os.makedirs(modelDir)
+    KPI_npModel.save(identity_model(), os.path.join(modelDir, "model.npz"))
+    KPI_preprocess.save(preprocessor(1.0), modelDir)
+
+    first = KPI_modelCache.get_model("kpi_a", modelConfig)
+    assert KPI_modelCache.get_model("kpi_a", modelConfig) is first
+    assert len(loads) == 1
+    # 只有 preprocess.json 变化时也重新加载
+    KPI_preprocess.save(preprocessor(3.0), modelDir)
+    bump_mtime(os.path.join(modelDir, KPI_preprocess.fileName), 5)
+    second = KPI_modelCache.get_model("kpi_a", modelConfig)
+    assert len(loads) == 2
+    assert second.preprocessor.mean[0] == 3.0
+    # 窗口参数不同的模型不使用
+    assert KPI_modelCache.get_model("kpi_a", dict(modelConfig, STA_windowSize_left=10)) is None
+
+
+def fake_registry(maxSize, stamps):
+    # 不读文件：stamps 中的值作为修改时间，不在其中的路径视为文件不存在
+    loads = []
+
+    def loader(path):
+        loads.append(path)
+        return "model " + path + " " + str(stamps[path])
+
+    def stamp(path):
+        if path not in stamps:
+            raise OSError(path)
+        return stamps[path]
+
+    return KPI_modelCache.ModelRegistry(maxSize=maxSize, loader=loader, stamp=stamp), loads
+
+
+def test_registry_evicts_least_recently_used():
+    stamps = {"a": 1, "b": 1, "c": 1, "d": 1}
+    registry, loads = fake_registry(3, stamps)
+    for path in ["a", "b", "c"]:
+        registry.get(path)
+    # 命中 a 之后 b 最久未用，加载 d 时淘汰 b
+    registry.get("a")
+    registry.get("d")
+    assert list(registry.models) == ["c", "a", "d"]
+    assert loads == ["a", "b", "c", "d"]
+    registry.get("b")
+    assert list(registry.models) == ["a", "d", "b"]
+    assert loads[-1] == "b"
+    assert (registry.hits, registry.misses) == (1, 5)
+
+
+def test_registry_reload_and_missing_file_keep_order():
+    stamps = {"a": 1, "b": 1, "c": 1}
+    registry, loads = fake_registry(3, stamps)
+    for path in ["a", "b", "c"]:
+        registry.get(path)
+    # 修改时间变化：重新加载并移到最近使用的位置，不淘汰其他模型
+    stamps["a"] = 2
+    assert registry.get("a") == "model a 2"
+    assert list(registry.models) == ["b", "c", "a"]
+    # 文件删除：返回 None 并移出缓存
+    del stamps["b"]
+    assert registry.get("b") is None
+    assert list(registry.models) == ["c", "a"]
+    assert loads == ["a", "b", "c", "a"]
+
+
+def test_registry_resize():
+    stamps = dict((path, 1) for path in "abcde")
+    registry, loads = fake_registry(5, stamps)
+    for path in "abcde":
+        registry.get(path)
+    registry.get("a")
+    # 缩小时按最久未用的顺序淘汰
+    registry.resize(2)
+    assert list(registry.models) == ["e", "a"]
+    registry.get("b")
+    assert list(registry.models) == ["a", "b"]
+    # 扩大后不再淘汰
+    registry.resize(4)
+    for path in "cd":
+        registry.get(path)
+    assert list(registry.models) == ["a", "b", "c", "d"]
+
+
+def test_get_model_resizes_from_config(tmp_path, monkeypatch):
+    registry = KPI_modelCache.ModelRegistry(maxSize=8)
+    monkeypatch.setattr(KPI_modelCache, "registry", registry)
+    modelConfig = dict(config, saveDirs=str(tmp_path), modelCacheSize=1)
+    for kpiid in ["kpi_a", "kpi_b"]:
+        os.makedirs(os.path.join(str(tmp_path), kpiid))
+        KPI_npModel.save(identity_model(), os.path.join(str(tmp_path), kpiid, "model.npz"))
+        KPI_modelCache.get_model(kpiid, modelConfig)
+    assert registry.maxSize == 1
+    assert list(registry.models) == [KPI_modelCache.model_path("kpi_b", modelConfig)]
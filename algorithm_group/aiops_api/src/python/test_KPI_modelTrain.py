@@ -0,0 +1,95 @@
+# KPI_modelTrain：训练/检验数据的划分，kpi_train_model 的保存行为（需要 Keras，没有时跳过）
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import KPI_config
+import KPI_modelTrain
+
+
+def make_frame(start, n, seed=0):
+    rng = np.random.RandomState(seed)
+    ids = np.arange(start + 1, start + n + 1)
+    values = 10 + np.sin(ids / 20.0) + rng.normal(0, 0.1, n)
+    labels = (rng.rand(n) < 0.05).astype(int)
+    values[labels == 1] += 5
+    return pd.DataFrame({'id': ids, 'value': values,
+                         'timestamp': pd.date_range("2020-01-01", periods=start + n, freq="min")[start:].astype(str),
+                         'label': labels}, columns=['id', 'value', 'timestamp', 'label'])
+
+
+def train_config(tmp_path):
+    config = dict(KPI_config.modelConfig)
+    config.update({"saveDirs": str(tmp_path), "minTrainNum": 200, "max_epochs": 1, "b_size": 64,
+                   "plotMode": "off", "earlyStoppingPatience": 0})
+    return config
+
+
+def model_files(saveDir):
+    return dict((name, os.stat(os.path.join(saveDir, name)).st_mtime_ns)
+                for name in ["model.h5", "model.npz", "preprocess.json", "trainState.json"])
+
+
+def test_split_stays_inside_handled_data():
+    for handledRows, uu in [(1000, 0), (1000, 300), (5000, 1000), (150, 0), (100, 200)]:
+        historyData_length, newData_length = KPI_modelTrain.split_lengths(handledRows, uu, 0.7, 0.28)
+        assert newData_length >= 0
+        assert uu + max(historyData_length, 0) + newData_length <= max(handledRows, uu)
+    # uu 之后的行数决定两段的长度
+    assert KPI_modelTrain.split_lengths(1000, 300, 0.7, 0.28) == (int(700 * 0.7) - 100, int(700 * 0.28) - 100)
+    assert KPI_modelTrain.split_lengths(150, 0, 0.7, 0.28) == (5, 0)
+
+
+def test_empty_test_slice_is_skipped(tmp_path):
+    pytest.importorskip("keras")
+    config = train_config(tmp_path)
+    config["nRate"] = 0.05
+    saveDir = os.path.join(str(tmp_path), "kpi_a")
+    KPI_modelTrain.kpi_train_model("kpi_a", make_frame(0, 600), config)
+    assert os.path.exists(os.path.join(saveDir, "model.npz"))
+    with open(os.path.join(saveDir, "log.txt")) as f:
+        assert "没有新的数据，跳过测试" in f.read()
+
+
+def test_no_new_rows_keeps_saved_model(tmp_path):
+    pytest.importorskip("keras")
+    config = train_config(tmp_path)
+    saveDir = os.path.join(str(tmp_path), "kpi_a")
+    frame = make_frame(0, 600)
+    KPI_modelTrain.kpi_train_model("kpi_a", frame, config)
+    before = model_files(saveDir)
+
+    # 同样的数据再训练一次：没有新增的行，模型文件不改写
+    KPI_modelTrain.kpi_train_model("kpi_a", frame, config)
+    assert model_files(saveDir) == before
+
+    # 训练参数变化时重新训练
+    config["max_epochs"] = 2
+    KPI_modelTrain.kpi_train_model("kpi_a", frame, config)
+    after = model_files(saveDir)
+    assert after["model.h5"] != before["model.h5"]
+    assert after["trainState.json"] != before["trainState.json"]
+
+    # 有新增数据时继续训练
+    KPI_modelTrain.kpi_train_model("kpi_a", pd.concat([frame, make_frame(600, 100, seed=1)]), config)
+    assert model_files(saveDir)["model.h5"] != after["model.h5"]
+
+
+def test_scaler_saved_with_weights(tmp_path):
+    pytest.importorskip("keras")
+    import KPI_modelCache
+    import KPI_npModel
+    import KPI_preprocess
+
+    config = train_config(tmp_path)
+    saveDir = os.path.join(str(tmp_path), "kpi_a")
+    KPI_modelTrain.kpi_train_model("kpi_a", make_frame(0, 600), config)
+    embedded = KPI_npModel.load(os.path.join(saveDir, "model.npz")).extra["preprocess"]
+    preprocessor = KPI_preprocess.load(saveDir, os.path.join(saveDir, "model.h5"))
+    assert embedded == preprocessor.to_dict()
+    # preprocess.json 在模型文件之后写入
+    files = model_files(saveDir)
+    assert files["model.h5"] <= files["model.npz"] <= files["preprocess.json"]
+    assert KPI_modelCache.get_model("kpi_a", config) is not None
@@ -0,0 +1,122 @@
+# KPI_npModel 的前向推理与 Keras 一致：有 Keras 时直接对比 model.predict，没有时对比 float64 的参考实现
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+import KPI_npModel
+
+rtol = 1e-4
+atol = 1e-5
+
+
+def sample_x(n=2000, seed=0):
+    # 标准化后的特征大致在这个范围，另加一些远离 0 的点
+    rng = np.random.RandomState(seed)
+    x = rng.normal(0, 2, (n, 3)).astype(np.float32)
+    x[:20] *= 50
+    return x
+
+
+def reference_forward(x, kernels, biases, activationNames):
+    z = np.asarray(x, dtype=np.float64)
+    for kernel, bias, name in zip(kernels, biases, activationNames):
+        z = z @ np.asarray(kernel, dtype=np.float64) + np.asarray(bias, dtype=np.float64)
+        if name == "relu":
+            z = np.maximum(z, 0)
+        elif name == "sigmoid":
+            z = np.exp(-np.logaddexp(0, -z))
+        elif name == "tanh":
+            z = np.tanh(z)
+    return z
+
+
+def test_saved_weights_match_reference(tmp_path):
+    # Dense(128)-Dense(128)-Dense(1) 的随机权重，保存后读回
+    rng = np.random.RandomState(1)
+    kernels = [rng.normal(0, 0.4, (3, 128)), rng.normal(0, 0.1, (128, 128)), rng.normal(0, 0.1, (128, 1))]
+    biases = [rng.normal(0, 0.1, 128), rng.normal(0, 0.1, 128), rng.normal(0, 0.1, 1)]
+    names = ["relu", "relu", "sigmoid"]
+    path = str(tmp_path / "model.npz")
+    KPI_npModel.save(KPI_npModel.NumpyModel(kernels, biases, names), path)
+    model = KPI_npModel.load(path)
+    x = sample_x()
+    expected = reference_forward(x, [k.astype(np.float32) for k in kernels], [b.astype(np.float32) for b in biases],
+                                 names)
+    np.testing.assert_allclose(model.predict(x), expected, rtol=rtol, atol=atol)
+    # 分批与不分批的结果相同
+    np.testing.assert_array_equal(model.predict(x, batch_size=300), model.predict(x))
+
+
+def test_embedding_matches_reference(tmp_path):
+    rng = np.random.RandomState(2)
+    embedding = rng.normal(0, 1, (5, 4))
+    kernels = [rng.normal(0, 0.3, (7, 16)), rng.normal(0, 0.3, (16, 1))]
+    biases = [rng.normal(0, 0.1, 16), rng.normal(0, 0.1, 1)]
+    path = str(tmp_path / "model.npz")
+    KPI_npModel.save(KPI_npModel.NumpyModel(kernels, biases, ["relu", "sigmoid"], embedding), path)
+    model = KPI_npModel.load(path)
+    x = sample_x(500)
+    index = rng.randint(0, 5, 500)
+    expected = reference_forward(np.concatenate((x, embedding[index].astype(np.float32)), axis=1),
+                                 [k.astype(np.float32) for k in kernels], [b.astype(np.float32) for b in biases],
+                                 ["relu", "sigmoid"])
+    np.testing.assert_allclose(model.predict([x, index]), expected, rtol=rtol, atol=atol)
+
+
+def test_sigmoid_saturates_without_warning():
+    z = np.array([[-1000.0], [-100.0], [0.0], [100.0], [1000.0]], dtype=np.float32)
+    model = KPI_npModel.NumpyModel([np.ones((1, 1))], [np.zeros(1)], ["sigmoid"])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        with np.errstate(all="raise", under="ignore"):
+            result = model.predict(z)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result[:, 0], [0.0, 0.0, 0.5, 1.0, 1.0], atol=1e-30)
+
+
+def test_unsupported_activation():
+    with pytest.raises(ValueError):
+        KPI_npModel.NumpyModel([np.zeros((3, 1))], [np.zeros(1)], ["softmax"])
+
+
+def train_briefly(model, x, y, inputs=None):
+    model.compile(loss='binary_crossentropy', optimizer='adam')
+    model.fit(x if inputs is None else inputs, y, epochs=2, batch_size=64, verbose=0)
+
+
+def test_matches_keras_dense_model(tmp_path):
+    K = pytest.importorskip("keras")
+    import KPI_modelTrain
+
+    x = sample_x()
+    y = (np.abs(x[:, :1]) > 3).astype(np.float32)
+    model = KPI_modelTrain.build_model()
+    train_briefly(model, x, y)
+    path = str(tmp_path / "model.npz")
+    assert KPI_npModel.export_model(model, path, x[:1000])
+    np.testing.assert_allclose(KPI_npModel.load(path).predict(x), model.predict(x, verbose=0), rtol=rtol, atol=atol)
+
+    # 从保存的 model.h5 读回的 Keras 模型导出，结果同样一致
+    model.save(str(tmp_path / "model.h5"))
+    loaded = K.models.load_model(str(tmp_path / "model.h5"))
+    os.remove(path)
+    assert KPI_npModel.export_model(loaded, path)
+    np.testing.assert_allclose(KPI_npModel.load(path).predict(x), loaded.predict(x, verbose=0),
+                               rtol=rtol, atol=atol)
+
+
+def test_matches_keras_group_model(tmp_path):
+    pytest.importorskip("keras")
+    import KPI_groupModel
+
+    x = sample_x()
+    index = np.arange(len(x)) % 4
+    y = (np.abs(x[:, :1]) > 3).astype(np.float32)
+    model = KPI_groupModel.build_model(4, 8)
+    train_briefly(model, x, y, [x, index])
+    path = str(tmp_path / "model.npz")
+    assert KPI_npModel.export_model(model, path, [x[:1000], index[:1000]])
+    np.testing.assert_allclose(KPI_npModel.load(path).predict([x, index]), model.predict([x, index], verbose=0),
+                               rtol=rtol, atol=atol)
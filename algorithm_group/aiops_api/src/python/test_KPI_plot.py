@@ -0,0 +1,70 @@
+# KPI_plot：deferred 模式只留下标记，由 render_pending 在有界进程池中绘制
+import os
+import subprocess
+
+import numpy as np
+import pytest
+
+import KPI_featureStore
+import KPI_plot
+
+
+def make_kpi_dir(root, name, rows=7000):
+    saveDir = os.path.join(str(root), name) + "/"
+    store = KPI_featureStore.FeatureStore(saveDir + "features/", 20, 0, 0.5)
+    ids = np.arange(1, rows + 1)
+    store.update(ids, np.datetime64("2020-01-01T00:00:00", "us") + ids.astype("timedelta64[m]"),
+                 np.sin(ids / 50.0), (ids % 97 == 0).astype(np.float64))
+    plotData = {"names": ["检验"], "loss": np.linspace(1, 0.1, 5), "val_loss": np.linspace(1, 0.2, 5),
+                "0_true": np.zeros(100), "0_pred": np.zeros(100, dtype=np.float32),
+                "0_features": np.zeros((100, 3))}
+    return saveDir, store.directory, plotData
+
+
+def test_decimate_keeps_envelope():
+    values = np.sin(np.arange(100000) / 100.0)
+    values[12345] = 5
+    x, y = KPI_plot.decimate(values, 1000)
+    assert len(y) <= 1000
+    assert y.max() == 5
+    assert y.min() == values.min()
+
+
+def test_deferred_leaves_marker_without_starting_processes(tmp_path, monkeypatch):
+    def no_process(*args, **kwargs):
+        raise AssertionError("render must not start a process")
+    monkeypatch.setattr(subprocess, "Popen", no_process)
+    saveDir, rawDir, plotData = make_kpi_dir(tmp_path, "kpi_a")
+    KPI_plot.render(saveDir, rawDir, plotData, {"plotMode": "deferred"})
+    assert os.path.exists(os.path.join(saveDir, KPI_plot.pendingName))
+    assert os.path.exists(os.path.join(saveDir, "plotData.npz"))
+    assert not os.path.exists(os.path.join(saveDir, "trainLoss.png"))
+
+
+def test_render_pending_uses_bounded_pool(tmp_path, monkeypatch):
+    pytest.importorskip("matplotlib")
+    import KPI_trainPool
+    monkeypatch.setattr(KPI_trainPool, "pollInterval", 0.05)
+    calls = []
+    trainAll = KPI_trainPool.train_all
+
+    def record(names, target, workers=2, timeout=7200, threads=1):
+        calls.append((list(names), workers, threads))
+        return trainAll(names, target, workers=workers, timeout=timeout, threads=threads)
+    monkeypatch.setattr(KPI_trainPool, "train_all", record)
+
+    saveDirs = []
+    for name in ["kpi_a", "kpi_b", "kpi_c"]:
+        saveDir, rawDir, plotData = make_kpi_dir(tmp_path, name)
+        KPI_plot.render(saveDir, rawDir, plotData, {"plotMode": "deferred"})
+        saveDirs.append(saveDir)
+    # 没有待绘制标记的目录被跳过
+    results = KPI_plot.render_pending(saveDirs + [str(tmp_path / "kpi_none") + "/"], workers=2, timeout=120)
+    assert results == dict((saveDir, "ok") for saveDir in saveDirs)
+    # 绘图子进程不设置 TensorFlow 线程数
+    assert calls == [(saveDirs, 2, None)]
+    for saveDir in saveDirs:
+        assert not os.path.exists(os.path.join(saveDir, KPI_plot.pendingName))
+        assert os.path.exists(os.path.join(saveDir, "trainLoss.png"))
+        assert os.path.exists(os.path.join(saveDir, "rowDat", "1原始数据.png"))
+    assert KPI_plot.render_pending(saveDirs) == {}
@@ -0,0 +1,146 @@
+# KPI_shard：一致性哈希的迁移比例、租约的过期与接管，以及多个预测进程分片重叠时每行只写一次
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import KPI_benchmark
+import KPI_db
+import KPI_npModel
+import KPI_shard
+
+kpiNames = ["kpi_" + kind + "_m" + str(i) + "_minute" for kind in ("all", "service", "instance") for i in range(700)]
+
+
+def test_ring_moves_about_one_share():
+    # 分片数从 n 变为 n+1 时只有约 1/(n+1) 的 KPI 换分片，而且都换到新增的分片
+    for n in range(1, 8):
+        before = KPI_shard.HashRing(n)
+        after = KPI_shard.HashRing(n + 1)
+        moved = [name for name in kpiNames if before.owner(name) != after.owner(name)]
+        assert all(after.owner(name) == n for name in moved)
+        share = len(moved) / float(len(kpiNames))
+        assert 0.6 / (n + 1) < share < 1.5 / (n + 1), (n, share)
+
+
+def test_shards_partition_names():
+    for count in (1, 2, 5):
+        owned = [KPI_shard.Shard(index, count).filter(kpiNames) for index in range(count)]
+        assert sorted(sum(owned, [])) == sorted(kpiNames)
+        # 各分片大致均衡
+        assert min(len(names) for names in owned) > 0.5 * len(kpiNames) / count
+    with pytest.raises(ValueError):
+        KPI_shard.Shard(2, 2)
+
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def lease_db(monkeypatch):
+    db_name = "lease_test"
+    monkeypatch.setitem(KPI_db.databases, db_name, KPI_db.sqlite_database())
+    return db_name
+
+
+def test_lease_expiry_and_takeover(lease_db):
+    clock = Clock(1000.0)
+    first = KPI_shard.Leases(lease_db, owner="a", ttl=10, clock=clock)
+    second = KPI_shard.Leases(lease_db, owner="b", ttl=10, clock=clock)
+    names = ["kpi_all_b_minute", "kpi_all_a_minute"]
+    assert first.claim(names) == names
+    assert second.claim(names) == []
+
+    # 续约后未过期，其他进程不能接管
+    clock.now = 1008.0
+    assert first.claim(names[:1]) == names[:1]
+    clock.now = 1012.0
+    assert second.claim(names) == names[1:]
+    assert first.claim(names) == names[:1]
+
+    # 持有者停止续约，过期后被接管
+    clock.now = 1030.0
+    assert second.claim(names) == names
+    assert first.claim(names) == []
+
+    # 释放后其他进程立即可以拿到
+    assert second.release(names[:1]) == 1
+    assert first.claim(names) == names[:1]
+    assert second.release() == 1
+    assert first.claim(names) == names
+
+
+def test_lease_claim_in_chunks(lease_db, monkeypatch):
+    monkeypatch.setattr(KPI_db, "updateChunkRows", 7)
+    clock = Clock(0.0)
+    first = KPI_shard.Leases(lease_db, owner="a", ttl=10, clock=clock)
+    second = KPI_shard.Leases(lease_db, owner="b", ttl=10, clock=clock)
+    names = kpiNames[:30]
+    assert first.claim(names[::2]) == names[::2]
+    assert second.claim(names) == names[1::2]
+    clock.now = 20.0
+    assert second.claim(names) == names
+
+
+def make_kpi_database(path, saveDirs, names, rows, predicted):
+    # 每个 KPI 表前 predicted 行已有预测值；触发器把每次写入 predict 记到 writes 表
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE writes (tbl TEXT, id INTEGER)")
+    for name in names:
+        conn.execute("CREATE TABLE " + name + " (id INTEGER PRIMARY KEY, value REAL, time TEXT, predict REAL)")
+        conn.executemany("INSERT INTO " + name + " VALUES (?, ?, ?, ?)",
+                         [(i, 100.0 + i % 17, "2020-01-01 %02d:%02d:00" % (i // 60 % 24, i % 60),
+                           0.0 if i <= predicted else None) for i in range(1, rows + 1)])
+        conn.execute("CREATE TRIGGER w_" + name + " AFTER UPDATE OF predict ON " + name +
+                     " BEGIN INSERT INTO writes VALUES ('" + name + "', new.id); END")
+        os.makedirs(os.path.join(saveDirs, name))
+        KPI_npModel.save(KPI_benchmark.random_dense_model(), os.path.join(saveDirs, name, "model.npz"))
+    conn.commit()
+    conn.close()
+
+
+def test_overlapping_shards_write_each_row_once(tmp_path):
+    pytest.importorskip("apscheduler")
+    pytest.importorskip("pytz")
+    moduleDir = os.path.dirname(os.path.abspath(KPI_shard.__file__))
+    saveDirs = str(tmp_path / "models")
+    with open(os.path.join(moduleDir, "KPIautoPredictConfig.ini")) as f:
+        ini = f.read()
+    for key, value in (("saveDirs", saveDirs + "/"), ("metricsPort", "0"), ("metricsLog", ""), ("plotMode", "off")):
+        ini = re.sub("(?m)^" + key + "=.*$", key + "=" + value, ini)
+    # 预测进程从当前目录读取配置
+    with open(str(tmp_path / "KPIautoPredictConfig.ini"), "w") as f:
+        f.write(ini)
+
+    names = ["kpi_all_m" + str(i) + "_minute" for i in range(12)]
+    path = str(tmp_path / "kpi.sqlite")
+    make_kpi_database(path, saveDirs, names, rows=1600, predicted=400)
+
+    # 0/2 与 1/3 负责的 KPI 有重叠（相当于分片数从 2 调整为 3 的过程中），只有持有租约的进程预测
+    processes = [subprocess.Popen([sys.executable, os.path.join(moduleDir, "autoPredictKPI.py"), "--sqlite", path,
+                                   "--ticks", "3", "--interval", "0.5", "--lease",
+                                   "--shard-index", str(index), "--shard-count", str(count)],
+                                  cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                 for index, count in ((0, 2), (1, 2), (1, 3))]
+    for process in processes:
+        output = process.communicate(timeout=300)[0]
+        assert process.returncode == 0, output.decode("utf-8", "replace")
+
+    conn = sqlite3.connect(path)
+    for name in names:
+        assert conn.execute("SELECT COUNT(*) FROM " + name + " WHERE predict IS NULL").fetchone()[0] == 0, name
+    written = conn.execute("SELECT tbl, id, COUNT(*) FROM writes GROUP BY tbl, id").fetchall()
+    assert len(written) == len(names) * 1200
+    assert all(row[2] == 1 for row in written)
+    # 进程退出时释放了租约
+    assert conn.execute("SELECT COUNT(*) FROM predict_lease").fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,100 @@
+# KPI_sweep：多组窗口一次计算的特征与逐组调用 window_features 相同；候选按检验得分排序选出最优
+import os
+
+import numpy as np
+import pytest
+
+import KPI_benchmark
+import KPI_feature
+import KPI_sweep
+
+
+def make_values(n, seed=0):
+    rng = np.random.RandomState(seed)
+    values = 1000 + 10 * np.sin(np.arange(n) / 13.0) + rng.normal(0, 2, n)
+    values[rng.rand(n) < 0.03] += 40
+    # 并列值
+    values[50:80] = 1000
+    return values
+
+
+windowCandidates = [(20, 0, 0.5), (20, 0, 50.0), (10, 10, 0.5), (15, 5, 95.0), (5, 0, 0.0), (3, 2, 100.0),
+                    (1, 0, 50.0), (0, 4, 25.0), (40, 3, 5.0)]
+
+
+@pytest.mark.parametrize("n", [2000, 43, 20, 5, 0])
+def test_multi_window_matches_window_features(n):
+    values = make_values(n)
+    computed = KPI_feature.multi_window_features(values, windowCandidates)
+    assert set(computed) == set(windowCandidates)
+    for left, right, fws in windowCandidates:
+        positions, features = computed[(left, right, fws)]
+        expectedPositions, expectedFeatures = KPI_feature.window_features(values, left, right, fws)
+        np.testing.assert_array_equal(positions, expectedPositions)
+        np.testing.assert_allclose(features[:, 1:], expectedFeatures[:, 1:], rtol=1e-12)
+        np.testing.assert_allclose(features[:, 0], expectedFeatures[:, 0], rtol=1e-7, atol=1e-9)
+
+
+def test_multi_window_rejects_empty_window():
+    with pytest.raises(ValueError):
+        KPI_feature.multi_window_features(make_values(100), [(0, 0, 0.5)])
+
+
+def result(left, right, checkScore, valLoss, trainScore=0.0):
+    return {"params": {"STA_windowSize_left": left, "STA_windowSize_right": right, "STA_fws": 0.5,
+                       "b_size": 0, "max_epochs": 1},
+            "checkScore": checkScore, "valLoss": valLoss, "trainScore": trainScore}
+
+
+def test_rank_and_select():
+    results = [result(20, 0, 0.6, 0.1), result(40, 0, 0.8, 0.3), result(10, 0, 0.8, 0.2),
+               result(5, 0, 0.8, 0.2), result(60, 0, None, None, trainScore=0.9), result(30, 0, 0.7, None)]
+    ranked = sorted(results, key=KPI_sweep.rank_key)
+    # 检验得分高的在前；没有检验数据时用训练得分；得分相同时 val_loss 低的在前，再相同时窗口小的在前
+    assert [r["params"]["STA_windowSize_left"] for r in ranked] == [60, 5, 10, 40, 30, 20]
+    assert KPI_sweep.select(results) is ranked[0]
+    assert KPI_sweep.select([]) is None
+
+
+def test_candidates_skip_empty_window():
+    candidateList = KPI_sweep.candidates([0, 20], [0, 5], [0.5], [0, 256], [10])
+    assert len(candidateList) == 6
+    assert all(c["STA_windowSize_left"] + c["STA_windowSize_right"] > 0 for c in candidateList)
+    assert KPI_sweep.parse_list("auto, 64,", int) == [0, 64]
+
+
+def test_split_rows_inside_features():
+    manifest = {"rows": 1200, "split": {"uu": 100, "hRate": 0.7, "nRate": 0.28, "traintestRate": 0.8}}
+    x = np.arange(1000, dtype=np.float32).reshape(-1, 1)
+    (train_x, _), (val_x, _), (check_x, _) = KPI_sweep.split_rows(x, x, manifest)
+    # 900 行中 530 行历史（其中 0.8 训练），之后 152 行检验，都在 x 之内且互不重叠
+    assert (len(train_x), len(val_x), len(check_x)) == (424, 106, 152)
+    assert train_x[0, 0] == 100 and val_x[0, 0] == 524 and check_x[0, 0] == 630
+
+
+def test_prepare_saves_and_reuses_windows(tmp_path, monkeypatch):
+    modelConfig = dict(KPI_benchmark.bench_config(str(tmp_path)), minTrainNum=100)
+    kpi = KPI_benchmark.synthetic_kpi(1500, seed=2)
+    candidateList = KPI_sweep.candidates([10, 20], [0, 3], [0.5, 50.0], [0], [1])
+    assert KPI_sweep.prepare("kpi_a", KPI_benchmark.synthetic_chunks(kpi, 400), candidateList, modelConfig) == 8
+    sweepDir = KPI_sweep.sweep_dir("kpi_a", modelConfig)
+    for params in candidateList:
+        window = KPI_sweep.window_of(params)
+        positions, features = KPI_feature.window_features(kpi['value'], *window)
+        np.testing.assert_allclose(np.load(sweepDir + KPI_sweep.window_file(window, "x")),
+                                   features.astype(np.float32), rtol=1e-6)
+        np.testing.assert_array_equal(np.load(sweepDir + KPI_sweep.window_file(window, "y"))[:, 0],
+                                      kpi['label'][positions])
+
+    # 数据没有变化时只计算新增的窗口
+    computed = []
+    multiWindow = KPI_feature.multi_window_features
+
+    def record(values, candidates):
+        computed.extend(candidates)
+        return multiWindow(values, candidates)
+    monkeypatch.setattr(KPI_feature, "multi_window_features", record)
+    moreCandidates = candidateList + KPI_sweep.candidates([40], [0], [0.5], [0], [1])
+    KPI_sweep.prepare("kpi_a", [], moreCandidates, modelConfig)
+    assert computed == [(40, 0, 0.5)]
+    assert os.path.exists(sweepDir + KPI_sweep.window_file([40, 0, 0.5], "x"))
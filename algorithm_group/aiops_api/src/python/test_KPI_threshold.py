@@ -0,0 +1,86 @@
+# KPI_threshold.best_threshold 与原 kpi_train_model 中逐点循环的阈值搜索（KPI_benchmark.legacy_best_threshold）结果相同
+import numpy as np
+import pytest
+
+import KPI_benchmark
+import KPI_threshold
+
+
+def make_case(kind, n=600, seed=0, dtype=np.float32):
+    rng = np.random.RandomState(seed)
+    labels = (rng.rand(n) < 0.1).astype(np.float32).reshape(-1, 1)
+    if kind == "random":
+        predicted = rng.rand(n, 1)
+    elif kind == "separable":
+        predicted = np.where(labels == 1, rng.uniform(0.6, 1, (n, 1)), rng.uniform(0, 0.4, (n, 1)))
+    elif kind == "ties":
+        # 得分恰好落在阈值网格上，比较时 > 与 >= 的差别会体现出来
+        predicted = rng.randint(0, 51, (n, 1)) * 0.02
+    elif kind == "all_negative":
+        predicted = rng.rand(n, 1)
+        labels[:] = 0
+    elif kind == "all_positive":
+        predicted = rng.rand(n, 1)
+        labels[:] = 1
+    elif kind == "constant":
+        predicted = np.full((n, 1), 0.5)
+    elif kind == "saturated":
+        # sigmoid 输出饱和：大量 0 和 1
+        predicted = rng.choice([0.0, 1.0, 1e-7, 0.9999999], (n, 1))
+    return predicted.astype(dtype), labels
+
+
+kinds = ["random", "separable", "ties", "all_negative", "all_positive", "constant", "saturated"]
+
+
+@pytest.mark.parametrize("kind", kinds)
+@pytest.mark.parametrize("step", [0.02, 0.05, 0.1, 0.3])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_matches_legacy_loop(kind, step, dtype):
+    for seed in range(3):
+        predicted, labels = make_case(kind, seed=seed, dtype=dtype)
+        expected = KPI_benchmark.legacy_best_threshold(predicted, labels, step)
+        assert KPI_threshold.best_threshold(predicted, labels, step) == expected
+
+
+@pytest.mark.parametrize("kind", kinds)
+def test_scores_match_legacy_per_threshold(kind):
+    predicted, labels = make_case(kind, n=300)
+    grid = KPI_threshold.legacy_grid(0.02)
+    scores = KPI_threshold.threshold_scores(predicted, labels, grid)
+    for tc, score in zip(grid, scores):
+        # 与原 testTC 一样用 Python float 与 float32 得分比较
+        positive = labels[:, 0] == 1
+        detected = np.array([p > float(tc) for p in predicted[:, 0]])
+        if positive.sum() == 0:
+            assert score == 1
+        else:
+            assert score == pytest.approx(((detected & positive).sum() - (detected & ~positive).sum()) /
+                                          float(positive.sum()))
+
+
+def test_all_negative_and_all_positive():
+    # 没有异常时每个阈值得分都是 1，取第一个阈值
+    predicted, labels = make_case("all_negative")
+    assert KPI_threshold.best_threshold(predicted, labels, 0.02) == (0.02, 1.0)
+    # 全是异常时阈值越低越好：取网格上第一个阈值
+    predicted, labels = make_case("all_positive")
+    threshold, score = KPI_threshold.best_threshold(predicted, labels, 0.02)
+    assert threshold == 0.02 and score == pytest.approx((predicted > 0.02).mean())
+    # 没有严格大于 0 的得分时返回 (startTC, 0)
+    assert KPI_threshold.best_threshold(np.zeros((10, 1), np.float32), np.ones((10, 1)), 0.02) == (0, 0)
+
+
+@pytest.mark.parametrize("kind", ["random", "separable", "ties", "saturated"])
+def test_exact_search_is_optimal(kind):
+    predicted, labels = make_case(kind)
+    threshold, score = KPI_threshold.best_threshold(predicted, labels, step=0)
+    candidates = np.unique(predicted)
+    candidates = candidates[candidates > 0]
+    bruteForce = KPI_threshold.threshold_scores(predicted, labels, candidates)
+    if bruteForce.max() <= 0:
+        assert (threshold, score) == (0, 0)
+        return
+    assert score == pytest.approx(bruteForce.max())
+    # 精确搜索不差于任何网格
+    assert score >= KPI_threshold.best_threshold(predicted, labels, 0.02)[1] - 1e-12
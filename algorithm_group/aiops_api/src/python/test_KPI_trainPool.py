@@ -0,0 +1,70 @@
+# KPI_trainPool：子进程从启动起就带着线程数限制，失败和超时按 KPI 返回
+import json
+import os
+import time
+
+import KPI_trainPool
+
+
+def record_environ(path):
+    # 子进程中执行：记录线程数相关的环境变量，以及解释器启动时的环境变量（Linux 的 /proc/self/environ）
+    names = list(KPI_trainPool.thread_environ(1))
+    result = {"current": dict((name, os.environ.get(name)) for name in names)}
+    if os.path.exists("/proc/self/environ"):
+        with open("/proc/self/environ", "rb") as f:
+            items = [item.decode("utf-8", "replace") for item in f.read().split(b"\0") if b"=" in item]
+        initial = dict(item.split("=", 1) for item in items)
+        result["initial"] = dict((name, initial.get(name)) for name in names)
+    with open(path, "w") as f:
+        json.dump(result, f)
+
+
+def record_modules(path):
+    # 子进程中执行：记录是否导入了 TensorFlow，以及线程数相关的环境变量
+    import sys
+    names = list(KPI_trainPool.thread_environ(1))
+    with open(path, "w") as f:
+        json.dump({"tensorflow": "tensorflow" in sys.modules,
+                   "environ": dict((name, os.environ.get(name)) for name in names)}, f)
+
+
+def fail(path):
+    raise RuntimeError(path)
+
+
+def sleep_long(path):
+    time.sleep(60)
+
+
+def test_thread_limits_reach_child(tmp_path, monkeypatch):
+    monkeypatch.setattr(KPI_trainPool, "pollInterval", 0.05)
+    monkeypatch.setenv("OMP_NUM_THREADS", "8")
+    monkeypatch.delenv("TF_NUM_INTRAOP_THREADS", raising=False)
+    paths = [str(tmp_path / ("kpi_%d.json" % i)) for i in range(3)]
+    results = KPI_trainPool.train_all(paths, record_environ, workers=2, threads=3)
+    assert results == dict((path, "ok") for path in paths)
+    for path in paths:
+        with open(path) as f:
+            recorded = json.load(f)
+        assert recorded["current"] == KPI_trainPool.thread_environ(3)
+        assert recorded.get("initial", recorded["current"]) == KPI_trainPool.thread_environ(3)
+    # 父进程的环境变量不变
+    assert os.environ["OMP_NUM_THREADS"] == "8"
+    assert "TF_NUM_INTRAOP_THREADS" not in os.environ
+
+
+def test_non_training_task_skips_tensorflow(tmp_path, monkeypatch):
+    monkeypatch.setattr(KPI_trainPool, "pollInterval", 0.05)
+    monkeypatch.delenv("TF_NUM_INTRAOP_THREADS", raising=False)
+    path = str(tmp_path / "plot.json")
+    assert KPI_trainPool.train_all([path], record_modules, workers=1, threads=None) == {path: "ok"}
+    with open(path) as f:
+        recorded = json.load(f)
+    assert not recorded["tensorflow"]
+    assert recorded["environ"]["TF_NUM_INTRAOP_THREADS"] is None
+
+
+def test_failure_and_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(KPI_trainPool, "pollInterval", 0.05)
+    assert KPI_trainPool.train_all(["kpi_fail"], fail, workers=1) == {"kpi_fail": "failed(1)"}
+    assert KPI_trainPool.train_all(["kpi_slow"], sleep_long, workers=1, timeout=1) == {"kpi_slow": "timeout"}
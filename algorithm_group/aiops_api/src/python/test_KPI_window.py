@@ -0,0 +1,95 @@
+# KPI_window：逐点推入（以及重启后 restore 再推入）得到的特征与 KPI_feature.window_features 一致
+import numpy as np
+import pytest
+
+import KPI_feature
+import KPI_window
+
+rtol = 1e-9
+
+
+def make_values(n, seed=0):
+    # 有较大的基数、重复值和突变点，覆盖平方和的抵消误差和分位数的并列值
+    rng = np.random.RandomState(seed)
+    values = 1e6 + 10 * np.sin(np.arange(n) / 7.0) + rng.normal(0, 3, n)
+    values[rng.rand(n) < 0.05] *= 1.5
+    values[100:140] = 1e6
+    return np.round(values, 2)
+
+
+def expected_features(values, left, right, fws, start=0):
+    positions, features = KPI_feature.window_features(values, left, right, fws)
+    keep = positions >= start
+    return positions[keep], features[keep]
+
+
+def push_all(state, values, start=0, pending=True):
+    ids, features = [], []
+    for i in range(start, len(values)):
+        result = state.push(i, values[i], pending)
+        if result is not None:
+            ids.append(result[0])
+            features.append(result[1])
+    return np.array(ids, dtype=np.int64), np.array(features).reshape(-1, 3)
+
+
+def assert_features_equal(actual, expected, values):
+    # 方差由累加的平方和得到，误差按数值的量级给出绝对容差（窗口内全相同时方差为 0）
+    np.testing.assert_array_equal(actual[0], expected[0])
+    np.testing.assert_allclose(actual[1][:, 1:], expected[1][:, 1:], rtol=rtol)
+    np.testing.assert_allclose(actual[1][:, 0], expected[1][:, 0], rtol=rtol, atol=1e-15 * np.abs(values).max() ** 2)
+
+
+@pytest.mark.parametrize("left,right,fws", [(20, 0, 0.5), (10, 5, 50.0), (3, 1, 95.0), (1, 0, 0.0)])
+def test_push_matches_window_features(left, right, fws, monkeypatch):
+    # refreshEvery 调小，覆盖重新求和
+    monkeypatch.setattr(KPI_window.SlidingWindow, "refreshEvery", 97)
+    values = make_values(2000)
+    state = KPI_window.KpiWindowState(left, right, fws, historyNum=0)
+    assert_features_equal(push_all(state, values), expected_features(values, left, right, fws), values)
+
+
+@pytest.mark.parametrize("left,right", [(20, 0), (10, 5), (3, 1)])
+def test_history_num_and_pending(left, right):
+    values = make_values(500)
+    state = KPI_window.KpiWindowState(left, right, 0.5, historyNum=200)
+    ids, features = push_all(state, values)
+    expected = expected_features(values, left, right, 0.5, start=200)
+    assert_features_equal((ids, features), expected, values)
+    # 不需要预测的行不输出
+    state = KPI_window.KpiWindowState(left, right, 0.5, historyNum=0)
+    assert len(push_all(state, values, pending=False)[0]) == 0
+
+
+@pytest.mark.parametrize("left,right", [(20, 0), (10, 5), (3, 1), (4, 2)])
+@pytest.mark.parametrize("blockRows", [3, 60, 400])
+def test_restore_after_restart(left, right, blockRows):
+    # 与 autoPredictKPI 重启后的 warm-up 相同：先用一段连续读取的数据 restore（这段的特征已批量算过），再逐点推入
+    values = make_values(700, seed=1)
+    ids = np.arange(blockRows, dtype=np.int64)
+    state = KPI_window.KpiWindowState(left, right, 0.5, historyNum=0)
+    state.restore(ids, values[:blockRows], np.ones(blockRows, dtype=bool), blockRows)
+    assert state.lastId == blockRows - 1
+
+    actual = push_all(state, values, start=blockRows)
+    # 批量计算时窗口还不完整的最后 right-1 个点在 restore 后等待，之后的推入补上它们的特征
+    firstPending = blockRows - max(right - 1, 0)
+    assert_features_equal(actual, expected_features(values, left, right, 0.5, start=firstPending), values)
+
+
+def test_restore_keeps_scorable_flags():
+    values = make_values(100)
+    state = KPI_window.KpiWindowState(10, 5, 0.5, historyNum=0)
+    scorable = np.zeros(50, dtype=bool)
+    scorable[-1] = True
+    state.restore(np.arange(50), values[:50], scorable, 50)
+    ids = push_all(state, values, start=50)[0]
+    # 等待中的点只有标记为需要预测的那个输出
+    assert ids[0] == 49
+    assert list(ids[1:]) == list(range(50, 96))
+
+
+def test_matches_after_param_change():
+    state = KPI_window.KpiWindowState(20, 0, 0.5, 100)
+    assert state.matches(20, 0, 0.5, 100)
+    assert not state.matches(20, 1, 0.5, 100)
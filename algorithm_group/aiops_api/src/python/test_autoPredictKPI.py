@@ -0,0 +1,267 @@
+# autoPredictKPI 的预测 tick（SQLite 替身库，见 KPI_benchmark.standin_database）：
+# 没有模型的 KPI 由在线检测器打分，模型生成后改用模型；只访问有新数据的表；
+# 重叠的 tick 合并为一次重跑；一个 KPI 出错不影响其他 KPI
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import KPI_config
+
+pytest.importorskip("apscheduler")
+pytest.importorskip("pytz")
+# 导入时按配置打开阶段日志，测试不写
+KPI_config.metricsLog = ""
+import autoPredictKPI  # noqa: E402
+import KPI_benchmark  # noqa: E402
+import KPI_db  # noqa: E402
+import KPI_discovery  # noqa: E402
+import KPI_feature  # noqa: E402
+import KPI_modelCache  # noqa: E402
+import KPI_metrics  # noqa: E402
+import KPI_npModel  # noqa: E402
+import KPI_predict  # noqa: E402
+import KPI_shard  # noqa: E402
+
+tableRows = 600
+pendingRows = 300
+
+
+@pytest.fixture
+def predictor(tmp_path, monkeypatch):
+    # 替身库、模型目录和 autoPredictKPI 的进程内状态都只在本测试中有效
+    monkeypatch.setattr(KPI_db, "databases", {})
+    monkeypatch.setattr(KPI_modelCache, "registry", KPI_modelCache.ModelRegistry())
+    monkeypatch.setitem(autoPredictKPI.modelConfig, "saveDirs", str(tmp_path))
+    monkeypatch.setattr(autoPredictKPI, "tickMode", "sync")
+    monkeypatch.setattr(autoPredictKPI, "fallbackEnabled", True)
+    monkeypatch.setattr(autoPredictKPI, "changeTracking", True)
+    monkeypatch.setattr(autoPredictKPI, "windowStates", {})
+    monkeypatch.setattr(autoPredictKPI, "fallbackStates", {})
+    monkeypatch.setattr(autoPredictKPI, "fallbackKpiSet", set())
+    monkeypatch.setattr(autoPredictKPI, "ownedKpis", set())
+    monkeypatch.setattr(autoPredictKPI, "watermarks", KPI_discovery.Watermarks())
+    monkeypatch.setattr(autoPredictKPI, "tableDiscovery", KPI_discovery.TableDiscovery(autoPredictKPI.DB_NAME))
+    monkeypatch.setattr(autoPredictKPI, "shard", KPI_shard.Shard(0, 1))
+    monkeypatch.setattr(autoPredictKPI, "leases", None)
+    monkeypatch.setattr(autoPredictKPI, "tickState", {"running": False, "rerun": False})
+    return str(tmp_path)
+
+
+def make_tables(names, rows=tableRows, pending=pendingRows):
+    kpis = [KPI_benchmark.synthetic_kpi(rows + 200, seed=i) for i in range(len(names))]
+    db = KPI_benchmark.standin_database(names, [dict((column, values[:rows]) for column, values in kpi.items())
+                                                for kpi in kpis], pending)
+    return db, kpis
+
+
+def append_rows(db, name, kpi, start, stop):
+    KPI_benchmark.insert_rows(db, name, dict((column, values[start:stop]) for column, values in kpi.items()), 0)
+
+
+def save_model(saveDirs, name, seed=0):
+    os.makedirs(os.path.join(saveDirs, name), exist_ok=True)
+    KPI_npModel.save(KPI_benchmark.random_dense_model(seed), os.path.join(saveDirs, name, "model.npz"))
+
+
+def predictions(db, name):
+    return dict(db.query("SELECT id, predict FROM " + KPI_db.table(name) + " ORDER BY id"))
+
+
+def model_scores(name, values, ids):
+    # 模型对这些行的得分：特征与训练时相同（window_features），再交给缓存中的模型
+    config = autoPredictKPI.kpiConfig(name)
+    positions, features = KPI_feature.window_features(values, config["STA_windowSize_left"],
+                                                      config["STA_windowSize_right"], config["STA_fws"])
+    byId = dict(zip(positions + 1, features))
+    model = KPI_modelCache.get_model(name, config)
+    return model.predict(np.array([byId[i] for i in ids], dtype=np.float32))[:, 0]
+
+
+def test_fallback_until_model_appears(predictor):
+    name = "kpi_all_route_minute"
+    db, kpis = make_tables([name])
+    kpi = kpis[0]
+    # 待预测的行之前都有足够的历史
+    assert autoPredictKPI.getHistoryNum(name) < tableRows - pendingRows
+
+    # 没有模型：积压的行由在线检测器打分
+    autoPredictKPI.runTick()
+    assert name in autoPredictKPI.fallbackStates
+    assert name not in autoPredictKPI.windowStates
+    written = predictions(db, name)
+    pendingIds = range(tableRows - pendingRows + 1, tableRows + 1)
+    assert all(written[i] is not None and 0 <= written[i] < 1 for i in pendingIds)
+
+    # 新数据继续由在线检测器处理
+    append_rows(db, name, kpi, tableRows, tableRows + 50)
+    autoPredictKPI.runTick()
+    assert name in autoPredictKPI.fallbackStates
+    assert all(predictions(db, name)[i] is not None for i in range(tableRows + 1, tableRows + 51))
+
+    # model.npz 出现后丢弃在线检测器，之后的行由模型预测
+    save_model(predictor, name)
+    append_rows(db, name, kpi, tableRows + 50, tableRows + 200)
+    autoPredictKPI.runTick()
+    assert name not in autoPredictKPI.fallbackStates
+    assert name in autoPredictKPI.windowStates
+    newIds = list(range(tableRows + 51, tableRows + 201))
+    written = predictions(db, name)
+    np.testing.assert_allclose([written[i] for i in newIds], model_scores(name, kpi['value'], newIds), rtol=1e-5)
+
+
+def test_fallback_disabled_waits_for_model(predictor, monkeypatch):
+    monkeypatch.setattr(autoPredictKPI, "fallbackEnabled", False)
+    name = "kpi_all_wait_minute"
+    db, kpis = make_tables([name])
+    autoPredictKPI.runTick()
+    assert all(value is None for i, value in predictions(db, name).items() if i > tableRows - pendingRows)
+    assert name not in autoPredictKPI.fallbackStates
+
+    # 模型生成后一次预测积压的行
+    save_model(predictor, name)
+    autoPredictKPI.runTick()
+    pendingIds = list(range(tableRows - pendingRows + 1, tableRows + 1))
+    written = predictions(db, name)
+    np.testing.assert_allclose([written[i] for i in pendingIds], model_scores(name, kpis[0]['value'], pendingIds),
+                               rtol=1e-5)
+
+
+def test_tick_visits_only_changed_tables(predictor, monkeypatch):
+    names = ["kpi_all_w1_minute", "kpi_all_w2_minute"]
+    db, kpis = make_tables(names)
+    # 只在配置的库名下注册替身库：所有读写都要经过 DB_NAME
+    monkeypatch.setattr(KPI_db, "databases", {"kpi_test": db})
+    monkeypatch.setattr(autoPredictKPI, "DB_NAME", "kpi_test")
+    monkeypatch.setattr(autoPredictKPI, "tableDiscovery", KPI_discovery.TableDiscovery("kpi_test"))
+    for i, name in enumerate(names):
+        save_model(predictor, name, seed=i)
+    visited = []
+    getPendingFeatures = autoPredictKPI.getPendingFeatures
+
+    def record(kpiName, db_name, maxBatch):
+        visited.append(kpiName)
+        return getPendingFeatures(kpiName, db_name, maxBatch)
+    monkeypatch.setattr(autoPredictKPI, "getPendingFeatures", record)
+
+    autoPredictKPI.runTick()
+    assert sorted(visited) == names
+    assert all(value is not None for name in names for value in predictions(db, name).values())
+
+    # 只有 w2 有新数据：只访问 w2，新行被打分
+    del visited[:]
+    append_rows(db, names[1], kpis[1], tableRows, tableRows + 20)
+    autoPredictKPI.runTick()
+    assert visited == [names[1]]
+    written = predictions(db, names[1])
+    newIds = list(range(tableRows + 1, tableRows + 21))
+    np.testing.assert_allclose([written[i] for i in newIds], model_scores(names[1], kpis[1]['value'], newIds),
+                               rtol=1e-5)
+    assert autoPredictKPI.watermarks.backlog(names[1]) == 0
+
+    # 没有新数据时不访问任何表
+    del visited[:]
+    autoPredictKPI.runTick()
+    assert visited == []
+
+
+def pending_ids(db, name):
+    return [i for i, value in predictions(db, name).items() if value is None]
+
+
+def test_overlapping_ticks_coalesce(predictor, monkeypatch):
+    name = "kpi_all_tick_minute"
+    db, kpis = make_tables([name])
+    save_model(predictor, name)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    runTick = autoPredictKPI.runTick
+
+    def slowTick():
+        # 第一次 tick 做完后停住，模拟耗时超过调度间隔
+        calls.append(len(calls))
+        runTick()
+        if len(calls) == 1:
+            started.set()
+            release.wait(30)
+    monkeypatch.setattr(autoPredictKPI, "runTick", slowTick)
+    coalesced = KPI_metrics.counters.get(("ticks_coalesced_total", ()), 0)
+
+    first = threading.Thread(target=autoPredictKPI.every_ten_seconds)
+    first.start()
+    assert started.wait(30)
+    assert pending_ids(db, name) == []
+    # 运行期间到达的 tick 立即返回，多次只记一次重跑
+    append_rows(db, name, kpis[0], tableRows, tableRows + 30)
+    for _ in range(3):
+        autoPredictKPI.every_ten_seconds()
+    assert len(calls) == 1
+    assert KPI_metrics.counters[("ticks_coalesced_total", ())] == coalesced + 3
+    release.set()
+    first.join(30)
+    assert len(calls) == 2
+    assert pending_ids(db, name) == []
+    assert autoPredictKPI.tickState == {"running": False, "rerun": False}
+    autoPredictKPI.every_ten_seconds()
+    assert len(calls) == 3
+
+
+def test_failed_tick_releases_guard(predictor, monkeypatch):
+    calls = []
+
+    def failingTick():
+        calls.append(1)
+        raise RuntimeError("tick failed")
+    monkeypatch.setattr(autoPredictKPI, "runTick", failingTick)
+    with pytest.raises(RuntimeError):
+        autoPredictKPI.every_ten_seconds()
+    # 出错后下一次 tick 照常执行
+    with pytest.raises(RuntimeError):
+        autoPredictKPI.every_ten_seconds()
+    assert len(calls) == 2
+    assert autoPredictKPI.tickState["running"] is False
+
+
+@pytest.mark.parametrize("mode", ["async", "sync"])
+def test_one_kpi_failure_does_not_abort_others(predictor, monkeypatch, mode):
+    monkeypatch.setattr(autoPredictKPI, "tickMode", mode)
+    names = ["kpi_all_read_minute", "kpi_all_model_minute", "kpi_all_good_minute"]
+    db, kpis = make_tables(names)
+    for i, name in enumerate(names):
+        save_model(predictor, name, seed=i)
+    # 第一张表读取出错，第二张表预测出错
+    getPendingFeatures = autoPredictKPI.getPendingFeatures
+    predictBatch = KPI_predict.kpi_predict_batch
+
+    def failingRead(kpiName, db_name, maxBatch):
+        if kpiName == names[0]:
+            raise RuntimeError("read failed")
+        return getPendingFeatures(kpiName, db_name, maxBatch)
+
+    def failingPredict(kpiid, features, modelConfig):
+        if kpiid == names[1]:
+            raise RuntimeError("predict failed")
+        return predictBatch(kpiid, features, modelConfig)
+    monkeypatch.setattr(autoPredictKPI, "getPendingFeatures", failingRead)
+    monkeypatch.setattr(KPI_predict, "kpi_predict_batch", failingPredict)
+
+    autoPredictKPI.runTick()
+    assert pending_ids(db, names[2]) == []
+    assert len(pending_ids(db, names[0])) == pendingRows
+    assert len(pending_ids(db, names[1])) == pendingRows
+    # 出错的 KPI 丢弃窗口状态，下次 tick 重新预热
+    assert names[0] not in autoPredictKPI.windowStates
+    assert names[1] not in autoPredictKPI.windowStates
+    assert names[2] in autoPredictKPI.windowStates
+
+    monkeypatch.setattr(autoPredictKPI, "getPendingFeatures", getPendingFeatures)
+    monkeypatch.setattr(KPI_predict, "kpi_predict_batch", predictBatch)
+    autoPredictKPI.runTick()
+    for name in names:
+        assert pending_ids(db, name) == []
+    pendingIds = list(range(tableRows - pendingRows + 1, tableRows + 1))
+    written = predictions(db, names[1])
+    np.testing.assert_allclose([written[i] for i in pendingIds], model_scores(names[1], kpis[1]['value'], pendingIds),
+                               rtol=1e-5)